@@ -5,27 +5,240 @@ import pickle
 import sys
 import math
 import json
+import numpy as np
 import pandas
 import seaborn as sns
 pandas.set_option('display.width', 1000)
-from epivizquindex.utils import hcoords, range2bbox
-from epivizquindex.QuadTree import Index
+from epivizquindex.utils import hcoords, range2bbox, range2bbox_many, range2boxes
+from epivizquindex.QuadTree import Index, PAGE_SIZE, WRITE_BUFFER, ITEM_FIELDS
+from epivizquindex.IntervalIndex import IntervalIndex, INTERVAL_MAGIC
+from epivizquindex.cache import LRUCache, HandlePool
+from epivizquindex.binning import bin_entries, bin_edges, bin_summaries, summarize_entries, empty_tiles
 # from utils import hcoords, range2bbox
 # from QuadTree import Index
 from epivizFileParser import BigWig
 from epivizFileParser.utils import toDataFrame
 import matplotlib.ticker as ticker
 import struct
+import zlib
+from struct import unpack_from
 import time
+import mmap
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 __author__ = "Jayaram Kancherla"
 __copyright__ = "Jayaram Kancherla"
 __license__ = "mit"
 
+# available index engines
+ENGINES = {"quadtree": Index, "interval": IntervalIndex}
+
+# single file index: a header (magic, version, manifest offset, manifest length), the page aligned
+# chromosome indexes, the layer tables, and a json manifest with the file mapping, genome, chromosome index
+# and layer table offsets. Version 1 containers have no layer tables
+CONTAINER_NAME = "quindex.index"
+CONTAINER_MAGIC = 0x45504943
+CONTAINER_VERSION = 2
+# layers kept next to the chromosome indexes, with the tables of each chromosome and resolution or tile size
+LAYERS = ["summaries", "presence"]
+# files appended with append_files are indexed into delta segments (container files) listed in a json log
+LOG_NAME = "quindex.log"
+SEGMENT_NAME = "quindex.delta.{}.index"
+# fields of a leaf entry of the bigwig btree
+LEAF_FIELDS = ["rStartChromIx", "rStartBase", "rEndChromIx", "rEndBase", "rdataOffset", "rDataSize"]
+# the zoom level blocks of a chromosome are indexed in a separate tree, stored under the chromosome name
+# followed by this suffix. Its items are tagged with the reduction level (bases per zoom record) of the block
+ZOOM_SUFFIX = "@zoom"
+ZOOM_FIELDS = ITEM_FIELDS + ["reduction"]
+# container with only the layers, for indexes saved with one file per chromosome
+LAYERS_NAME = "quindex.layers.index"
+# largest number of tiles summed by summary, a coarser resolution is used for larger ranges
+SUMMARY_TILES = 1024
+# default tile size in bases of the presence bitmaps
+PRESENCE_TILE = 64 * 1024
+# number of item, region pairs compared at once when matching the records of a batch query to its regions
+OVERLAP_CHUNK = 1 << 22
+# data blocks separated by at most this many bytes in a bigwig file are fetched with one read
+READ_GAP = 64 * 1024
+# estimated overhead in bytes of a decoded data block in the block cache
+BLOCK_BYTES = 512
+# byte budget of the parsed headers kept for the bigwig files whose handle is closed
+HEADER_CACHE_SIZE = 64 * 1024 * 1024
+# attributes of a BigWig object restored when a closed file is opened again
+HEADER_FIELDS = ["endian", "header", "compressed", "columns", "zoomBin", "chromTreeBin", "chrmIds"]
+
+
+def _read_file_blocks(genome, engine, index_zooms, summary_resolutions, read_gap, file, fileid, zoomlvl):
+    '''
+    Read the leaf blocks of a file in a worker process, see EpivizQuindex.get_file_blocks, and its summary
+    tiles if the index has a summary layer. The reader has no index of its own, only the settings needed to encode the blocks.
+    '''
+    reader = EpivizQuindex.__new__(EpivizQuindex)
+    reader.genome = genome
+    reader.engine = engine
+    reader.index_zooms = index_zooms
+    reader.summary_resolutions = summary_resolutions
+    reader.read_gap = read_gap
+    bw, blocks = reader.get_file_blocks(file, fileid, zoomlvl)
+    return blocks, reader.get_file_summary(bw, blocks) if summary_resolutions else None
+
+
+def _tree_chrom(key):
+    '''
+    Return the chromosome of a tree key, the key of a zoom tree is the chromosome followed by ZOOM_SUFFIX.
+    '''
+    return key[:-len(ZOOM_SUFFIX)] if key.endswith(ZOOM_SUFFIX) else key
+
+
+def _overlap_pairs(starts, ends, region_starts, region_ends):
+    '''
+    Match items to the regions they overlap (both ends inclusive).
+
+        Returns:
+        - **items (ndarray)**: index of the item of each match.
+        - **regions (ndarray)**: index of the region of each match.
+    '''
+    # compare the items against all regions in chunks, to bound the size of the overlap matrix
+    step = max(1, OVERLAP_CHUNK // max(len(region_starts), 1))
+    items, regions = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    for i in range(0, len(starts), step):
+        rows, cols = np.nonzero((starts[i:i + step, None] <= region_ends) & (ends[i:i + step, None] >= region_starts))
+        items.append(rows + i)
+        regions.append(cols)
+    return np.concatenate(items), np.concatenate(regions)
+
+
+def _zoom_selected(zoomlvl, resolution, num_bins):
+    '''
+    Check the zoom arguments of a query: zoomlvl -2 reads the base level entries, -1 selects a zoom level
+    per file from a resolution or a number of bins.
+
+        Returns:
+        - **selected (bool)**: whether zoom levels are selected.
+    '''
+    if zoomlvl == -2:
+        if resolution is not None or num_bins is not None:
+            raise Exception("resolution and num_bins select a zoom level, they need zoomlvl = -1")
+        return False
+    if zoomlvl != -1:
+        raise Exception("zoomlvl is -2 for the base level, or -1 to select a zoom level per file")
+    if resolution is None and num_bins is None:
+        raise Exception("a resolution or number of bins is needed to select a zoom level")
+    return True
+
+
+def _coarsest_levels(records, resolutions, by):
+    '''
+    Keep the zoom blocks of the coarsest reduction level of each group whose reduction is at most the resolution.
+
+        Parameters:
+        - **records (Data Frame)**: zoom blocks with their reduction level.
+        - **resolutions (float or Series)**: requested number of bases per bin, or the resolution of each block.
+        - **by (list)**: columns of the groups, e.g. the file name.
+
+        Returns:
+        - **records (Data Frame)**: the kept blocks, with their reduction level as zoomlvl column.
+    '''
+    records = records.loc[records["reduction"] <= resolutions]
+    coarsest = records.groupby(by)["reduction"].transform("max")
+    return records.loc[records["reduction"] == coarsest].rename(columns = {"reduction": "zoomlvl"})
+
+
+def _encode_runs(bitmap):
+    '''
+    Run length encode a presence bitmap: consecutive tiles with the same file id bits share one run.
+
+        Parameters:
+        - **bitmap (ndarray)**: (tiles, bytes) array of the file id bits of each tile.
+
+        Returns:
+        - **runs (ndarray)**: structured array of the first tile and the file id bits of each run.
+    '''
+    change = np.ones(len(bitmap), dtype=bool)
+    change[1:] = (bitmap[1:] != bitmap[:-1]).any(axis=1)
+    first = np.flatnonzero(change)
+    runs = np.empty(len(first), dtype=[("tile", np.int64), ("bits", np.uint8, (bitmap.shape[1],))])
+    runs["tile"] = first
+    runs["bits"] = bitmap[first]
+    return runs
+
+
+def _decode_runs(runs, num_tiles):
+    '''
+    Expand the runs of a presence bitmap, see _encode_runs.
+
+        Parameters:
+        - **runs (ndarray)**: runs of the bitmap.
+        - **num_tiles (int)**: number of tiles of the bitmap.
+
+        Returns:
+        - **bitmap (ndarray)**: (tiles, bytes) array of the file id bits of each tile.
+    '''
+    return np.repeat(runs["bits"], np.diff(np.append(runs["tile"], num_tiles)), axis=0)
+
+
+def _coalesce(offsets, sizes, gap):
+    '''
+    Group data blocks into reads of consecutive file ranges.
+
+        Parameters:
+        - **offsets (ndarray)**: file offset of each block.
+        - **sizes (ndarray)**: size of each block.
+        - **gap (int)**: blocks separated by at most this many bytes are read together.
+
+        Returns:
+        - **reads (list)**: (offset, size, block indices) of each read, the blocks are sorted by offset.
+    '''
+    if len(offsets) == 0:
+        return []
+    order = np.argsort(offsets, kind='stable')
+    starts = offsets[order]
+    ends = np.maximum.accumulate(starts + sizes[order])
+    # a read ends where the next block starts more than gap bytes after all the previous blocks end
+    breaks = np.flatnonzero(starts[1:] > ends[:-1] + gap) + 1
+    bounds = np.concatenate([[0], breaks, [len(order)]])
+    return [(int(starts[lo]), int(ends[hi - 1] - starts[lo]), order[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+
+def _decode_block(data, zoomlvl, endian):
+    '''
+    Decode an uncompressed bigwig data block, a section of bedGraph, variable step or fixed step
+    entries, or zoom records when zoomlvl is not -2. See BigWig.parseLeafDataNode.
+
+        Returns:
+        - **block (tuple)**: chromosome id, start, end and value arrays of the entries.
+    '''
+    if zoomlvl != -2:
+        records = np.frombuffer(data, dtype=np.dtype([("chrom", "u4"), ("start", "u4"), ("end", "u4"), ("count", "u4"),
+                                                      ("min", "f4"), ("max", "f4"), ("sum", "f4"), ("squares", "f4")]).newbyteorder(endian),
+                                count=len(data) // 32)
+        total = records["sum"].astype(np.float64)
+        count = records["count"].astype(np.float64)
+        value = np.divide(total, count, out=total.copy(), where=count > 0)
+        return records["chrom"], records["start"], records["end"], value
+    (chromId, chromStart, chromEnd, itemStep, itemSpan, iType, _, itemCount) = unpack_from(endian + "IIIIIBBH", data, 0)
+    if iType == 1:
+        items = np.frombuffer(data, dtype=np.dtype([("start", "u4"), ("end", "u4"), ("value", "f4")]).newbyteorder(endian),
+                              count=itemCount, offset=24)
+        start, end, value = items["start"], items["end"], items["value"]
+    elif iType == 2:
+        items = np.frombuffer(data, dtype=np.dtype([("start", "u4"), ("value", "f4")]).newbyteorder(endian),
+                              count=itemCount, offset=24)
+        start, value = items["start"], items["value"]
+        end = start.astype(np.int64) + itemSpan
+    elif iType == 3:
+        value = np.frombuffer(data, dtype=np.dtype("f4").newbyteorder(endian), count=itemCount, offset=24)
+        start = chromStart + itemStep * np.arange(itemCount, dtype=np.int64)
+        end = start + itemSpan
+    else:
+        raise Exception("unknown bigwig section type " + str(iType))
+    return np.full(len(value), chromId, dtype=np.int64), start, end, value.astype(np.float64)
+
 
 class EpivizQuindex(object):
 
-    def __init__(self, genome, max_depth=20, max_items=256, base_path = os.path.join(os.getcwd(), 'quIndex/')):
+    def __init__(self, genome, max_depth=20, max_items=256, base_path = os.path.join(os.getcwd(), 'quIndex/'), engine = "quadtree", node_cache_size = 64 * 1024 * 1024, max_query_boxes = 16, fetch_workers = 8, read_gap = READ_GAP, block_cache_size = 256 * 1024 * 1024, max_open_files = 256, index_zooms = True, summary_resolutions = None, presence_tile = PRESENCE_TILE):
         '''
         Initialization of Quindex object.
 
@@ -34,12 +247,35 @@ class EpivizQuindex(object):
             - **max_depth (int)**: maximum depth of the Quindex.
             - **max_items (int)**: maximum number of items in a node before splitting.
             - **base_path (str)**: path to the index folder. If the index is precomputed, you need to set this path to the folder to load the Quindex.
+            - **engine (str)**: index engine of the chromosome trees, "quadtree" (2D hilbert quadtree) or "interval" (1D interval index).
+                                When the index is loaded with from_disk, the engine stored on disk is used.
+            - **node_cache_size (int)**: byte budget of the cache of decoded index nodes used by file based queries,
+                                         shared by all chromosomes. 0 disables the cache.
+            - **max_query_boxes (int)**: maximum number of hilbert space boxes a query range is decomposed into, see utils.range2boxes.
+                                         1 searches the single bounding box of the range.
+            - **fetch_workers (int)**: number of threads fetching the entries of different files in query, 1 fetches the files one after the other.
+            - **read_gap (int)**: data blocks of a file separated by at most this many bytes are fetched with one read.
+            - **block_cache_size (int)**: byte budget of the cache of decoded bigwig data blocks used by query,
+                                          shared by all files and chromosomes. 0 disables the cache.
+            - **max_open_files (int)**: maximum number of bigwig file objects kept open, the least recently used
+                                        ones are closed. Their parsed headers are kept to open them again.
+            - **index_zooms (bool)**: also index the zoom level blocks of the files, so that query can read
+                                      summary records instead of the base level entries, see query.
+            - **summary_resolutions (list)**: tile sizes in bases of the summary layer, which keeps statistics of every file
+                                              per tile so that summary and bin_stats can answer overviews without reading
+                                              the files. The entries of the files are read once when they are added.
+                                              None disables the summary layer, it is enabled when loading an index that has one.
+            - **presence_tile (int)**: tile size in bases of the presence bitmaps, which record the files with blocks in
+                                       each tile of a chromosome so that hit only searches the tiles at the ends of the range.
+                                       None disables the bitmaps.
 
             Returns:
                     
         '''
         self.file_mapping = []
-        self.file_objects = {}
+        # bigwig file objects, and the parsed headers of the closed ones
+        self.file_headers = LRUCache(HEADER_CACHE_SIZE)
+        self.file_objects = HandlePool(max_open_files, self._open_file, self._close_file)
         # self.file_chrids = {}
         self.genome = genome
         self.max_items = max_items
@@ -47,6 +283,30 @@ class EpivizQuindex(object):
         self.base_path = base_path
         self.file_counter = 0
         self.trees = {}
+        # delta segments of appended files, each a dictionary of chromosome indexes
+        self.segments = []
+        self.segment_files = []
+        # ids of removed files, their items are skipped until the index is compacted
+        self.removed = set()
+        if engine not in ENGINES:
+            raise Exception("unknown index engine " + str(engine))
+        self.engine = engine
+        self.node_cache = LRUCache(node_cache_size) if node_cache_size else None
+        self.block_cache = LRUCache(block_cache_size) if block_cache_size else None
+        self.max_query_boxes = max_query_boxes
+        self.fetch_workers = fetch_workers
+        self.read_gap = read_gap
+        self.index_zooms = index_zooms
+        self.summary_resolutions = sorted(summary_resolutions) if summary_resolutions else None
+        # summary tiles of each chromosome and resolution, a (files, tiles) array with one row per file id
+        self.summaries = {}
+        self.presence_tile = presence_tile
+        # presence bitmaps of each chromosome and tile size, the runs of tiles with the same file id bits, see _encode_runs
+        self.presence = {}
+        # summary tiles and presence bitmaps of the files of each delta segment, with the id of its first file
+        self.segment_layers = []
+        # number of query boxes, candidate items and matching items of the last get_records call
+        self.last_query_stats = {}
         if not os.path.exists(base_path):
             os.mkdir(base_path)
 
@@ -57,10 +317,10 @@ class EpivizQuindex(object):
 
             Parameters:
             - **file (str)**:       file path .
-            - **zoomlvl (int)**:    zoom level of the btree.
+            - **zoomlvl (int)**:    unused, the zoom level btrees are read with get_zoom_tree.
 
             Returns:
-            - **tree (bytes)**:       btree of the bigwig file in the given zoom level.
+            - **tree (bytes)**:       btree of the base level of the bigwig file.
             - **bw (object)**:        bigwig file object.
         '''
         bw = BigWig(file)
@@ -68,7 +328,7 @@ class EpivizQuindex(object):
         bw.zooms = {}
         totalLevels = bw.header.get("zoomLevels")
         if totalLevels <= 0:
-            return -2, bw.header.get("fullIndexOffset")
+            return bw.getTree(-2), bw
             
         data = bw.zoomBin
         # if data is None:
@@ -86,6 +346,30 @@ class EpivizQuindex(object):
             bw.zooms[level].append(bw.zooms[level + 1][2] - bw.zooms[level][1])        
         tree = bw.getTree(-2)
         return tree, bw
+
+    def get_zoom_tree(self, bw, zoomlvl):
+        '''
+        Return the btree of a zoom level of the bigwig file. The size of the btree is bounded from its header,
+        as the last zoom level has no next level to end it.
+
+            Parameters:
+            - **bw (object)**:      bigwig file object, with the zoom levels read by get_file_btree.
+            - **zoomlvl (int)**:    zoom level of the btree.
+
+            Returns:
+            - **tree (bytes)**:     btree of the zoom level, starting at its index offset.
+        '''
+        indexOffset = bw.zooms[zoomlvl][1]
+        (rMagic, rBlockSize, rItemCount) = struct.unpack_from(bw.endian + "IIQ", bw.get_bytes(indexOffset, 48))
+        # nodes hold at most rBlockSize entries of 32 (leaf) or 24 (parent) bytes after a 4 byte header
+        nodes = max(math.ceil(rItemCount / rBlockSize), 1)
+        size = 48 + nodes * (4 + 32 * rBlockSize)
+        while nodes > 1:
+            nodes = math.ceil(nodes / rBlockSize)
+            size += nodes * (4 + 24 * rBlockSize)
+        if zoomlvl + 1 in bw.zooms:
+            size = min(size, bw.zooms[zoomlvl + 1][2] - indexOffset)
+        return bw.get_bytes(indexOffset, size)
     
     def read_node(self, tree, offset, endian="="):
         '''
@@ -103,7 +387,7 @@ class EpivizQuindex(object):
         (rIsLeaf, rReserved, rCount) = struct.unpack(endian + "BBH", data)
         return {"rIsLeaf": rIsLeaf, "rCount": rCount, "rOffset": offset + 4}
 
-    def traverse_nodes(self, node, zoomlvl = -2, tree = None, result = [], fullIndexOffset = None, endian="="):
+    def traverse_nodes(self, node, zoomlvl = -2, tree = None, result = None, fullIndexOffset = None, endian="="):
         '''
         Recursively traverse and return the value in the btree.
 
@@ -118,6 +402,8 @@ class EpivizQuindex(object):
             Returns:
             - **result (list)**:          recursive result array to store the parsed leaf nodes.        
         '''
+        if result is None:
+            result = []
         offset = node.get("rOffset")
         if node.get("rIsLeaf"):
             for i in range(0, node.get("rCount")):
@@ -148,17 +434,207 @@ class EpivizQuindex(object):
             Returns:
             - **df (DataFrame)**:  Data frame of btree nodes' values.        
         '''
-        findexOffset = bw.header.get("fullIndexOffset")
-        offset = 48
-        root = self.read_node(tree, offset, endian = bw.endian)
-        records = self.traverse_nodes(root, zoomlvl, tree = tree, result = [], fullIndexOffset = findexOffset, endian = bw.endian)
-        # print(hex(id(records)))
-        df = pandas.DataFrame(records, columns=["rStartChromIx", "rStartBase", "rEndChromIx", "rEndBase", 
-                    "rdataOffset", "rDataSize"])
-
-        # print(root)
+        blocks = self.get_leaf_blocks(tree, bw, zoomlvl)
+        df = pandas.DataFrame({name: blocks[name].astype(np.int64) for name in LEAF_FIELDS}, columns = LEAF_FIELDS)
         return df
 
+    def get_leaf_blocks(self, tree, bw, zoomlvl, indexOffset = None):
+        '''
+        read the leaf entries of the bigwig btree. The btree is walked iteratively, in the same order as
+        traverse_nodes, and the entries of each leaf node are decoded at once with a numpy dtype in the endian of the file.
+
+            Parameters:
+            - **tree (bytes)**:    btree from bigwig file.
+            - **bw (object)**:     bigwig file object.
+            - **zoomlvl (int)**:   zoomlevel of the node.
+            - **indexOffset (int)**: file offset of the btree, the full index offset by default.
+
+            Returns:
+            - **blocks (ndarray)**:  structured array of the leaf entries, with the fields of LEAF_FIELDS.
+        '''
+        endian = bw.endian
+        leaf = np.dtype([(name, endian + t) for name, t in zip(LEAF_FIELDS, ["u4", "u4", "u4", "u4", "u8", "u8"])])
+        child = np.dtype([(name, endian + t) for name, t in zip(LEAF_FIELDS[:5], ["u4", "u4", "u4", "u4", "u8"])])
+        # child offsets are file offsets, the stored binary starts at the index offset
+        findexOffset = bw.header.get("fullIndexOffset") if indexOffset is None else indexOffset
+        leaves = [np.empty(0, dtype=leaf)]
+        stack = [48]
+        while stack:
+            offset = stack.pop()
+            (rIsLeaf, rReserved, rCount) = struct.unpack_from(endian + "BBH", tree, offset)
+            if rIsLeaf:
+                leaves.append(np.frombuffer(tree, dtype=leaf, count=rCount, offset=offset + 4))
+            else:
+                children = np.frombuffer(tree, dtype=child, count=rCount, offset=offset + 4)["rdataOffset"]
+                stack += (children.astype(np.int64) - findexOffset)[::-1].tolist()
+        return np.concatenate(leaves)
+
+    def get_file_summary(self, bw, blocks):
+        '''
+        Read all the entries of a file and compute its summary tiles.
+
+            Parameters:
+            - **bw (object)**:    bigwig file object.
+            - **blocks (dict)**:  leaf blocks of the file, see get_file_blocks.
+
+            Returns:
+            - **summary (dict)**: dictionary mapping each chromosome of the file to its tiles at each resolution
+                                  of summary_resolutions, see binning.summarize_entries.
+        '''
+        summary = {}
+        if bw is None:
+            return summary
+        for chrm, (items, _) in blocks.items():
+            if chrm.endswith(ZOOM_SUFFIX):
+                continue
+            starts, ends, values = self.read_entries(bw, chrm, items[:, 2], items[:, 3])
+            summary[chrm] = {resolution: summarize_entries(starts, ends, values, self.genome[chrm], resolution)
+                             for resolution in self.summary_resolutions}
+        return summary
+
+    def read_entries(self, bw, chrm, offsets, sizes):
+        '''
+        Read and decode base level data blocks of a file, without the block cache. Blocks that are at most
+        read_gap bytes apart are fetched with one read.
+
+            Parameters:
+            - **bw (object)**:       bigwig file object.
+            - **chrm (str)**:        chromosome of the blocks.
+            - **offsets (ndarray)**: file offsets of the blocks.
+            - **sizes (ndarray)**:   sizes of the blocks.
+
+            Returns:
+            - **starts, ends, values (ndarray)**: the entries of the chromosome in the blocks.
+        '''
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        chrmId = bw.getId(chrm)
+        result = [[np.empty(0, dtype=np.int64)] * 2 + [np.empty(0, dtype=np.float64)]]
+        for read_offset, read_size, members in _coalesce(offsets, sizes, self.read_gap):
+            data = bw.get_bytes(read_offset, read_size)
+            for i in members.tolist():
+                block = data[offsets[i] - read_offset:offsets[i] - read_offset + sizes[i]]
+                chroms, starts, ends, values = _decode_block(zlib.decompress(block) if bw.compressed else block, -2, bw.endian)
+                keep = chroms == chrmId
+                result.append([starts[keep], ends[keep], values[keep]])
+        return [np.concatenate(column).astype(dtype) for column, dtype in zip(zip(*result), [np.int64, np.int64, np.float64])]
+
+    def add_summaries(self, fileids, summaries, layers = None):
+        '''
+        Add the summary tiles of new files to the summary layer. Files without tiles for a chromosome,
+        e.g. files without entries on it, get empty tiles.
+
+            Parameters:
+            - **fileids (list)**:   ids of the files.
+            - **summaries (list)**: summary of each file, see get_file_summary.
+            - **layers (dict)**:    layers of a delta segment to add the tiles to, see index_files.
+
+            Returns:
+       
+        '''
+        first, layer = (0, self.summaries) if layers is None else (layers["first_fileid"], layers["summaries"])
+        chroms = list(layer)
+        for summary in summaries:
+            chroms += [chrm for chrm in (summary or {}) if chrm not in chroms]
+        for chrm in chroms:
+            tables = layer.setdefault(chrm, {})
+            for resolution in self.summary_resolutions:
+                num_tiles = max(-(-self.genome[chrm] // resolution), 1)
+                table = tables.get(resolution, empty_tiles((0, num_tiles)))
+                rows = empty_tiles((self.file_counter - first - len(table), num_tiles))
+                for fileid, summary in zip(fileids, summaries):
+                    if summary is not None and chrm in summary:
+                        rows[fileid - first - len(table)] = summary[chrm][resolution]
+                tables[resolution] = np.concatenate([table, rows])
+
+    def add_presence(self, chrm, items, layers = None):
+        '''
+        Set the bits of the files of new blocks in the presence bitmaps of a chromosome.
+
+            Parameters:
+            - **chrm (str)**:        chromosome.
+            - **items (ndarray)**:   (n, 5) array of items (start, end, offset, size, fileid) of the blocks.
+            - **layers (dict)**:     layers of a delta segment to set the bits in, see index_files.
+
+            Returns:
+       
+        '''
+        first_fileid, layer = (0, self.presence) if layers is None else (layers["first_fileid"], layers["presence"])
+        tile = self.presence_tile
+        num_tiles = max(-(-self.genome[chrm] // tile), 1)
+        width = -(-(self.file_counter - first_fileid) // 8)
+        bitmap = np.zeros((num_tiles, width), dtype=np.uint8)
+        previous = layer.setdefault(chrm, {}).get(tile)
+        if previous is not None:
+            bitmap[:, :previous["bits"].shape[1]] = _decode_runs(previous, num_tiles)
+        # blocks and ranges include both ends, a block is present in every tile from its start to its end
+        first = np.clip(items[:, 0] // tile, 0, num_tiles - 1)
+        last = np.clip(items[:, 1] // tile, first, num_tiles - 1)
+        counts = last - first + 1
+        block = np.repeat(np.arange(len(items)), counts)
+        tiles = first[block] + np.arange(len(block)) - np.repeat(np.cumsum(counts) - counts, counts)
+        fileids = items[block, 4] - first_fileid
+        np.bitwise_or.at(bitmap, (tiles, fileids >> 3), (1 << (fileids & 7)).astype(np.uint8))
+        layer[chrm][tile] = _encode_runs(bitmap)
+
+    def present_files(self, chrm, start, end):
+        '''
+        Return the files with blocks in the tiles covering a range, from the presence bitmaps.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the range.
+            - **end (int)**: end location of the range.
+
+            Returns:
+            - **present (ndarray)**: boolean array indexed by file id.
+        '''
+        present = np.zeros(self.file_counter, dtype=bool)
+        num_tiles = max(-(-self.genome[chrm] // self.presence_tile), 1) if chrm in self.genome else 0
+        first = max(start // self.presence_tile, 0)
+        last = min(end // self.presence_tile, num_tiles - 1)
+        if last < first:
+            return present
+        for first_fileid, layer in self._layer_parts("presence"):
+            runs = layer.get(chrm, {}).get(self.presence_tile)
+            if runs is None:
+                continue
+            # the runs overlapping the tiles, the first run starts at tile 0
+            lo, hi = np.searchsorted(runs["tile"], [first, last], 'right') - 1
+            bits = np.bitwise_or.reduce(runs["bits"][lo:hi + 1], axis=0)
+            unpacked = np.unpackbits(bits, bitorder='little')[:self.file_counter - first_fileid].astype(bool)
+            present[first_fileid:first_fileid + len(unpacked)] |= unpacked
+        return present
+
+    def _layer_parts(self, name):
+        '''
+        Return the tables of a layer of the index, followed by those of its delta segments.
+
+            Parameters:
+            - **name (str)**: name of the layer, "summaries" or "presence".
+
+            Returns:
+            - **parts (list)**: (first file id, tables) pairs, the rows or bits of the tables start at the first file id.
+        '''
+        return [(0, getattr(self, name))] + [(layers["first_fileid"], layers[name]) for layers in self.segment_layers]
+
+    def read_layers(self, layers):
+        '''
+        Use the summary layer and presence bitmaps saved with the index, see read_container.
+        A layer that was not saved with the index or its delta segments is disabled, it would not cover the indexed files.
+
+            Parameters:
+            - **layers (dict)**: tables of each layer of LAYERS, chromosome and resolution or tile size.
+
+            Returns:
+       
+        '''
+        self.summaries, self.presence = layers["summaries"], layers["presence"]
+        self.summary_resolutions = sorted({resolution for _, layer in self._layer_parts("summaries")
+                                           for tables in layer.values() for resolution in tables}) or None
+        tiles = {tile for _, layer in self._layer_parts("presence") for tables in layer.values() for tile in tables}
+        self.presence_tile = min(tiles) if len(tiles) != 0 else None
+
     def get_file_chr(self, bw):
         '''
         Return the chromosomes in the given bigwig file.
@@ -172,6 +648,126 @@ class EpivizQuindex(object):
         bw.getId("chr2")
         return bw.chrmIds
 
+    def get_tree(self, chrm):
+        '''
+        Return the index of a chromosome, creating an empty one if needed.
+
+            Parameters:
+            - **chrm (str)**: chromosome.
+
+            Returns:
+            - **tree (Index or IntervalIndex)**: index of the chromosome.
+        '''
+        if self.trees.get(chrm) == None:
+            self.trees[chrm] = self.new_tree(chrm)
+        return self.trees[chrm]
+
+    def new_tree(self, chrm):
+        '''
+        Create an empty index for a chromosome, with the engine of the Quindex.
+
+            Parameters:
+            - **chrm (str)**: chromosome, or the key of a zoom tree (chromosome followed by ZOOM_SUFFIX).
+
+            Returns:
+            - **tree (Index or IntervalIndex)**: empty index of the chromosome.
+        '''
+        # zoom trees have the reduction level as extra item field
+        fields = ZOOM_FIELDS if chrm.endswith(ZOOM_SUFFIX) else None
+        if self.engine == "interval":
+            return IntervalIndex(fields = fields)
+        chromLength = self.genome[_tree_chrom(chrm)]
+        dims = 2
+        hlevel = math.ceil(math.log2(chromLength)/dims)
+        x_y_dim = math.ceil(math.pow(2, hlevel))
+        return Index(bbox=(0, 0, x_y_dim, x_y_dim), cache = self.node_cache, fields = fields)
+
+    def get_file_blocks(self, file, fileid, zoomlvl = -2):
+        '''
+        Read the leaf blocks of a file, and compute their bounding boxes in hilbert space.
+
+            Parameters:
+            - **file (str)**:     file path.
+            - **fileid (int)**:   id of the file in the Quindex.
+            - **zoomlvl (int)**:  unused, the base level blocks are read, and the zoom level blocks with index_zooms.
+
+            Returns:
+            - **bw (object)**:    bigwig file object.
+            - **blocks (dict)**:  dictionary mapping each chromosome of the file to a tuple of
+                                  an (n, 5) array of items (start, end, offset, size, fileid) and an (n, 4) array of bounding boxes.
+                                  Bounding boxes are only computed for the quadtree engine, they are None otherwise.
+                                  With index_zooms, the zoom level blocks of a chromosome are mapped to by its name followed
+                                  by ZOOM_SUFFIX, as (n, 6) arrays of items with the reduction level of the block as last field.
+        '''
+        tree, bw = self.get_file_btree(file)
+        leaves = self.get_leaf_blocks(tree, bw, -2)
+        chrmTree = self.get_file_chr(bw)
+
+        # group the entries by chromosome, keeping their order within a chromosome
+        order = np.argsort(leaves["rStartChromIx"], kind='stable')
+        leaves = leaves[order]
+        chromIx = leaves["rStartChromIx"]
+        blocks = {}
+        for chrm in chrmTree.keys():
+            chromLength = self.genome[chrm]
+            hlevel = math.ceil(math.log2(chromLength)/2)
+            lo, hi = np.searchsorted(chromIx, chrmTree[chrm], 'left'), np.searchsorted(chromIx, chrmTree[chrm], 'right')
+            chrm_leaves = leaves[lo:hi]
+            items = np.empty((len(chrm_leaves), 5), dtype=np.int64)
+            items[:, 0] = chrm_leaves["rStartBase"]
+            items[:, 1] = chrm_leaves["rEndBase"]
+            items[:, 2] = chrm_leaves["rdataOffset"]
+            items[:, 3] = chrm_leaves["rDataSize"]
+            items[:, 4] = fileid
+            if self.engine == "quadtree":
+                blocks[chrm] = (items, range2bbox_many(hlevel, items[:, 0], items[:, 1]).astype('d'))
+            else:
+                blocks[chrm] = (items, None)
+        if getattr(self, "index_zooms", False):
+            blocks.update(self.get_zoom_blocks(bw, fileid, chrmTree))
+        return bw, blocks
+
+    def get_zoom_blocks(self, bw, fileid, chrmTree):
+        '''
+        Read the leaf blocks of every zoom level of a file. Unlike base level sections, a block of zoom records
+        may span several chromosomes, it is then indexed in each of them, up to the last base of the chromosome.
+
+            Parameters:
+            - **bw (object)**:      bigwig file object, with the zoom levels read by get_file_btree.
+            - **fileid (int)**:     id of the file in the Quindex.
+            - **chrmTree (dict)**:  chromosome to id mapping of the file.
+
+            Returns:
+            - **blocks (dict)**:  dictionary mapping the zoom tree key of each chromosome to a tuple of an (n, 6) array
+                                  of items (start, end, offset, size, fileid, reduction) and an (n, 4) array of bounding boxes.
+        '''
+        levels = []
+        for level, (reductionLevel, indexOffset, _, _) in bw.zooms.items():
+            leaves = self.get_leaf_blocks(self.get_zoom_tree(bw, level), bw, level, indexOffset)
+            levels.append((leaves, reductionLevel))
+        if len(levels) == 0:
+            return {}
+        leaves = np.concatenate([leaves for leaves, _ in levels])
+        reductions = np.concatenate([np.full(len(leaves), reductionLevel, dtype=np.int64) for leaves, reductionLevel in levels])
+        blocks = {}
+        for chrm, chrmId in chrmTree.items():
+            chromLength = self.genome[chrm]
+            hlevel = math.ceil(math.log2(chromLength)/2)
+            keep = (leaves["rStartChromIx"] <= chrmId) & (leaves["rEndChromIx"] >= chrmId)
+            chrm_leaves = leaves[keep]
+            items = np.empty((len(chrm_leaves), 6), dtype=np.int64)
+            items[:, 0] = np.where(chrm_leaves["rStartChromIx"] == chrmId, chrm_leaves["rStartBase"], 0)
+            items[:, 1] = np.where(chrm_leaves["rEndChromIx"] == chrmId, chrm_leaves["rEndBase"], chromLength - 1)
+            items[:, 2] = chrm_leaves["rdataOffset"]
+            items[:, 3] = chrm_leaves["rDataSize"]
+            items[:, 4] = fileid
+            items[:, 5] = reductions[keep]
+            if self.engine == "quadtree":
+                blocks[chrm + ZOOM_SUFFIX] = (items, range2bbox_many(hlevel, items[:, 0], items[:, 1]).astype('d'))
+            else:
+                blocks[chrm + ZOOM_SUFFIX] = (items, None)
+        return blocks
+
     def add_to_index(self, file, zoomlvl = -2):
         '''
         Add a file to Quindex.
@@ -182,87 +778,503 @@ class EpivizQuindex(object):
             Returns:
                            
         '''
-        tree, bw = self.get_file_btree(file, zoomlvl)
-        df = self.get_leaf_nodes(tree, bw, zoomlvl)
-        chrmTree = self.get_file_chr(bw)
+        self.add_files([file], zoomlvl)
 
-        self.file_mapping.append(file)
-        
-        self.file_objects[file] = bw
+    def add_files(self, files, zoomlvl = -2, workers = None):
+        '''
+        Add files to Quindex. The leaf blocks of all files are collected first, and each chromosome
+        tree is then built with one bulk insert.
 
-        for chrm in chrmTree.keys():
-            # print(chrm)
-            chromLength = self.genome[chrm]
-            
-            if self.trees.get(chrm) == None:
-                dims = 2
-                hlevel = math.ceil(math.log2(chromLength)/dims)
-                # print("hlevel", hlevel)
-                x_y_dim = math.ceil(math.pow(2, hlevel))
-                # print("max x|y =", x_y_dim)
-                tree = Index(bbox=(0, 0, x_y_dim, x_y_dim))
-                self.trees[chrm] = tree
-            tree = self.trees[chrm]
-
-
-            chrmId = chrmTree[chrm]
-            df_chrmId = df[df["rStartChromIx"] == chrmId]
-            # print(chrmId, df.head())
-            # print("\t df shape - ", df.shape)
-            for i, row in df_chrmId.iterrows():
-                # x, y, _ = hcoords(row["rStartBase"], chromLength)
-                # x_start, y_start, _ = hcoords(row["rStartBase"], chromLength)
-                _, _, hlevel = hcoords(row["rEndBase"], chromLength)
-                bbox = range2bbox(hlevel, {"start":row["rStartBase"], "end":row["rEndBase"]})
-                # print("\t\t bbox", bbox)
-                # bbox = (x_start, y_start, x_end, y_end)
-                tree.insert((row["rStartBase"], row["rEndBase"], row["rdataOffset"], row["rDataSize"], self.file_counter), bbox)
-                # tree.insert((row["rStartBase"], row["rEndBase"], row["rdataOffset"], row["rDataSize"], fileIds[file]), (x, y, x+1, y+1))
-            
-        
-        self.file_counter += 1
+            Parameters:
+            - **files (list)**:   file paths.
+            - **zoomlvl (int)**:  unused, see get_file_blocks.
+            - **workers (int)**:  number of processes reading the files in parallel. By default files are read one by one.
 
-    def to_disk(self):
+            Returns:
+                           
+        '''
+        self.index_files(files, self.trees, zoomlvl, workers)
+
+    def index_files(self, files, trees, zoomlvl = -2, workers = None, layers = None):
+        '''
+        Register files in the file mapping and insert their leaf blocks into a set of chromosome indexes.
+        File ids are assigned in the order of the files, also when they are read in parallel.
+
+            Parameters:
+            - **files (list)**:   file paths.
+            - **trees (dict)**:   chromosome indexes to insert into, missing chromosomes are created.
+            - **zoomlvl (int)**:  unused, see get_file_blocks.
+            - **workers (int)**:  number of processes reading the files in parallel. By default files are read one by one.
+            - **layers (dict)**:  layers of a delta segment receiving the summary tiles and presence bits of the files,
+                                  with the id of its first file ("first_fileid"). By default the layers of the index.
+
+            Returns:
+                           
+        '''
+        fileids = list(range(self.file_counter, self.file_counter + len(files)))
+        if workers is not None and workers > 1 and len(files) > 1:
+            # the workers only return the blocks, the file objects are opened again when queried
+            with ProcessPoolExecutor(max_workers = min(workers, len(files))) as pool:
+                results = list(pool.map(_read_file_blocks, repeat(self.genome), repeat(self.engine), repeat(self.index_zooms),
+                                        repeat(self.summary_resolutions), repeat(self.read_gap), files, fileids, repeat(zoomlvl)))
+            file_blocks = [blocks for blocks, _ in results]
+            file_summaries = [summary for _, summary in results]
+        else:
+            file_blocks, file_summaries = [], []
+            for file, fileid in zip(files, fileids):
+                bw, blocks = self.get_file_blocks(file, fileid, zoomlvl)
+                file_summaries.append(self.get_file_summary(bw, blocks) if self.summary_resolutions else None)
+                if bw is not None:
+                    # the btree data read to index the file is not needed to query it
+                    bw.cacheData = {}
+                    self.file_objects.add(file, bw)
+                file_blocks.append(blocks)
+
+        blocks = {}
+        for file, file_block in zip(files, file_blocks):
+            self.file_mapping.append(file)
+            self.file_counter += 1
+            for chrm, chrm_blocks in file_block.items():
+                blocks.setdefault(chrm, []).append(chrm_blocks)
+
+        for chrm, chrm_blocks in blocks.items():
+            items = np.concatenate([b[0] for b in chrm_blocks])
+            bboxes = np.concatenate([b[1] for b in chrm_blocks]) if self.engine == "quadtree" else None
+            if trees.get(chrm) is None:
+                trees[chrm] = self.new_tree(chrm)
+            trees[chrm].insert_many(items, bboxes)
+        if self.summary_resolutions:
+            self.add_summaries(fileids, file_summaries, layers)
+        if self.presence_tile:
+            for chrm, chrm_blocks in blocks.items():
+                if not chrm.endswith(ZOOM_SUFFIX):
+                    self.add_presence(chrm, np.concatenate([b[0] for b in chrm_blocks]), layers)
+
+    def append_files(self, files, zoomlvl = -2, workers = None):
+        '''
+        Add files to a Quindex saved on disk without rewriting it. The files are indexed into a new
+        delta segment next to the saved index, with their summary tiles and presence bits, and queries merge
+        the results of the index and its segments. Use compact to fold the segments into the index.
+
+            Parameters:
+            - **files (list)**:   file paths.
+            - **zoomlvl (int)**:  unused, see get_file_blocks.
+            - **workers (int)**:  number of processes reading the files in parallel, see add_files.
+
+            Returns:
+                           
+        '''
+        if not self.on_disk():
+            raise Exception("no index saved in " + self.base_path + ", use add_files and to_disk first")
+        if len(self.trees) == 0:
+            raise Exception("load the saved index with from_disk first")
+        start = len(self.file_mapping)
+        self.file_counter = start
+        trees = {}
+        layers = {"first_fileid": start, "summaries": {}, "presence": {}}
+        self.index_files(files, trees, zoomlvl, workers, layers)
+        name = SEGMENT_NAME.format(len(self.segment_files) + 1)
+        path = os.path.join(self.base_path, name)
+        # the layers are written with the segment, the log only lists complete segments
+        self.write_container(path, trees, {"file_mapping": self.file_mapping[start:], "first_fileid": start}, layers)
+        self.segments.append(self.read_container(path, load = False, trees = trees)[1])
+        self.segment_layers.append(layers)
+        self.segment_files.append(name)
+        self.write_log()
+
+    def remove_file(self, file):
+        '''
+        Remove a file from Quindex. The file id is tombstoned and its items are skipped by queries,
+        they are dropped and the file ids renumbered when the index is compacted.
+        On a saved index, the tombstone is recorded in the log of the index.
+
+            Parameters:
+            - **file (str)**:   file path.
+
+            Returns:
+                           
+        '''
+        ids = [fileid for fileid, name in enumerate(self.file_mapping) if name == file and fileid not in self.removed]
+        if len(ids) == 0:
+            raise Exception("file " + str(file) + " is not indexed")
+        self.removed.update(ids)
+        self.file_objects.discard(file)
+        self.file_headers.discard(lambda key: key == file)
+        if self.block_cache is not None:
+            self.block_cache.discard(lambda key: key[0] == file)
+        if self.on_disk():
+            self.write_log()
+
+    def active_files(self):
+        '''
+        Return the files of Quindex that are not removed.
+
+            Returns:
+            - **files (list)**:   file paths, in file id order.
+        '''
+        return [name for fileid, name in enumerate(self.file_mapping) if fileid not in self.removed]
+
+    def to_disk(self, single_file = False):
         '''
         Save the current index to the path that is stored when creating the Quindex object.
+        Delta segments of appended files are folded into the saved index and removed files are dropped.
+
+            Parameters:
+            - **single_file (bool)**: write one container file with a manifest, all chromosome indexes and the layers,
+                                      instead of one file per chromosome, pickled key and file maps and a layers container.
+
+            Returns:
+       
+        '''
+        self.rebuild_trees()
+        container = os.path.join(self.base_path, CONTAINER_NAME)
+        layers = os.path.join(self.base_path, LAYERS_NAME)
+        if single_file:
+            self.to_container(container)
+            if os.path.exists(layers):
+                os.remove(layers)
+        else:
+            for chrm in self.trees.keys():
+                if self.trees.get(chrm) != None:
+                    self.trees[chrm].to_disk(os.path.join(self.base_path,  "quadtree."+ chrm + ".index"))
+            with open(os.path.join(self.base_path, "quadtreeKeys.index"), 'wb') as pickle_file:
+                pickle.dump(list(self.trees.keys()), pickle_file)
+            with open(os.path.join(self.base_path,  "quadtreeFileMaps.index"), 'wb') as pickle_file:
+                pickle.dump(self.file_mapping, pickle_file)
+            self.write_container(layers, {}, {}, {"summaries": self.summaries, "presence": self.presence})
+            # from_disk prefers the container, do not leave an outdated one behind
+            if os.path.exists(container):
+                os.remove(container)
+        # the segments are part of the saved index now
+        for name in self.segment_files:
+            os.remove(os.path.join(self.base_path, name))
+        self.segment_files = []
+        if os.path.exists(os.path.join(self.base_path, LOG_NAME)):
+            os.remove(os.path.join(self.base_path, LOG_NAME))
+
+    def on_disk(self):
+        '''
+        Whether an index is saved in the path of the Quindex.
+
+            Returns:
+            - **on_disk (bool)**: True if a container or per chromosome index was saved.
+        '''
+        return (os.path.exists(os.path.join(self.base_path, CONTAINER_NAME)) or
+                os.path.exists(os.path.join(self.base_path, "quadtreeKeys.index")))
+
+    def compact(self):
+        '''
+        Fold the delta segments of appended files into the index, drop the items of removed files and
+        renumber the file ids. A saved index is rewritten in the format it was saved with.
+
+            Returns:
+       
+        '''
+        if len(self.segments) == 0 and len(self.removed) == 0:
+            return
+        if self.on_disk():
+            self.to_disk(single_file = os.path.exists(os.path.join(self.base_path, CONTAINER_NAME)))
+        else:
+            self.rebuild_trees()
+
+    def rebuild_trees(self):
+        '''
+        Rebuild the chromosome indexes in memory with the items of the delta segments, without the
+        items of removed files. The remaining files are renumbered in order.
+
+            Returns:
+       
+        '''
+        if len(self.segments) == 0 and len(self.removed) == 0:
+            return
+        # new id of every file, -1 for removed files
+        remap = np.full(len(self.file_mapping), -1, dtype=np.int64)
+        kept = [fileid for fileid in range(len(self.file_mapping)) if fileid not in self.removed]
+        remap[kept] = np.arange(len(kept))
+        chroms = list(self.trees)
+        for segment in self.segments:
+            chroms += [chrm for chrm in segment if chrm not in chroms]
+        trees = {}
+        for chrm in chroms:
+            parts = [t.all_items() for t in [self.trees.get(chrm)] + [s.get(chrm) for s in self.segments] if t is not None]
+            items = np.concatenate(parts)
+            items = items[remap[items['fileid']] != -1]
+            items['fileid'] = remap[items['fileid']]
+            trees[chrm] = self.new_tree(chrm)
+            if self.engine == "quadtree":
+                trees[chrm].insert_many(items, items['rect'])
+            else:
+                trees[chrm].insert_many(items)
+        # release the maps of the old indexes, their files may be replaced next
+        for tree in list(self.trees.values()) + [tree for segment in self.segments for tree in segment.values()]:
+            if tree is not None:
+                tree.close()
+        self.trees = trees
+        self.segments = []
+        # merge the layer tables of the segments, the tables of later parts take precedence
+        num_files = len(self.file_mapping)
+        summaries, presence = {}, {}
+        for first, layer in self._layer_parts("summaries"):
+            for chrm, tables in layer.items():
+                for resolution, table in tables.items():
+                    merged = summaries.setdefault(chrm, {}).setdefault(resolution, empty_tiles((num_files, table.shape[1])))
+                    merged[first:first + len(table)] = table[:num_files - first]
+        for first, layer in self._layer_parts("presence"):
+            for chrm, tables in layer.items():
+                for tile, runs in tables.items():
+                    num_tiles = max(-(-self.genome[chrm] // tile), 1)
+                    merged = presence.setdefault(chrm, {}).setdefault(tile, np.zeros((num_tiles, num_files), dtype=bool))
+                    bits = np.unpackbits(_decode_runs(runs, num_tiles), axis=1, bitorder='little')[:, :num_files - first]
+                    merged[:, first:first + bits.shape[1]] |= bits.astype(bool)
+        self.summaries = {chrm: {resolution: table[kept] for resolution, table in tables.items()} for chrm, tables in summaries.items()}
+        self.presence = {chrm: {tile: _encode_runs(np.packbits(bits[:, kept], axis=1, bitorder='little')) for tile, bits in tables.items()}
+                         for chrm, tables in presence.items()}
+        self.segment_layers = []
+        self.file_mapping = [self.file_mapping[fileid] for fileid in kept]
+        self.file_counter = len(self.file_mapping)
+        self.removed = set()
+
+    def to_container(self, path):
+        '''
+        Write the index to a single container file, see write_container.
 
             Parameters:
+            - **path (str)**: path of the container file.
+
+            Returns:
+       
+        '''
+        self.write_container(path, self.trees, {"genome": self.genome, "file_mapping": self.file_mapping},
+                             {"summaries": self.summaries, "presence": self.presence})
+        self.read_container(path, load = False, trees = self.trees)
+
+    def write_container(self, path, trees, meta, layers = None):
+        '''
+        Write chromosome indexes to a container file. The chromosome indexes are page aligned and followed
+        by the tables of the layers and a json manifest, the header at the start of the file locates the manifest.
+
+            Parameters:
+            - **path (str)**: path of the container file.
+            - **trees (dict)**: chromosome indexes.
+            - **meta (dict)**: extra manifest entries, e.g. the genome and file mapping.
+            - **layers (dict)**: tables of each layer of LAYERS, chromosome and resolution or tile size.
+
+            Returns:
+       
+        '''
+        manifest = dict(meta, version = CONTAINER_VERSION, engine = self.engine, trees = {}, layers = {})
+        # the file is written next to the target and then replaced, so open maps of the old file stay valid
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb', buffering = WRITE_BUFFER) as f:
+            f.write(bytes(PAGE_SIZE))
+            position = PAGE_SIZE
+            for chrm, tree in trees.items():
+                if tree is None:
+                    continue
+                length = tree.write(f)
+                manifest["trees"][chrm] = {"offset": position, "length": length}
+                position += length
+                padding = (PAGE_SIZE - position % PAGE_SIZE) % PAGE_SIZE
+                f.write(bytes(padding))
+                position += padding
+            for name in LAYERS:
+                for chrm, tables in (layers or {}).get(name, {}).items():
+                    for key, table in tables.items():
+                        table = np.ascontiguousarray(table)
+                        f.write(table.tobytes())
+                        manifest["layers"].setdefault(name, {}).setdefault(chrm, {})[str(key)] = {
+                            "offset": position, "shape": list(table.shape), "dtype": np.lib.format.dtype_to_descr(table.dtype)}
+                        position += table.nbytes
+                        padding = (8 - position % 8) % 8
+                        f.write(bytes(padding))
+                        position += padding
+            data = json.dumps(manifest).encode("utf-8")
+            f.write(data)
+            f.seek(0)
+            f.write(struct.pack('qqqq', CONTAINER_MAGIC, CONTAINER_VERSION, position, len(data)))
+        os.replace(tmp_path, path)
+        if self.node_cache is not None:
+            self.node_cache.discard(lambda key: key[0].startswith(path + "#"))
+
+    def write_log(self):
+        '''
+        Write the log listing the delta segments of appended files and the ids of removed files.
 
             Returns:
        
         '''
-        for chrm in self.trees.keys():
-            if self.trees.get(chrm) != None:
-                self.trees[chrm].to_disk(os.path.join(self.base_path,  "quadtree."+ chrm + ".index"))
-        with open(os.path.join(self.base_path, "quadtreeKeys.index"), 'wb') as pickle_file:
-            pickle.dump(list(self.trees.keys()), pickle_file)
-        with open(os.path.join(self.base_path,  "quadtreeFileMaps.index"), 'wb') as pickle_file:
-            pickle.dump(self.file_mapping, pickle_file)
+        path = os.path.join(self.base_path, LOG_NAME)
+        with open(path + ".tmp", 'w') as f:
+            json.dump({"version": CONTAINER_VERSION, "segments": self.segment_files, "removed": sorted(self.removed)}, f)
+        os.replace(path + ".tmp", path)
 
-    def from_disk(self, load = True):
+    def from_disk(self, load = True, lazy = False, max_resident_depth = None, max_resident_nodes = None):
         '''
         load the current index to the path that is stored when creating the Quindex object.
 
             Parameters:
             - **load (bool)**: a boolean indicating whether the Index backbone is newly created. By default this should be true.
+            - **lazy (bool)**: with load, only read the root of each quadtree, the other nodes are loaded the first time a query visits them.
+            - **max_resident_depth (int)**: with lazy, the deepest level of quadtree nodes kept in memory.
+            - **max_resident_nodes (int)**: with lazy, the maximum number of quadtree nodes kept in memory per chromosome.
+                                            Parts of a tree beyond these limits are searched in the file.
 
             Returns:
        
         '''
-        with open(os.path.join(self.base_path, "quadtreeKeys.index"), 'rb') as pickle_file:
-            keys = pickle.load(pickle_file)
-        with open(os.path.join(self.base_path,  "quadtreeFileMaps.index"), 'rb') as pickle_file:
-            self.file_mapping = pickle.load(pickle_file)
-        for chrm in keys:
-            path = os.path.join(self.base_path,  "quadtree."+ chrm + ".index")
-            # this check might not be necessary
-            if os.path.exists(path):
-                # print(path, load)
-                self.trees[chrm] = Index(disk = path, first_run = load)
+        options = {"lazy": lazy, "max_resident_depth": max_resident_depth, "max_resident_nodes": max_resident_nodes}
+        container = os.path.join(self.base_path, CONTAINER_NAME)
+        if os.path.exists(container):
+            manifest, self.trees, layers = self.read_container(container, load, **options)
+            self.genome = manifest["genome"]
+            self.file_mapping = manifest["file_mapping"]
+        else:
+            with open(os.path.join(self.base_path, "quadtreeKeys.index"), 'rb') as pickle_file:
+                keys = pickle.load(pickle_file)
+            with open(os.path.join(self.base_path,  "quadtreeFileMaps.index"), 'rb') as pickle_file:
+                self.file_mapping = pickle.load(pickle_file)
+            for chrm in keys:
+                path = os.path.join(self.base_path,  "quadtree."+ chrm + ".index")
+                # this check might not be necessary
+                if os.path.exists(path):
+                    self.trees[chrm] = self.load_tree(path, load, **options)
+            layers = os.path.join(self.base_path, LAYERS_NAME)
+            layers = self.read_container(layers, load = False)[2] if os.path.exists(layers) else {name: {} for name in LAYERS}
+
+        # delta segments of appended files
+        self.segments = []
+        self.segment_layers = []
+        self.segment_files = []
+        self.removed = set()
+        log = os.path.join(self.base_path, LOG_NAME)
+        if os.path.exists(log):
+            with open(log) as f:
+                log = json.load(f)
+            self.segment_files = log["segments"]
+            self.removed = set(log.get("removed", []))
+        for name in self.segment_files:
+            manifest, trees, segment_layers = self.read_container(os.path.join(self.base_path, name), load, **options)
+            self.file_mapping = self.file_mapping[:manifest["first_fileid"]] + manifest["file_mapping"]
+            self.segments.append(trees)
+            self.segment_layers.append(dict(segment_layers, first_fileid = manifest["first_fileid"]))
+        self.file_counter = len(self.file_mapping)
+        self.read_layers(layers)
+
+    def read_container(self, path, load = True, trees = None, **options):
+        '''
+        Open a container file written by write_container. The file is mapped once and every
+        chromosome index uses its part of the map.
 
-    def fetch_entries(self, file_name, df, chrm, start, end, zoomlvl):
+            Parameters:
+            - **path (str)**: path of the container file.
+            - **load (bool)**: whether to load the indexes to memory.
+            - **trees (dict)**: indexes already in memory, they are kept and only pointed to the container.
+            - **options**: lazy loading options of a quadtree index, see from_disk.
+
+            Returns:
+            - **manifest (dict)**: manifest of the container.
+            - **trees (dict)**: chromosome indexes of the container.
+            - **layers (dict)**: read only maps of the tables of each layer of LAYERS, chromosome and resolution or tile size.
+        '''
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, manifest_offset, manifest_length) = struct.unpack_from('qqqq', buffer, 0)
+        if magic != CONTAINER_MAGIC:
+            raise Exception("File magic mismatch")
+        if version > CONTAINER_VERSION:
+            raise Exception("unsupported index version " + str(version))
+        manifest = json.loads(bytes(buffer[manifest_offset:manifest_offset + manifest_length]).decode("utf-8"))
+        self.engine = manifest["engine"]
+        trees = {} if trees is None else trees
+        view = memoryview(buffer)
+        for chrm, entry in manifest["trees"].items():
+            start, length = entry["offset"], entry["length"]
+            tree = trees.get(chrm)
+            if tree is None:
+                if self.engine == "interval":
+                    tree = IntervalIndex()
+                else:
+                    tree = Index(disk = path, cache = self.node_cache)
+            if isinstance(tree, IntervalIndex):
+                tree.attach(view[start:start + length], path + "#" + chrm, (path, start, length), load = load)
+            else:
+                tree.attach(view[start:start + length], path + "#" + chrm, (path, start, length), load = load, **options)
+            trees[chrm] = tree
+        layers = {name: {} for name in LAYERS}
+        for name, chroms in manifest.get("layers", {}).items():
+            for chrm, tables in chroms.items():
+                for key, entry in tables.items():
+                    dtype = np.lib.format.descr_to_dtype(entry["dtype"])
+                    table = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(entry["shape"])), offset=entry["offset"])
+                    layers[name].setdefault(chrm, {})[int(key)] = table.reshape(entry["shape"])
+        return manifest, trees, layers
+
+    def load_tree(self, path, load = True, **options):
+        '''
+        Open a precomputed chromosome index, the engine is detected from the file magic.
+
+            Parameters:
+            - **path (str)**: path to the chromosome index.
+            - **load (bool)**: whether to load the index to memory.
+            - **options**: lazy loading options of a quadtree index, see from_disk.
+
+            Returns:
+            - **tree (Index or IntervalIndex)**: index of the chromosome.
         '''
-        Fetch entries from a file.
+        with open(path, 'rb') as f:
+            (magic,) = struct.unpack('q', f.read(8))
+        if magic == INTERVAL_MAGIC:
+            self.engine = "interval"
+            return IntervalIndex(disk = path, first_run = load)
+        self.engine = "quadtree"
+        return Index(disk = path, first_run = load, cache = self.node_cache, **options)
+
+    def memory_usage(self):
+        '''
+        Report the memory used by the in-memory index of each chromosome.
+
+            Parameters:
+
+            Returns:
+                usage (Data Frame): Data Frame with the number of tree nodes, the number of indexed items, the bytes held by the item arrays and the total bytes of each chromosome tree.
+        '''
+        usage = []
+        for chrm, tree in self.trees.items():
+            usage.append(dict(chr = chrm, **tree.memory_usage()))
+        return pandas.DataFrame(usage, columns = ["chr", "nodes", "items", "item_bytes", "bytes"])
+
+    def cache_stats(self):
+        '''
+        Report the usage of the node cache shared by the file based queries.
+
+            Parameters:
+
+            Returns:
+                stats (dict): number of cached nodes, bytes used, byte budget, hits, misses and evictions. Empty if the cache is disabled.
+        '''
+        if self.node_cache is None:
+            return {}
+        return self.node_cache.stats()
+
+    def block_cache_stats(self):
+        '''
+        Report the usage of the cache of decoded data blocks shared by the queries.
+
+            Parameters:
+
+            Returns:
+                stats (dict): number of cached blocks, bytes used, byte budget, hits, misses and evictions. Empty if the cache is disabled.
+        '''
+        if self.block_cache is None:
+            return {}
+        return self.block_cache.stats()
+
+    def fetch_arrays(self, file_name, df, chrm, start, end, zoomlvl):
+        '''
+        Fetch entries from a file as numpy columns.
+        Decoded blocks are taken from the block cache. The other matched data blocks are sorted by offset, blocks
+        that are at most read_gap bytes apart are fetched with one read, and each block is then decompressed and
+        decoded out of the combined buffer.
 
             Parameters:
             - **fileid (int)**: id of the file stored in Quindex.
@@ -273,85 +1285,377 @@ class EpivizQuindex(object):
             - **zoomlvl (int)**: zoom lvl of the query range.
 
             Returns:
-                result (Data Frame): Data Frame containing the fetched entries sorte by start location.
-       
+                arrays (list): chromosome id, start, end and score arrays of the fetched entries, in the order of the blocks.
+                columns (list): column names of the arrays.
         '''
 
         df_search = df[df["file_name"] == file_name]
-        if self.file_objects.get(file_name) != None:
-            bw = self.file_objects[file_name]
-        else:
-            bw = BigWig(file_name)
-            # bw.getHeader()
-            # bw.getId("chr2")
-            self.file_objects[file_name] = bw
-        chrmId = bw.getId(chrm)
+        offsets = df_search["offset"].values.astype(np.int64)
+        sizes = df_search["size"].values.astype(np.int64)
+        cache = self.block_cache
+        blocks = [None] * len(offsets)
+        missing = []
+        for i, offset in enumerate(offsets.tolist()):
+            if cache is not None:
+                blocks[i] = cache.get((file_name, zoomlvl, offset))
+            if blocks[i] is None:
+                missing.append(i)
+        missing = np.array(missing, dtype=np.int64)
+        reads = []
+        with self.file_objects.handle(file_name) as bw:
+            chrmId = bw.getId(chrm)
+            for read_offset, read_size, members in _coalesce(offsets[missing], sizes[missing], self.read_gap):
+                reads.append((read_offset, bw.get_bytes(read_offset, read_size), members))
+            endian, compressed, columns = bw.endian, bw.compressed, bw.columns
+        for read_offset, data, members in reads:
+            for i in missing[members].tolist():
+                block = data[offsets[i] - read_offset:offsets[i] - read_offset + sizes[i]]
+                # contiguous copies, the cached block does not hold on to the decompressed data
+                blocks[i] = tuple(np.ascontiguousarray(column) for column in
+                                  _decode_block(zlib.decompress(block) if compressed else block, zoomlvl, endian))
+                if cache is not None:
+                    cache.put((file_name, zoomlvl, int(offsets[i])), blocks[i], BLOCK_BYTES + sum(column.nbytes for column in blocks[i]))
+
+        result = [[np.empty(0, dtype=np.int64)] * 3 + [np.empty(0, dtype=np.float64)]]
+        for chroms, starts, ends, values in blocks:
+            keep = (ends >= start) & (starts <= end) & (chroms == chrmId)
+            result.append([chroms[keep], starts[keep], ends[keep], values[keep]])
+        arrays = [np.concatenate(column).astype(dtype) for column, dtype in zip(zip(*result), [np.int64] * 3 + [np.float64])]
+        return arrays, columns
+
+    def _open_file(self, file_name):
+        '''
+        Open a bigwig file for the file object pool. The header of a file that was opened before is not read again.
+        '''
+        state = self.file_headers.get(file_name)
+        if state is None:
+            return BigWig(file_name)
+        bw = BigWig.__new__(BigWig)
+        super(BigWig, bw).__init__(file_name)
+        bw.__dict__.update(state)
+        bw.tree = {}
+        bw.cacheData = {}
+        bw.sync = False
+        return bw
+
+    def _close_file(self, file_name, bw):
+        '''
+        Close a bigwig file evicted from the file object pool, keeping its parsed header and chromosome map.
+        '''
+        state = {name: getattr(bw, name) for name in HEADER_FIELDS if hasattr(bw, name)}
+        self.file_headers.put(file_name, state, 1024 + len(state.get("zoomBin", b"")) + len(state.get("chromTreeBin", b"")))
+        conn = getattr(bw, "conn", None)
+        if conn is not None and hasattr(conn, "close"):
+            conn.close()
+        bw.cacheData = {}
 
-        result = []
-        for i, row in df_search.iterrows():
-            result += bw.parseLeafDataNode(chrmId, start, end, zoomlvl, chrmId, row["start"], chrmId, row["end"], row["offset"], row["size"])
+    def fetch_entries(self, file_name, df, chrm, start, end, zoomlvl):
+        '''
+        Fetch entries from a file, see fetch_arrays.
+
+            Parameters:
+            - **fileid (int)**: id of the file stored in Quindex.
+            - **df (DataFrame)**: Data Frame contains results from Quindex query.
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the query range.
+            - **end (int)**: end location of the query range.
+            - **zoomlvl (int)**: zoom lvl of the query range.
+
+            Returns:
+                result (list): the fetched entries as (chromosome id, start, end, score) tuples.
+                columns (list): column names of the entries.
+        '''
+        arrays, columns = self.fetch_arrays(file_name, df, chrm, start, end, zoomlvl)
 
         # result = toDataFrame(result, bw.columns)
         # result["chr"] = chrm
         # result = result.sort_values(by = ['start'])
 
-        return result, bw.columns
+        return list(zip(*[array.tolist() for array in arrays])), columns
+
+    def fetch_many(self, requests, workers = None):
+        '''
+        Fetch the entries of many (file, range) requests as numpy columns, the files are read concurrently by a thread pool.
+        The requests of one file are fetched in order by the same thread, as a file object is not shared between threads.
+
+            Parameters:
+            - **requests (list)**: (file_name, df, chrm, start, end, zoomlvl) arguments of fetch_arrays.
+            - **workers (int)**: number of threads, defaults to fetch_workers.
+
+            Returns:
+                results (list): (arrays, columns) of each request, in the order of the requests.
+        '''
+        workers = self.fetch_workers if workers is None else workers
+        by_file = {}
+        for i, request in enumerate(requests):
+            by_file.setdefault(request[0], []).append(i)
+
+        def fetch_file(positions):
+            return [self.fetch_arrays(*requests[i]) for i in positions]
+
+        if workers is None or workers <= 1 or len(by_file) <= 1:
+            fetched = [fetch_file(positions) for positions in by_file.values()]
+        else:
+            with ThreadPoolExecutor(max_workers = min(workers, len(by_file))) as pool:
+                fetched = list(pool.map(fetch_file, by_file.values()))
+        results = [None] * len(requests)
+        for positions, file_results in zip(by_file.values(), fetched):
+            for i, result in zip(positions, file_results):
+                results[i] = result
+        return results
+
+    def get_records(self, chrm, start, end, zoomlvl = -2, in_memory = True, debug = False, max_boxes = None, file_names = None):
+        '''
+        Search the index for the blocks overlapping a range.
+        The range is searched as the union of at most max_boxes hilbert space boxes, the candidate items
+        returned by the trees are then filtered by their range. The counts are kept in last_query_stats.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the query range.
+            - **end (int)**: end location of the query range.
+            - **zoomlvl (int)**: -2 searches the base level blocks, any other value the zoom level blocks of all
+                                 reduction levels, listed with their reduction level. See query for the selection of a zoom level.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **debug (bool)**: When true, the results also include the bounding box of each entry.
+            - **max_boxes (int)**: maximum number of query boxes, defaults to max_query_boxes.
+            - **file_names (list)**: paths to the files whose blocks are returned, all files by default.
+                                     The trees skip the subtrees without blocks of these files.
 
-    def get_records(self, chrm, start, end, zoomlvl = -2, in_memory = True, debug = False):
+            Returns:
+                result (Data Frame): Data Frame with the start, end, offset, size and file name (and reduction) of the matching blocks.
+        '''
         chromLength = self.genome[chrm]
         dims = 2
         hlevel = math.ceil(math.log2(chromLength)/dims)
         # print("hlevel", hlevel)
         x_y_dim = math.ceil(math.pow(2, hlevel))
         # print("max x|y =", x_y_dim)
-        # if in_memory:
-        tree = self.trees[chrm]
-        # else:
-        #     tree = Index(bbox=(0, 0, x_y_dim, x_y_dim), disk = self.base_path + "quadtree." + chrm + ".index", first_run = True)
-
-        xstart, ystart, _ = hcoords(start, chromLength)
-        xend, yend, _ = hcoords(end, chromLength)
-        overlapbbox = range2bbox(hlevel, {"start":start, "end":end}, margin = 0)
-        # overlapbbox = (xstart - 1, ystart - 1, end + 1, end + 1)
-        # t = time.time()
-        matches = tree.intersect(overlapbbox, in_memory = in_memory, debug = debug)
-        # print("tree times: ", time.time() - t)
-        df = pandas.DataFrame(matches, columns=["start", "end", "offset", "size", "fileid"]) if not debug else pandas.DataFrame(matches, columns=["start", "end", "offset", "size", "fileid", 'r1', 'r2', 'r3', 'r4'])
+        max_boxes = self.max_query_boxes if max_boxes is None else max_boxes
+        key, columns = (chrm, ITEM_FIELDS) if zoomlvl == -2 else (chrm + ZOOM_SUFFIX, ZOOM_FIELDS)
+        # the index of the chromosome and those of the delta segments of appended files
+        trees = [self.trees.get(key)] + [segment.get(key) for segment in self.segments]
+        exclude = sorted(self.removed) if len(self.removed) != 0 else None
+        fileids = self._search_ids(file_names)
+        matches = []
+        overlapbbox = None
+        for tree in trees:
+            if tree is None:
+                continue
+            if isinstance(tree, IntervalIndex):
+                # intervals are searched directly, there is no bounding box to report in debug mode
+                matches += tree.intersect((start, end), in_memory = in_memory, exclude = exclude, fileids = fileids)
+                debug = False
+            else:
+                if overlapbbox is None:
+                    if max_boxes > 1:
+                        overlapbbox = range2boxes(hlevel, start, end, max_boxes = max_boxes)
+                    else:
+                        overlapbbox = np.array([range2bbox(hlevel, {"start":start, "end":end}, margin = 0)])
+                matches += tree.intersect(overlapbbox, in_memory = in_memory, debug = debug, exclude = exclude, fileids = fileids)
+        df = pandas.DataFrame(matches, columns=columns) if not debug else pandas.DataFrame(matches, columns=columns + ['r1', 'r2', 'r3', 'r4'])
         df = df.loc[df['start'] <= end]
         df = df.loc[df['end'] >= start]
-        df = df.replace({"fileid": {v: k for v, k in enumerate(self.file_mapping)}}).rename(columns={"fileid": "file_name"})
+        if len(df) != 0:
+            df["fileid"] = np.array(self.file_mapping, dtype = object)[df["fileid"].values.astype(np.int64)]
+        df = df.rename(columns={"fileid": "file_name"})
+        self.last_query_stats = {"boxes": 0 if overlapbbox is None else len(overlapbbox), "candidates": len(matches),
+                                 "results": len(df), "ratio": len(matches) / max(len(df), 1)}
 
         return df
 
 
+    def _regions(self, regions):
+        '''
+        Normalize the regions of a batch query.
+
+            Parameters:
+            - **regions (list or Data Frame)**: (chr, start, end) tuples, or a Data Frame with chr, start and end columns
+                                                and a unique index.
+
+            Returns:
+                regions (Data Frame): Data Frame with the region id (position in the list, or index of the Data Frame), chr, start and end of each region.
+        '''
+        if isinstance(regions, pandas.DataFrame):
+            if not regions.index.is_unique:
+                raise Exception("the index of the regions Data Frame is used as region id, it must be unique")
+            ids = regions.index.values
+            regions = regions[["chr", "start", "end"]].values.tolist()
+        else:
+            regions = [tuple(region) for region in regions]
+            ids = np.arange(len(regions))
+        frame = pandas.DataFrame(regions, columns = ["chr", "start", "end"])
+        frame.insert(0, "region", ids)
+        return frame
+
+    def get_records_many(self, regions, zoomlvl = -2, in_memory = True, max_boxes = None, file_names = None):
+        '''
+        Search the index for the blocks overlapping many regions at once.
+        The regions are grouped by chromosome and each chromosome tree is searched once with the query boxes
+        of all its regions, the candidate blocks are then matched to the regions they overlap.
+
+            Parameters:
+            - **regions (list or Data Frame)**: (chr, start, end) tuples, or a Data Frame with chr, start and end columns.
+            - **zoomlvl (int)**: -2 searches the base level blocks, any other value the zoom level blocks, see get_records.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **max_boxes (int)**: maximum number of query boxes per region, defaults to max_query_boxes.
+            - **file_names (list)**: paths to the files whose blocks are returned, all files by default, see get_records.
+
+            Returns:
+                result (Data Frame): Data Frame with the region id, chr, start, end, offset, size and file name of the
+                                     matching blocks. A block overlapping several regions is listed once per region.
+        '''
+        regions = self._regions(regions)
+        max_boxes = self.max_query_boxes if max_boxes is None else max_boxes
+        exclude = sorted(self.removed) if len(self.removed) != 0 else None
+        fileids = self._search_ids(file_names)
+        names = np.array(self.file_mapping, dtype = object)
+        columns = ITEM_FIELDS if zoomlvl == -2 else ZOOM_FIELDS
+        suffix = "" if zoomlvl == -2 else ZOOM_SUFFIX
+        frames = []
+        stats = {"boxes": 0, "candidates": 0, "results": 0}
+        for chrm, group in regions.groupby("chr", sort = False):
+            hlevel = math.ceil(math.log2(self.genome[chrm])/2)
+            starts = group["start"].values.astype(np.int64)
+            ends = group["end"].values.astype(np.int64)
+            trees = [self.trees.get(chrm + suffix)] + [segment.get(chrm + suffix) for segment in self.segments]
+            boxes = None
+            matches = []
+            for tree in trees:
+                if tree is None:
+                    continue
+                if isinstance(tree, IntervalIndex):
+                    # intervals are searched directly, once per region
+                    matches += list(dict.fromkeys(item for start, end in zip(starts.tolist(), ends.tolist())
+                                                  for item in tree.intersect((start, end), in_memory = in_memory, exclude = exclude, fileids = fileids)))
+                    continue
+                if boxes is None:
+                    if max_boxes > 1:
+                        boxes = [box for start, end in zip(starts.tolist(), ends.tolist())
+                                 for box in range2boxes(hlevel, start, end, max_boxes = max_boxes).tolist()]
+                    else:
+                        boxes = range2bbox_many(hlevel, starts, ends).tolist()
+                    stats["boxes"] += len(boxes)
+                matches += tree.intersect(boxes, in_memory = in_memory, exclude = exclude, fileids = fileids)
+            stats["candidates"] += len(matches)
+            items = np.array(matches, dtype = np.int64).reshape(-1, len(columns))
+            rows, region_rows = _overlap_pairs(items[:, 0], items[:, 1], starts, ends)
+            frame = pandas.DataFrame(items[rows], columns = columns)
+            frame.insert(0, "chr", chrm)
+            frame.insert(0, "region", group["region"].values[region_rows])
+            frames.append(frame)
+        df = pandas.concat(frames, ignore_index = True) if len(frames) != 0 else pandas.DataFrame(columns = ["region", "chr"] + columns)
+        df = df.sort_values(by = ["region"], kind = "stable", ignore_index = True)
+        df["fileid"] = names[df["fileid"].values.astype(np.int64)]
+        df = df.rename(columns = {"fileid": "file_name"})
+        stats["results"] = len(df)
+        stats["ratio"] = stats["candidates"] / max(len(df), 1)
+        self.last_query_stats = stats
+        return df
+
     def has_data(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None):
-        records = self.get_records(chrm, start, end, zoomlvl, in_memory).drop(columns=['offset', 'size'])
-        if file_names is not None:
-            return records.loc[records['file_name'].isin(file_names)]
-        return records
+        return self.get_records(chrm, start, end, zoomlvl, in_memory, file_names = file_names).drop(columns=['offset', 'size'])
+
+    def has_data_many(self, regions, zoomlvl = -2, in_memory = True, file_names = None):
+        '''
+        Batch version of has_data, see get_records_many.
+
+            Returns:
+                result (Data Frame): Data Frame with the region id, chr, start, end and file name of the matching blocks.
+        '''
+        return self.get_records_many(regions, zoomlvl, in_memory, file_names = file_names).drop(columns=['offset', 'size'])
 
     def hit(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None):
-        records = self.get_records(chrm, start, end, in_memory=in_memory).drop(columns=['offset', 'size'])
-        file_names = self.file_mapping if file_names == None else file_names
-        result = [len(records.loc[records['file_name'] == f]) > 0 for f in file_names]
-        return pandas.DataFrame({'file_name': file_names, 'hit': result})
+        '''
+        Find the files with data in a range.
+        With presence bitmaps, the files present in the tiles inside the range are hits, and only the tiles
+        at the ends of the range are searched in the index for the other files present there.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the range.
+            - **end (int)**: end location of the range.
+            - **zoomlvl (int)**: unused, the base level blocks are searched.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **file_names (list)**: paths to the files, all files by default.
 
-    def query(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None):
+            Returns:
+                result (Data Frame): Data Frame with the file name and whether the file has data in the range.
+        '''
+        file_names = self.active_files() if file_names is None else file_names
+        tile = self.presence_tile
+        # tiles entirely inside the range
+        first, last = -(-start // tile) if tile else 0, (end + 1) // tile - 1 if tile else -1
+        if first > last:
+            found = set(self.get_records(chrm, start, end, in_memory=in_memory, file_names=file_names)['file_name'])
+        else:
+            present = self.present_files(chrm, first * tile, (last + 1) * tile - 1)
+            edges = self.present_files(chrm, start, first * tile - 1) | self.present_files(chrm, (last + 1) * tile, end)
+            for fileid in self.removed:
+                present[fileid] = edges[fileid] = False
+            found = {self.file_mapping[fileid] for fileid in np.flatnonzero(present)}
+            requested = set(file_names)
+            missing = [self.file_mapping[fileid] for fileid in np.flatnonzero(edges & ~present) if self.file_mapping[fileid] in requested]
+            if len(missing) != 0:
+                for lo, hi in [(start, first * tile - 1), ((last + 1) * tile, end)]:
+                    if lo <= hi:
+                        found.update(self.get_records(chrm, lo, hi, in_memory=in_memory, file_names=missing)['file_name'])
+        return pandas.DataFrame({'file_name': file_names, 'hit': [f in found for f in file_names]})
+
+    def select_zoom(self, chrm, start, end, resolution, in_memory = True, file_names = None):
+        '''
+        Search the index for the blocks to read a range at a given resolution. Each file is read at its coarsest
+        zoom level whose reduction level is at most resolution bases, files without such a zoom level
+        in the range are read at the base level.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the query range.
+            - **end (int)**: end location of the query range.
+            - **resolution (float)**: requested number of bases per bin.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **file_names (list)**: paths to the files that are read, all files by default.
+
+            Returns:
+                result (Data Frame): Data Frame with the start, end, offset, size, file name and zoom level of the blocks to read.
+                                     The zoom level is the reduction level of zoom blocks, and -2 for base level blocks.
+        '''
+        records = _coarsest_levels(self.get_records(chrm, start, end, -1, in_memory, file_names = file_names), resolution, ["file_name"])
+        file_names = self.active_files() if file_names is None else file_names
+        found = set(records["file_name"])
+        missing = [name for name in file_names if name not in found]
+        if len(missing) != 0:
+            base = self.get_records(chrm, start, end, -2, in_memory, file_names = missing).assign(zoomlvl = -2)
+            records = pandas.concat([records, base], ignore_index = True)
+        return records
+
+    def query(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None, workers = None, resolution = None, num_bins = None):
         '''
         Query the given range in the Quindex.
+        With zoomlvl -1, each file is read at the coarsest zoom level that meets the resolution or number of bins,
+        see select_zoom. The entries are then the zoom records, with the mean value of the bases they summarize as score.
 
             Parameters:
             - **chrm (str)**: target chromosome.
             - **start (int)**: start location of the query range.
             - **end (int)**: end location of the query range.
-            - **zoomlvl (int)**: zoom lvl of the query range.
+            - **zoomlvl (int)**: -2 reads the base level entries, -1 selects a zoom level per file from resolution or num_bins.
             - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
-            - **file (string)**: path to the file. If this is provided, the query will only return searches related to this file.
+            - **file_names (list)**: paths to the files. If this is provided, the query will only return entries of these files.
+            - **workers (int)**: number of threads fetching the files, defaults to fetch_workers.
+            - **resolution (float)**: requested number of bases per bin, with zoomlvl -1.
+            - **num_bins (int)**: requested number of bins in the range, with zoomlvl -1 when resolution is not given.
 
             Returns:
                 result (Data Frame): Data Frame containing the fetched entries sorte by start location.
        '''
-        records = self.get_records(chrm, start, end, zoomlvl, in_memory)
+        if _zoom_selected(zoomlvl, resolution, num_bins):
+            resolution = (end - start) / num_bins if resolution is None else resolution
+            records = self.select_zoom(chrm, start, end, resolution, in_memory, file_names)
+            levels = dict(zip(records["file_name"], records["zoomlvl"].tolist()))
+        else:
+            records = self.get_records(chrm, start, end, zoomlvl, in_memory, file_names = file_names)
+            levels = {}
 
         # if file_names != None:
         #     entries, columns = self.fetch_entries(file_names, records, chrm, start, end, zoomlvl)
@@ -367,11 +1671,9 @@ class EpivizQuindex(object):
         dfs = []
         partial_result = []
         # t = time.time()
-        for file_name in records.file_name.unique():
-            if (file_names is not None) and not (file_name in file_names):
-                continue
-            entries, columns = self.fetch_entries(file_name, records, chrm, start, end, zoomlvl)
-            partial_result=pandas.DataFrame(entries, columns=columns)
+        requests = [(file_name, records, chrm, start, end, levels.get(file_name, zoomlvl)) for file_name in records.file_name.unique()]
+        for (file_name, *_), (arrays, columns) in zip(requests, self.fetch_many(requests, workers)):
+            partial_result=pandas.DataFrame(dict(zip(columns, arrays)))
             partial_result["file_name"] = file_name
             dfs.append(partial_result)
 
@@ -380,48 +1682,207 @@ class EpivizQuindex(object):
 
         return dfs.sort_values(by = ['file_name', 'start']) if len(dfs) > 0 else dfs
 
-    def plot_helpper(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None, num_bins = 100, show_missing = True):
-        records = self.query(chrm, start, end, in_memory = in_memory, file_names = file_names)
-        show_missing = -1 if show_missing else 0
-        entries = {}
-        bin_size = (end-start)/num_bins
-        file_names = self.file_mapping if file_names == None else file_names
-        for file_name in file_names:
-            entries[file_name] = []
-            e = records.loc[records['file_name'] == file_name]
-            x = start
-            while x < end:
-                # print(x,min(x+bin_size, end))
-                tb = e.loc[e['start'] <= min(x+bin_size, end)]
-                tb = tb.loc[tb['end'] > x]
-                score = 0
-                pointer = x
-                for i, j in tb.iterrows():
-                    next_pointer = min(x+bin_size, j['end'])
-                    width = next_pointer - pointer
-                    pointer = next_pointer
-                    score += width * j['score']
-                # print(x+bin_size - pointer)
-                
-                if score < 0:
-                    print('file ', file_name, ' score ', score, ' position ', position)
-                score += show_missing * (x+bin_size - pointer)
-                entries[file_name].append(score/bin_size)
-                x += bin_size
-        columns = []
+    def _select_zoom_many(self, regions, resolutions, in_memory = True, file_names = None):
+        '''
+        Batch version of select_zoom, the zoom level of each file is selected per region.
+
+            Parameters:
+            - **regions (Data Frame)**: chr, start and end of each region, indexed by region id.
+            - **resolutions (Series)**: requested number of bases per bin of each region, indexed by region id.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **file_names (list)**: paths to the files that are read, all files by default.
+
+            Returns:
+                result (Data Frame): Data Frame with the region id, chr, start, end, offset, size, file name and zoom level
+                                     of the blocks to read, see select_zoom.
+        '''
+        records = self.get_records_many(regions, -1, in_memory, file_names = file_names)
+        records = _coarsest_levels(records, records["region"].map(resolutions), ["region", "file_name"])
+        file_names = self.active_files() if file_names is None else file_names
+        found = pandas.MultiIndex.from_frame(records[["region", "file_name"]])
+        if len(found.unique()) < len(regions) * len(set(file_names)):
+            # the files without a zoom level meeting the resolution of a region are read at the base level
+            base = self.get_records_many(regions, -2, in_memory, file_names = file_names)
+            base = base.loc[~pandas.MultiIndex.from_frame(base[["region", "file_name"]]).isin(found)].assign(zoomlvl = -2)
+            records = pandas.concat([records, base], ignore_index = True).sort_values(by = ["region"], kind = "stable", ignore_index = True)
+        return records
+
+    def query_many(self, regions, zoomlvl = -2, in_memory = True, file_names = None, workers = None, resolution = None, num_bins = None):
+        '''
+        Query many ranges in the Quindex at once, see get_records_many.
+        The blocks shared by several regions are read once, through the block cache of each file.
+        With zoomlvl -1, each file is read at its coarsest zoom level meeting the resolution or number of bins of each region, see query.
+
+            Parameters:
+            - **regions (list or Data Frame)**: (chr, start, end) tuples, or a Data Frame with chr, start and end columns.
+            - **zoomlvl (int)**: -2 reads the base level entries, -1 selects a zoom level per region and file from resolution or num_bins.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **file_names (list)**: paths to the files. If this is provided, the query will only return entries of these files.
+            - **workers (int)**: number of threads fetching the files, defaults to fetch_workers.
+            - **resolution (float)**: requested number of bases per bin, with zoomlvl -1.
+            - **num_bins (int)**: requested number of bins in each region, with zoomlvl -1 when resolution is not given.
+
+            Returns:
+                result (Data Frame): Data Frame containing the fetched entries with their region id, sorted by region, file and start location.
+        '''
+        regions = self._regions(regions).set_index("region")
+        if _zoom_selected(zoomlvl, resolution, num_bins):
+            if resolution is None:
+                resolutions = (regions["end"] - regions["start"]) / num_bins
+            else:
+                resolutions = pandas.Series(resolution, index = regions.index)
+            records = self._select_zoom_many(regions, resolutions, in_memory, file_names)
+        else:
+            records = self.get_records_many(regions, zoomlvl, in_memory, file_names = file_names)
+        requests, request_regions = [], []
+        for region, region_records in records.groupby("region", sort = False):
+            chrm, start, end = regions.loc[region, ["chr", "start", "end"]].tolist()
+            levels = dict(zip(region_records["file_name"], region_records["zoomlvl"].tolist())) if "zoomlvl" in region_records else {}
+            for file_name in region_records.file_name.unique():
+                requests.append((file_name, region_records, chrm, start, end, levels.get(file_name, zoomlvl)))
+                request_regions.append(region)
+        dfs = []
+        for (file_name, _, chrm, *_), region, (arrays, columns) in zip(requests, request_regions, self.fetch_many(requests, workers)):
+            partial_result = pandas.DataFrame(dict(zip(columns, arrays)))
+            partial_result["chr"] = chrm
+            partial_result["file_name"] = file_name
+            partial_result.insert(0, "region", region)
+            dfs.append(partial_result)
+
+        if len(dfs) == 0:
+            return pandas.DataFrame()
+        dfs = pandas.concat(dfs, axis = 0)
+        return dfs.sort_values(by = ['region', 'file_name', 'start'])
+
+    def _search_ids(self, file_names):
+        '''
+        Return the ids of the files whose blocks a search returns, None for all files.
+        '''
+        if file_names is None:
+            return None
+        names = set(file_names)
+        return [fileid for fileid, name in enumerate(self.file_mapping) if name in names and fileid not in self.removed]
+
+    def _file_ids(self, file_names):
+        '''
+        Return the ids of files that are not removed.
+        '''
+        ids = {name: fileid for fileid, name in enumerate(self.file_mapping) if fileid not in self.removed}
+        for name in file_names:
+            if name not in ids:
+                raise Exception("file " + str(name) + " is not indexed")
+        return np.array([ids[name] for name in file_names], dtype=np.int64)
+
+    def _summary_resolutions(self):
+        '''
+        Return the resolutions of the summary layer, from the finest to the coarsest.
+        '''
+        if not any(len(layer) != 0 for _, layer in self._layer_parts("summaries")):
+            raise Exception("the index has no summary layer, set summary_resolutions when creating it")
+        return self.summary_resolutions
+
+    def _summary_tiles(self, chrm, resolution, file_names):
+        '''
+        Return the summary tiles of files on a chromosome at a resolution, as a (files, tiles) array.
+        '''
+        ids = self._file_ids(file_names)
+        tiles = empty_tiles((len(ids), max(-(-self.genome[chrm] // resolution), 1)))
+        for first, layer in self._layer_parts("summaries"):
+            table = layer.get(chrm, {}).get(resolution)
+            if table is not None:
+                rows = ids - first
+                keep = (rows >= 0) & (rows < len(table))
+                tiles[keep] = table[rows[keep]]
+        return tiles
+
+    def summary(self, chrm, start, end, file_names = None, max_tiles = SUMMARY_TILES):
+        '''
+        Summarize the entries of every file over a range from the summary layer, without reading the files.
+        The range is summed at the finest resolution with at most max_tiles tiles in the range, the sums of
+        the tiles at the ends of the range are counted in proportion to their overlap with it.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the range.
+            - **end (int)**: end location of the range.
+            - **file_names (list)**: paths to the files, all files by default.
+            - **max_tiles (int)**: largest number of tiles summed.
+
+            Returns:
+                result (Data Frame): Data Frame with the count, coverage, sum, squares, mean, min and max of each file,
+                                     see binning.bin_entries.
+        '''
+        file_names = self.active_files() if file_names == None else file_names
+        resolutions = self._summary_resolutions()
+        resolution = next((r for r in resolutions if (end - start) / r <= max_tiles), resolutions[-1])
+        stats = bin_summaries(self._summary_tiles(chrm, resolution, file_names), resolution, start, end, 1, self.genome[chrm])
+        return pandas.DataFrame({name: matrix[:, 0] for name, matrix in stats.items()}, index = file_names)
+
+    def bin_stats(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None, num_bins = 100, summary = False):
+        '''
+        Query a range and aggregate the entries of every file over equal bins, see binning.bin_entries.
+        With summary, the bins are computed from the tiles of the summary layer instead, at the coarsest
+        resolution that is not larger than the bins, see binning.bin_summaries.
+
+            Parameters:
+            - **chrm (str)**: target chromosome.
+            - **start (int)**: start location of the query range.
+            - **end (int)**: end location of the query range.
+            - **zoomlvl (int)**: -2 reads the base level entries, -1 the coarsest zoom level of each file meeting num_bins, see query.
+                                 The zoom levels are not used with summary.
+            - **in_memory (bool)**: Boolean indicating whether the search in performed in memory.
+            - **file_names (list)**: paths to the files, all files by default.
+            - **num_bins (int)**: number of bins.
+            - **summary (bool)**: compute the bins from the summary layer, without reading the files.
+
+            Returns:
+                stats (dict): Data Frames of the count, coverage, sum, squares, mean, min and max of each file (rows)
+                              and bin (columns), the columns are labeled with the end location of the bins.
+        '''
+        file_names = self.active_files() if file_names == None else file_names
+        if summary:
+            resolutions = self._summary_resolutions()
+            resolution = ([r for r in resolutions if r <= (end - start) / num_bins] or resolutions[:1])[-1]
+            stats = bin_summaries(self._summary_tiles(chrm, resolution, file_names), resolution, start, end, num_bins, self.genome[chrm])
+            return self._bin_frames(stats, start, end, num_bins, file_names)
+        records = self.query(chrm, start, end, zoomlvl, in_memory = in_memory, file_names = file_names,
+                             num_bins = num_bins if zoomlvl == -1 else None)
+        if len(records) != 0:
+            records = records.loc[records["file_name"].isin(file_names)]
+            files = pandas.Categorical(records["file_name"], categories = file_names).codes
+            stats = bin_entries(files, records["start"].values, records["end"].values, records["score"].values,
+                                start, end, num_bins, len(file_names))
+        else:
+            stats = bin_entries([], [], [], [], start, end, num_bins, len(file_names))
+        return self._bin_frames(stats, start, end, num_bins, file_names)
+
+    def _bin_frames(self, stats, start, end, num_bins, file_names):
+        '''
+        Label the binned statistics with the files and the end location of the bins.
+        '''
         formatter = ticker.EngFormatter()
-    
-        x = start
-        while x < end:
-            columns.append(formatter.format_eng(int(min(x+bin_size, end))))
-            x += bin_size
-        values = pandas.DataFrame(entries).transpose()
-        values.columns = columns
+        columns = [formatter.format_eng(int(edge)) for edge in bin_edges(start, end, num_bins)[1:]]
+        return {name: pandas.DataFrame(matrix, index = file_names, columns = columns) for name, matrix in stats.items()}
 
-        return values
+    def plot_helpper(self, chrm, start, end, zoomlvl = -2, in_memory = True, file_names = None, num_bins = 100, show_missing = True, summary = False):
+        '''
+        Compute the heatmap values of region_plot: the coverage weighted mean of each file over equal bins,
+        where the uncovered bases of a bin count as -1 with show_missing, and as 0 otherwise.
+        The entries are read at the base level with zoomlvl -2, and at the zoom level of each file meeting num_bins
+        with zoomlvl -1. With summary, the values are computed from the summary layer, see bin_stats.
+
+            Returns:
+                values (Data Frame): Data Frame of the value of each file (rows) and bin (columns).
+        '''
+        stats = self.bin_stats(chrm, start, end, zoomlvl, in_memory, file_names, num_bins, summary)
+        bin_size = (end - start) / num_bins
+        values = stats["sum"]
+        if show_missing:
+            values = values - (bin_size - stats["coverage"])
+        return values / bin_size
 
-    def region_plot(self, chrm, start, end, meta_data = None, column = 'type', zoomlvl = -2, in_memory = True, file_names = None, num_bins = 100, fig_size = (15,10), show_missing=True):
-        values = self.plot_helpper(chrm, start, end, zoomlvl, in_memory, file_names, num_bins, show_missing)
+    def region_plot(self, chrm, start, end, meta_data = None, column = 'type', zoomlvl = -2, in_memory = True, file_names = None, num_bins = 100, fig_size = (15,10), show_missing=True, summary = False):
+        values = self.plot_helpper(chrm, start, end, zoomlvl, in_memory, file_names, num_bins, show_missing, summary)
         if meta_data is not None:
             values = values.join(meta_data[[column]]).groupby(column).mean()
         sns.set(rc={'figure.figsize':fig_size})
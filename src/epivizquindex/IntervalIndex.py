@@ -0,0 +1,313 @@
+## 1D interval index, an alternative engine to the 2D hilbert quadtree
+
+import os
+import sys
+import threading
+from struct import *
+import numpy as np
+
+from epivizquindex.QuadTree import ITEM_FIELDS, WRITE_BUFFER, _map, _release
+
+INTERVAL_MAGIC = 0x45504949
+# version 1 files have no running max of the chunk max ends, it is computed when they are read
+INTERVAL_VERSION = 2
+# number of consecutive items sharing one max end entry
+CHUNK_SIZE = 64
+
+
+class IntervalIndex(object):
+    """
+    Index of 1D intervals, with the same interface as the quadtree Index.
+
+    Items are stored column wise (one int64 row per item field) and sorted by start.
+    Every chunk of CHUNK_SIZE consecutive items keeps the maximum end of its items, and the running
+    max of these (the reach of the chunks up to it), so a search only scans the chunks that can reach the query start:
+    - items with start > end are excluded with a binary search on the starts,
+    - chunks before the first one reaching start are excluded with a binary search on the reach,
+    - the other chunks whose max end < start are skipped.
+    """
+
+    def __init__(self, disk = None, first_run = False, chunk_size = CHUNK_SIZE, fields = None):
+        '''
+        Initialize an empty interval index, or one backed by a precomputed file.
+
+            Parameters:
+            - **disk (str)**: path to the precomputed index.
+            - **first_run (bool)**: Setting it to true loads the precomputed index to memory when the object is created.
+            - **chunk_size (int)**: number of consecutive items sharing one max end entry.
+            - **fields (list)**: names of the item fields, ITEM_FIELDS by default. The first two are the start and end.
+        '''
+        self.fields = list(ITEM_FIELDS if fields is None else fields)
+        self.chunk_size = chunk_size
+        self.columns = np.empty((len(self.fields), 0), dtype=np.int64)
+        self.chunk_max = np.empty(0, dtype=np.int64)
+        self.chunk_reach = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._buffer = None
+        self._mapped = None
+        self._lock = threading.Lock()
+        # (container path, offset, length) of an index stored in a container file
+        self._segment = None
+        self._shared = False
+        self.disk = disk
+        if disk and first_run:
+            self.from_disk(disk)
+
+    def insert(self, item, bbox = None):
+        '''
+        Insert an item into the index.
+
+            Parameters:
+            - **item**: the item fields, e.g. (start, end, offset, size, fileid).
+            - **bbox**: unused, kept for compatibility with the quadtree Index.
+        '''
+        with self._lock:
+            self._pending.append(np.array(item, dtype=np.int64).reshape(-1, 1))
+
+    def insert_many(self, items, bboxes = None):
+        '''
+        Insert many items at once.
+
+            Parameters:
+            - **items**: a (n, number of fields) array with the item fields in order, or a structured array.
+            - **bboxes**: unused, kept for compatibility with the quadtree Index.
+        '''
+        if isinstance(items, np.ndarray) and items.dtype.names is not None:
+            columns = np.array([items[name] for name in self.fields], dtype=np.int64)
+        else:
+            columns = np.asarray(items, dtype=np.int64).reshape(-1, len(self.fields)).T
+        if columns.shape[1] != 0:
+            with self._lock:
+                self._pending.append(columns)
+
+    def _merge(self):
+        '''
+        Merge the pending items into the sorted columns and rebuild the chunk max ends and their running max.
+        The merge holds the lock, so that searches running while items are inserted see the columns
+        and chunk max ends of the same merge.
+
+            Returns:
+            - **columns, chunk_max, chunk_reach, chunk_size**: snapshot of the merged index.
+        '''
+        with self._lock:
+            if len(self._pending) != 0:
+                columns = np.concatenate([self.columns] + self._pending, axis=1)
+                self._pending = []
+                self.columns = np.ascontiguousarray(columns[:, np.argsort(columns[0], kind='stable')])
+                self.chunk_max = self._chunk_max(self.columns[1], self.chunk_size)
+                self.chunk_reach = np.maximum.accumulate(self.chunk_max)
+            return self.columns, self.chunk_max, self.chunk_reach, self.chunk_size
+
+    @staticmethod
+    def _chunk_max(ends, chunk_size):
+        if len(ends) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.maximum.reduceat(ends, np.arange(0, len(ends), chunk_size))
+
+    def _search(self, columns, chunk_max, chunk_reach, chunk_size, start, end):
+        '''
+        Return the indices of the items overlapping [start, end].
+        '''
+        hi = np.searchsorted(columns[0], end, 'right')
+        if hi == 0:
+            return np.empty(0, dtype=np.int64)
+        last = (hi - 1) // chunk_size
+        # the running max of the chunk max ends is sorted, every chunk before `first` ends before start
+        first = np.searchsorted(chunk_reach[:last + 1], start, 'left')
+        chunks = first + np.flatnonzero(chunk_max[first:last + 1] >= start)
+        if len(chunks) == 0:
+            return np.empty(0, dtype=np.int64)
+        idx = (chunks[:, None] * chunk_size + np.arange(chunk_size)).ravel()
+        idx = idx[idx < hi]
+        return idx[columns[1, idx] >= start]
+
+    def intersect(self, query, in_memory = False, debug = False, exclude = None, fileids = None):
+        '''
+        Return all items overlapping the query range (both ends inclusive).
+
+            Parameters:
+            - **query (tuple)**: start and end of the query range.
+            - **in_memory (bool)**: A flag for using in_memory search with respect to file based search.
+            - **debug (bool)**: unused, kept for compatibility with the quadtree Index.
+            - **exclude (list)**: file ids whose items are skipped, e.g. removed files.
+            - **fileids (list)**: file ids whose items are returned, all files by default.
+
+            Returns:
+            - **results (list)**: the matching items as tuples.
+        '''
+        start, end = query
+        if in_memory:
+            columns, chunk_max, chunk_reach, chunk_size = self._merge()
+        else:
+            columns, chunk_max, chunk_reach, chunk_size = self._open()
+        idx = self._search(columns, chunk_max, chunk_reach, chunk_size, start, end)
+        if exclude is not None and len(idx) != 0:
+            idx = idx[~np.isin(columns[self.fields.index("fileid"), idx], exclude)]
+        if fileids is not None and len(idx) != 0:
+            idx = idx[np.isin(columns[self.fields.index("fileid"), idx], list(fileids))]
+        return list(zip(*columns[:, idx].tolist()))
+
+    def _read(self, buffer):
+        '''
+        Parse an index file: header, field names, sorted columns, chunk max ends and their running max.
+
+            Returns:
+            - **columns (ndarray)**: zero copy view of the item columns.
+            - **chunk_max (ndarray)**: zero copy view of the chunk max ends.
+            - **chunk_reach (ndarray)**: zero copy view of the running max of the chunk max ends,
+                                         computed for version 1 files.
+            - **chunk_size (int)**: chunk size used when the index was written.
+        '''
+        (magic, chunk_size, version, _, count, num_chunks, _, _, _, item_size, fields_len) = unpack_from('qiiiqqqqqll', buffer, 0)
+        if magic != INTERVAL_MAGIC:
+            raise Exception("File magic mismatch")
+        if version not in (1, INTERVAL_VERSION):
+            raise Exception("Unsupported index version " + str(version))
+        fields = bytes(buffer[80:80 + fields_len]).decode("utf-8").split(",")
+        offset = (80 + fields_len + 7) // 8 * 8
+        columns = np.frombuffer(buffer, dtype=np.int64, count=len(fields) * count, offset=offset).reshape(len(fields), count)
+        offset += columns.nbytes
+        chunk_max = np.frombuffer(buffer, dtype=np.int64, count=num_chunks, offset=offset)
+        offset += chunk_max.nbytes
+        if version == 1:
+            chunk_reach = np.maximum.accumulate(chunk_max)
+        else:
+            chunk_reach = np.frombuffer(buffer, dtype=np.int64, count=num_chunks, offset=offset)
+        self.fields = fields
+        return columns, chunk_max, chunk_reach, chunk_size
+
+    def _open(self):
+        '''
+        Memory map the index file, once per IntervalIndex.
+
+            Returns:
+            - **columns, chunk_max, chunk_reach, chunk_size**: zero copy views of the mapped file, see _read.
+        '''
+        if self._buffer is None:
+            with self._lock:
+                if self._buffer is None:
+                    buffer = _map(self.disk, self._segment)
+                    self._mapped = self._read(buffer)
+                    self._buffer = buffer
+        return self._mapped
+
+    def attach(self, buffer, disk, segment = None, load = False):
+        '''
+        Use an index that is already mapped, e.g. a chromosome index of a container file.
+        The buffer belongs to the caller and is not closed by the index.
+
+            Parameters:
+            - **buffer (memoryview)**: the index data.
+            - **disk (str)**: name of the index.
+            - **segment (tuple)** (optional): (container path, offset, length) of the index, to map it again after close.
+            - **load (bool)** (optional): load the index to memory.
+        '''
+        self.close()
+        self.disk = disk
+        self._segment = segment
+        mapped = self._read(buffer)
+        with self._lock:
+            self._buffer, self._mapped, self._shared = buffer, mapped, True
+        if load:
+            self._load(buffer)
+
+    def close(self):
+        '''
+        Release the memory map of the index file, if any.
+        '''
+        with self._lock:
+            buffer, self._buffer = self._buffer, None
+            shared, self._shared = self._shared, False
+            self._mapped = None
+        if buffer is not None and not shared:
+            _release(buffer)
+
+    def from_disk(self, f_path):
+        '''
+        Load a precomputed interval index to memory.
+
+            Parameters:
+            - **f_path (str)**: path to the precomputed index.
+        '''
+        self.close()
+        self.disk = f_path
+        self._segment = None
+        with open(f_path, 'rb') as f:
+            self._load(f.read())
+
+    def _load(self, buffer):
+        '''
+        Copy the index data to memory, see from_disk.
+        '''
+        columns, chunk_max, chunk_reach, chunk_size = self._read(buffer)
+        columns, chunk_max, chunk_reach = columns.copy(), chunk_max.copy(), chunk_reach.copy()
+        with self._lock:
+            self.columns, self.chunk_max, self.chunk_reach, self.chunk_size = columns, chunk_max, chunk_reach, chunk_size
+            self._pending = []
+
+    def to_disk(self, path):
+        '''
+        Write the index to disk.
+
+            Parameters:
+            - **path (str)**: path to which the index will be stored at.
+        '''
+        self._merge()
+        self.close()
+        self.disk = path
+        self._segment = None
+        # the file is written next to the target and then replaced, so open maps of the old file stay valid
+        with open(path + ".tmp", 'wb', buffering = WRITE_BUFFER) as f:
+            self.write(f)
+        os.replace(path + ".tmp", path)
+        return self.disk
+
+    def write(self, f):
+        '''
+        Write the index to a binary stream, starting at its current position.
+
+            Parameters:
+            - **f (file)**: binary stream to write to.
+
+            Returns:
+            - **length (int)**: number of bytes written.
+        '''
+        columns, chunk_max, chunk_reach, chunk_size = self._merge()
+        fields = bytes(",".join(self.fields), 'utf-8')
+        padding = (8 - (80 + len(fields)) % 8) % 8
+        f.write(pack('qiiiqqqqqll', INTERVAL_MAGIC, chunk_size, INTERVAL_VERSION, 0, columns.shape[1],
+                     len(chunk_max), 0, 0, 0, 8 * len(self.fields), len(fields)))
+        f.write(fields)
+        f.write(bytes(padding))
+        f.write(columns.tobytes())
+        f.write(chunk_max.tobytes())
+        f.write(chunk_reach.tobytes())
+        return 80 + len(fields) + padding + columns.nbytes + chunk_max.nbytes + chunk_reach.nbytes
+
+    def all_items(self):
+        '''
+        Return every item of the index.
+
+            Returns:
+            - **items (ndarray)**: structured array of the items.
+        '''
+        if self.disk is not None and self.columns.shape[1] == 0 and len(self._pending) == 0:
+            columns = self._open()[0]
+        else:
+            columns = self._merge()[0]
+        items = np.empty(columns.shape[1], dtype=[(name, np.int64) for name in self.fields])
+        for name, column in zip(self.fields, columns):
+            items[name] = column
+        return items
+
+    def memory_usage(self):
+        '''
+        Report the memory held by the in-memory index.
+
+            Returns:
+            - **usage (dict)**: number of nodes (sorted runs), number of items, bytes held by the item arrays and total bytes.
+        '''
+        columns, chunk_max, chunk_reach, _ = self._merge()
+        items = columns.shape[1]
+        item_bytes = columns.nbytes + chunk_max.nbytes + chunk_reach.nbytes
+        return {"nodes": int(items != 0), "items": items, "item_bytes": item_bytes, "bytes": item_bytes + sys.getsizeof(self)}
@@ -1,12 +1,35 @@
 ## heavily modefied quadtree implementation from
 ## https://github.com/karimbahgat/Pyqtree
 
+import os
 import sys
+import mmap
+import threading
+from functools import lru_cache
 from struct import *
-from shapely.geometry import Polygon
+import numpy as np
 
 MAX_ITEMS = 50
 MAX_DEPTH = 30
+# nodes of an index file are packed into blocks of this size
+PAGE_SIZE = 4096
+# buffer size used when writing an index file
+WRITE_BUFFER = 1 << 20
+# approximate size of a decoded node without its items, used to account for it in the node cache
+NODE_BYTES = 256
+# names of the default item fields, in the order they are packed
+ITEM_FIELDS = ["start", "end", "offset", "size", "fileid"]
+# names of the optional item fields following the default ones, e.g. the reduction level of a zoom block
+OPTIONAL_FIELDS = ["reduction"]
+# number of bits of the file id filter of a node, a file id sets the bit fileid % FILE_BITS
+FILE_BITS = 256
+# flags of a node in the index file: leaf node, and file summary (see _file_summary) following the child offsets
+LEAF_FLAG = 1
+FILES_FLAG = 2
+FILES_BYTES = 16 + FILE_BITS // 8
+# format version in the index file header: nodes without file summaries, and nodes that may have one (FILES_FLAG)
+NODE_VERSION = 64
+FILES_VERSION = 65
 # size of each item
 # leaf_size = 48 + 1 + ((Item_numbers) * self.item_size)
 # parent_size = 48 + 1 + 32 + ((Item_numbers) * self.item_size)
@@ -48,7 +71,7 @@ def _loopallchildren(parent):
 
 def box_intersect(box1, box2):
     '''
-    Determin whether the two bounding box intersect.
+    Determin whether the two bounding box intersect. Boxes are closed, so boxes that only share an edge or a corner intersect.
 
         Parameters:
         - **box1 (tuple)**: bottom left, top right coordinate of a bounding box.
@@ -58,10 +81,134 @@ def box_intersect(box1, box2):
         - **box_intersect (bool)**: Whether the two bounding box intersect.
    
     '''
-    p1 = Polygon([(box1[0], box1[1]), (box1[0], box1[3]), (box1[2], box1[3]), (box1[2], box1[1])])
-    p2 = Polygon([(box2[0], box2[1]), (box2[0], box2[3]), (box2[2], box2[3]), (box2[2], box2[1])])
+    return (box1[0] <= box2[2]) and (box2[0] <= box1[2]) and (box1[1] <= box2[3]) and (box2[1] <= box1[3])
 
-    return p1.intersects(p2)
+def box_intersect_many(box, rects):
+    '''
+    Vectorized version of box_intersect, test one bounding box against many.
+
+        Parameters:
+        - **box (tuple)**: bottom left, top right coordinate of a bounding box.
+        - **rects (ndarray)**: (n, 4) array of bottom left, top right coordinates.
+
+        Returns:
+        - **mask (ndarray)**: boolean array, True where the rect intersects the box.
+    '''
+    return (rects[:, 0] <= box[2]) & (rects[:, 2] >= box[0]) & (rects[:, 1] <= box[3]) & (rects[:, 3] >= box[1])
+
+@lru_cache(maxsize=None)
+def _item_dtype(field_str):
+    '''
+    Build the numpy dtype of a packed item (item fields followed by its bounding box) from the struct field string.
+
+        Parameters:
+        - **field_str (str)**: struct format of the item fields, e.g. 'lllll'.
+
+        Returns:
+        - **dtype (numpy.dtype)**: packed dtype matching the on-disk item layout.
+    '''
+    names = ITEM_FIELDS + OPTIONAL_FIELDS
+    names = names + ['f%d' % i for i in range(len(names), len(field_str))]
+    fields = [(name, t) for name, t in zip(names, field_str)]
+    return np.dtype(fields + [('rect', 'd', (4,))])
+
+def _file_summary(fileids):
+    '''
+    Summarize a set of file ids as their min, max and a bit filter of fileid % FILE_BITS.
+    The summary of a node covers the items of its subtree, a search for some files skips the subtrees
+    whose summary cannot contain any of them.
+
+        Parameters:
+        - **fileids (ndarray)**: file ids.
+
+        Returns:
+        - **summary (ndarray)**: uint64 array of the min, the max and the FILE_BITS bits of the filter.
+    '''
+    fileids = np.asarray(fileids, dtype=np.uint64)
+    summary = np.zeros(2 + FILE_BITS // 64, dtype=np.uint64)
+    if len(fileids) == 0:
+        # an empty summary, its min is above its max
+        summary[0] = np.iinfo(np.uint64).max
+        return summary
+    summary[0], summary[1] = fileids.min(), fileids.max()
+    bits = fileids % np.uint64(FILE_BITS)
+    np.bitwise_or.at(summary, 2 + (bits >> np.uint64(6)).astype(np.int64), np.uint64(1) << (bits & np.uint64(63)))
+    return summary
+
+def _merge_summary(summary, other):
+    '''
+    Return the summary of the union of two sets of file ids, None if one of them is unknown.
+    '''
+    if summary is None or other is None:
+        return None
+    merged = summary | other
+    merged[0] = min(summary[0], other[0])
+    merged[1] = max(summary[1], other[1])
+    return merged
+
+def _may_contain(summary, query):
+    '''
+    Determin whether a node may hold items of the queried files, from their summaries.
+    A node without summary, e.g. read from an index written before the summaries, may hold any file.
+    '''
+    if summary is None:
+        return True
+    return summary[0] <= query[1] and summary[1] >= query[0] and bool((summary[2:] & query[2:]).any())
+
+def _append_results(items, results, debug, exclude = None, fileids = None):
+    '''
+    Append matched items to the result list as tuples.
+
+        Parameters:
+        - **items (ndarray)**: structured array of matched items.
+        - **results (list)**: result list.
+        - **debug (bool)**: When true, the results also include the bounding box of each entry.
+        - **exclude (ndarray)**: file ids whose items are skipped, e.g. removed files.
+        - **fileids (tuple)**: file ids whose items are kept and their summary, all files if None.
+    '''
+    if exclude is not None and len(items) != 0:
+        items = items[~np.isin(items['fileid'], exclude)]
+    if fileids is not None and len(items) != 0:
+        items = items[np.isin(items['fileid'], fileids[0])]
+    if len(items) == 0:
+        return
+    fields = list(items.dtype.names[:-1])
+    if debug:
+        results.extend(item + tuple(rect) for item, rect in zip(items[fields].tolist(), items['rect'].tolist()))
+    else:
+        results.extend(items[fields].tolist())
+
+def _map(path, segment = None):
+    '''
+    Memory map an index file read only.
+
+        Parameters:
+        - **path (str)**: path to the index file.
+        - **segment (tuple)** (optional): (container path, offset, length) to map a part of a container file instead.
+
+        Returns:
+        - **buffer (mmap or memoryview)**: the mapped index.
+    '''
+    if segment is not None:
+        path, offset, length = segment
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if segment is not None:
+        buffer = memoryview(buffer)[offset:offset + length]
+    return buffer
+
+def _release(buffer):
+    '''
+    Release a buffer returned by _map.
+    '''
+    try:
+        if isinstance(buffer, memoryview):
+            buffer.release()
+        else:
+            buffer.close()
+    except BufferError:
+        # a concurrent search still holds a view, the map is released once it is collected
+        pass
 
 def box_contains(box1, box2):
     '''
@@ -79,35 +226,47 @@ def box_contains(box1, box2):
     # print(box1, box2)
     return (box1[0] <= box2[0]) and (box1[1] <= box2[1]) and (box1[2] >= box2[2]) and (box1[3] >= box2[3])
 
-
-class _QuadNode(object):
+def _query_clip(rect, box):
     '''
-    Quadtree node object that contains the data and the rectangular bounding box..
+    Return the part of a query that intersects a box, the query is one bounding box or a list of boxes.
 
         Parameters:
-        - **parent (_Quadtree)**: _Quadtree node object
-    '''
-    def __init__(self, item, rect):
-        self.item = item
-        self.rect = rect
+        - **rect (tuple)**: bottom left, top right coordinate of a bounding box, or a list of boxes.
+        - **box (tuple)**: bottom left, top right coordinate of a bounding box.
 
-    def __eq__(self, other):
-        return self.item == other.item and self.rect == other.rect
-
-    def __hash__(self):
-        return hash(self.item)
-
-    def pack_items(self, mappings):
-        b_array = bytes()
-        for i, t in zip(self.item, mappings.values()):
-            f = None
-            if t == int:
-                f = 'l'
-            elif t == float:
-                f = 'd'
-            b_array += pack(f, i)
-        return b_array
+        Returns:
+        - **rect (tuple)**: the query boxes intersecting the box (one box or a list), None if there are none.
+    '''
+    if isinstance(rect, list):
+        rect = [r for r in rect if box_intersect(r, box)]
+        if len(rect) == 0:
+            return None
+        return rect if len(rect) > 1 else rect[0]
+    return rect if box_intersect(rect, box) else None
+
+def _query_contains(rect, box):
+    '''
+    box_contains for a query that is one bounding box, or a list of boxes containing the box if one of them does.
+    '''
+    if isinstance(rect, list):
+        return any(box_contains(r, box) for r in rect)
+    return box_contains(rect, box)
 
+def _query_intersect_many(rect, rects):
+    '''
+    box_intersect_many for a query that is one bounding box, or a list of boxes.
+    '''
+    if isinstance(rect, list):
+        boxes = np.array(rect, dtype='d')
+        # only the items intersecting the bounding box of the query boxes are tested against each box
+        mask = box_intersect_many((boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()), rects)
+        idx = np.flatnonzero(mask)
+        if len(idx) != 0:
+            candidates = rects[idx][:, None, :]
+            mask[idx] = ((candidates[..., 0] <= boxes[:, 2]) & (candidates[..., 2] >= boxes[:, 0]) &
+                         (candidates[..., 1] <= boxes[:, 3]) & (candidates[..., 3] >= boxes[:, 1])).any(axis=1)
+        return mask
+    return box_intersect_many(rect, rects)
 
 
 class _QuadTree(object):
@@ -116,9 +275,15 @@ class _QuadTree(object):
     The index being used behind the scenes. Has all the same methods as the user
     index, but requires more technical arguments when initiating it than the
     user-friendly version.
+
+    Items stored at a node are kept in a structured numpy array (one row per item,
+    item fields followed by the item's bounding box) that grows geometrically;
+    only the first `count` rows are in use.
     """
+    __slots__ = ('items', 'count', 'children', 'isLeaf', 'center', 'width', 'height',
+                 'max_items', 'max_depth', '_depth', 'extra', 'item_size', 'field_str', 'dtype', 'files')
 
-    def __init__(self, x = None, y = None, width = None, height = None, max_items = None, max_depth = None, _depth=0 , path = None, offset = None, extra = [], field_str = None):
+    def __init__(self, x = None, y = None, width = None, height = None, max_items = None, max_depth = None, _depth=0 , buffer = None, offset = None, extra = None, field_str = None):
         '''
         Initialize the current node.
 
@@ -130,27 +295,36 @@ class _QuadTree(object):
             - **max_items (int)**: maximum number of items in a node before splitting.
             - **max_depth (int)**: maximum depth of the index. the index will stop splitting after reaching max depth.
             - **_depth (int)**: depth of the current node.
-            - **path (str)**: path to the precomputed index. If None, node will be computed in memory.
+            - **buffer (mmap)**: memory map of a precomputed index to decode the node from. If None, node will be computed in memory.
             - **offset (int)**: file offset to the node. 
+            - **extra (dict)**: item fields and their types, shared by all nodes of a tree.
+            - **field_str (str)**: struct format of the item fields.
 
        
         '''
-        self.nodes = []
         self.children = []
         self.isLeaf = True
         self.center = (x, y)
-        self.extra = {}
         self.width, self.height = width, height
         self.max_items = max_items
         self.max_depth = max_depth
         self._depth = _depth
-        self.item_size = 4 * 8
-        self.field_str = field_str
-        for function in ["start", "end", "offset", "size", "fileid"]:
-
-            self.add_field(function, int)
-        if path:
-            self._from_disk(path, offset)
+        if extra is None:
+            self.extra = {}
+            self.item_size = 4 * 8
+            for function in ITEM_FIELDS:
+                self.add_field(function, int)
+        else:
+            self.extra = extra
+            self.item_size = 4 * 8 + 8 * len(extra)
+        self.field_str = field_str if field_str is not None else self.get_field_str().decode("utf-8")
+        self.dtype = _item_dtype(self.field_str)
+        self.items = np.empty(0, dtype=self.dtype)
+        self.count = 0
+        # summary of the file ids of the subtree, None when it is not known
+        self.files = _file_summary([]) if 'fileid' in self.dtype.names else None
+        if buffer is not None:
+            self._from_buffer(buffer, offset)
 
     def __iter__(self):
         for child in _loopallchildren(self):
@@ -174,6 +348,12 @@ class _QuadTree(object):
                 exception('type not supported')
         return bytes(field_str, 'utf-8')
 
+    @property
+    def nodes(self):
+        '''
+        The items stored at this node, as a structured array.
+        '''
+        return self.items[:self.count]
 
     def IsParent(self):
         '''
@@ -197,7 +377,68 @@ class _QuadTree(object):
             - **hasData (bool)**: Whether the node contains data.
        
         '''
-        return len(self.nodes) != 0
+        return self.count != 0
+
+    def _new_child(self, x, y, width, height, depth):
+        return _QuadTree(x, y, width, height, self.max_items, self.max_depth, depth,
+                         extra = self.extra, field_str = self.field_str)
+
+    def _append(self, items):
+        '''
+        Append items to this node's array, growing it geometrically.
+
+            Parameters:
+            - **items (ndarray)**: structured array of items.
+
+            Returns:
+       
+        '''
+        n = self.count + len(items)
+        if self.count == 0 and n > len(self.items):
+            self.items = items.copy()
+            self.count = n
+            return
+        if n > len(self.items):
+            grown = np.empty(max(n, 2 * len(self.items), 4), dtype=self.dtype)
+            grown[:self.count] = self.items[:self.count]
+            self.items = grown
+        self.items[self.count:n] = items
+        self.count = n
+
+    def _quadrants(self, rects):
+        '''
+        Find the child quadrant that fully contains each rect.
+
+            Parameters:
+            - **rects (ndarray)**: (n, 4) array of normalized bounding boxes.
+
+            Returns:
+            - **quadrants (ndarray)**: index of the child containing each rect, -1 if none of the children fully contains it.
+       
+        '''
+        x = self.center[0]
+        y = self.center[1]
+        lx = x - self.width/2
+        rx = x + self.width/2
+        ty = y + self.height/2
+        by = y - self.height/2
+        left = (x > rects[:, 2]) & (lx < rects[:, 0])
+        right = (rx > rects[:, 2]) & (x < rects[:, 0])
+        top = (ty > rects[:, 3]) & (y < rects[:, 1])
+        bottom = (y > rects[:, 3]) & (by < rects[:, 1])
+        quadrants = np.full(len(rects), -1, dtype=np.int8)
+        quadrants[right & top] = 0
+        quadrants[left & top] = 1
+        quadrants[left & bottom] = 2
+        quadrants[right & bottom] = 3
+        return quadrants
+
+    def _add_files(self, items):
+        '''
+        Add the file ids of new items of the subtree to the file summary of the node.
+        '''
+        if self.files is not None:
+            self.files = _merge_summary(self.files, _file_summary(items['fileid']))
 
     def _insert(self, item, bbox):
         '''
@@ -211,97 +452,136 @@ class _QuadTree(object):
        
         '''
         rect = _normalize_rect(bbox)
-        if len(self.children) == 0:
-            node = _QuadNode(item, rect)
-            self.nodes.append(node)
-
-            if len(self.nodes) > self.max_items and self._depth < self.max_depth:
-                self.isLeaf = False 
-                self._split()
-        else:
+        row = np.array([tuple(item) + (rect,)], dtype=self.dtype)
+        node = self
+        node._add_files(row)
+        while len(node.children) != 0:
             # calculate left-x, right-x, top-y, bottom-y coordinate of the current
             # node
-            x = self.center[0]
-            y = self.center[1]
-            lx = x - self.width/2
-            rx = x + self.width/2
-            ty = y + self.height/2
-            by = y - self.height/2
+            x = node.center[0]
+            y = node.center[1]
+            lx = x - node.width/2
+            rx = x + node.width/2
+            ty = y + node.height/2
+            by = y - node.height/2
 
             if (x > rect[2] and lx < rect[0] and ty > rect[3] and y < rect[1]):
-                self.children[1]._insert(item, rect)
+                node = node.children[1]
             elif (rx > rect[2] and x < rect[0] and ty > rect[3] and y < rect[1]):
-                self.children[0]._insert(item, rect)
+                node = node.children[0]
             elif (x > rect[2] and lx < rect[0] and y > rect[3] and by < rect[1]):
-                self.children[2]._insert(item, rect)
+                node = node.children[2]
             elif (rx > rect[2] and x < rect[0] and y > rect[3] and by < rect[1]):
-                self.children[3]._insert(item, rect)
+                node = node.children[3]
             else:
             # none of the childrens FULLY contains the node, insert at this level
-                node = _QuadNode(item, rect)
-                self.nodes.append(node)
-
+                break
+            node._add_files(row)
+        node._append(row)
+        if len(node.children) == 0 and node.count > node.max_items and node._depth < node.max_depth:
+            node.isLeaf = False
+            node._split()
+
+    def _insert_many(self, items):
+        '''
+        Insert a structured array of items (with normalized rects) into the index, routing them
+        down the tree one level at a time.
 
+            Parameters:
+            - **items (ndarray)**: structured array of items.
 
-    def _intersect_memory(self, rect, results = None, debug = False, parent_contains = False):
+            Returns:
+       
+        '''
+        self._add_files(items)
+        if len(self.children) == 0:
+            if self.count + len(items) <= self.max_items or self._depth >= self.max_depth:
+                self._append(items)
+                return
+            # the node overflows, turn it into a parent node and route all of its items
+            if self.count != 0:
+                items = np.concatenate([self.items[:self.count], items])
+                self.items = np.empty(0, dtype=self.dtype)
+                self.count = 0
+            self.isLeaf = False
+            self._spawn_children()
+        # group the items by quadrant (-1 first, for the items staying at this node)
+        quadrants = self._quadrants(items['rect'])
+        order = np.argsort(quadrants, kind='stable')
+        items = items[order]
+        bounds = np.searchsorted(quadrants[order], np.arange(-1, 5))
+        if bounds[1] != 0:
+            self._append(items[:bounds[1]])
+        for i, child in enumerate(self.children):
+            if bounds[i + 2] != bounds[i + 1]:
+                child._insert_many(items[bounds[i + 1]:bounds[i + 2]])
+
+    def _intersect_memory(self, rect, results = None, debug = False, parent_contains = False, index = None, exclude = None, fileids = None):
         '''
         Recursively return nodes that intersect with the bounding box in memory. This method requires the index preloaded in memory.
 
             Parameters:
-            - **rect (tuple)**: a tuple that represents the bottom left, top right coorinates of a bounding box.
+            - **rect (tuple)**: a tuple that represents the bottom left, top right coorinates of a bounding box, or a list of boxes.
             - **results (list)**:   recursive result array to store the parsed leaf nodes.     
             - **debug (bool)**: When true, the results also include the bounding box of each entry. 
+            - **index (Index)**: root of a lazily loaded index, used to load the children that are not in memory yet.
+            - **exclude (ndarray)**: file ids whose items are skipped.
+            - **fileids (tuple)**: file ids whose items are kept and their summary, subtrees without them are skipped.
             Returns:
             - **results (list)**:   recursive result array to store the parsed leaf nodes.    
        
         '''
         if results == None:
             results = []
+        if fileids is not None and not _may_contain(self.files, fileids[1]):
+            return results
 
-        contains = parent_contains or box_contains(rect, (self.center[0] - self.width/2, self.center[1] - self.height/2, self.center[0] + self.width/2, self.center[1] + self.height/2))
-        # print(contains)
-
+        contains = parent_contains or _query_contains(rect, (self.center[0] - self.width/2, self.center[1] - self.height/2, self.center[0] + self.width/2, self.center[1] + self.height/2))
 
         if not self.isLeaf:
-            if (self.children[1] != None) and (contains or box_intersect(rect, (self.center[0] - self.width/2, self.center[1], self.center[0], self.center[1] + self.height/2))):
-                self.children[1]._intersect_memory(rect, results, parent_contains = contains, debug = debug)
-            if (self.children[2] != None) and (contains or box_intersect(rect, (self.center[0] - self.width/2, self.center[1] - self.height/2, self.center[0], self.center[1]))):
-                self.children[2]._intersect_memory(rect, results, parent_contains = contains, debug = debug)
-            if (self.children[3] != None) and (contains or box_intersect(rect, (self.center[0], self.center[1] - self.height/2, self.center[0] + self.width/2, self.center[1]))):
-                self.children[3]._intersect_memory(rect, results, parent_contains = contains, debug = debug)
-            if (self.children[0] != None) and (contains or box_intersect(rect, (self.center[0], self.center[1], self.center[0] + self.width/2, self.center[1] + self.height/2))):
-                self.children[0]._intersect_memory(rect, results, parent_contains = contains, debug = debug)
-
-
-        # if not self.isLeaf:
-        #     if self.children[1] and box_intersect(rect, (self.center[0] - self.width/2, self.center[1], self.center[0], self.center[1] + self.height/2)):
-        #         self.children[1]._intersect_memory(rect, results)
-        #     if self.children[2] and box_intersect(rect, (self.center[0] - self.width/2, self.center[1] - self.height/2, self.center[0], self.center[1])):
-        #         self.children[2]._intersect_memory(rect, results)
-        #     if self.children[3] and box_intersect(rect, (self.center[0], self.center[1] - self.height/2, self.center[0] + self.width/2, self.center[1])):
-        #         self.children[3]._intersect_memory(rect, results)
-        #     if self.children[0] and box_intersect(rect, (self.center[0], self.center[1], self.center[0] + self.width/2, self.center[1] + self.height/2)):
-        #         self.children[0]._intersect_memory(rect, results)
-
-        for node in self.nodes:
-            if box_intersect(rect, node.rect):
-            # (
-                if debug:
-                    results.append(node.item + node.rect)
-                else:
-                    results.append(node.item)
+            x, y, width, height = self.center[0], self.center[1], self.width, self.height
+            quadrants = ((1, (x - width/2, y, x, y + height/2)), (2, (x - width/2, y - height/2, x, y)),
+                         (3, (x, y - height/2, x + width/2, y)), (0, (x, y, x + width/2, y + height/2)))
+            for i, quadrant in quadrants:
+                if self.children[i] == None:
+                    continue
+                # the items of a child are inside its quadrant, only the query boxes reaching it are passed on
+                sub = rect if contains else _query_clip(rect, quadrant)
+                if sub is not None:
+                    self._intersect_child(i, sub, results, debug, contains, index, exclude, fileids)
+
+        if self.count != 0:
+            items = self.items[:self.count]
+            _append_results(items[_query_intersect_many(rect, items['rect'])], results, debug, exclude, fileids)
         return results
 
-    def _intersect_file(self, rect, f_path, offset = None, results=None, debug = False, parent_contains = False):
+    def _intersect_child(self, i, rect, results, debug, contains, index, exclude = None, fileids = None):
+        '''
+        Search the i-th child, loading it first if it is only a file offset. When the index does not
+        allow more nodes in memory, the child subtree is searched in the file instead.
+        '''
+        child = self.children[i]
+        if not isinstance(child, _QuadTree):
+            offset = child
+            child = index._resident_child(self, i)
+            if child is None:
+                index._intersect_file(rect, index._open(), offset, results, debug = debug, parent_contains = contains,
+                                      exclude = exclude, fileids = fileids)
+                return
+        child._intersect_memory(rect, results, parent_contains = contains, debug = debug, index = index, exclude = exclude, fileids = fileids)
+
+    def _intersect_file(self, rect, buffer, offset = None, results=None, debug = False, parent_contains = False, exclude = None, fileids = None):
         '''
         Recursively return nodes that intersect with the bounding box in the index located in a file.
 
             Parameters:
-            - **rect (tuple)**: a tuple that represents the bottom left, top right coorinates of a bounding box.
-            - **f_path (str)**: path to the index.
+            - **rect (tuple)**: a tuple that represents the bottom left, top right coorinates of a bounding box, or a list of boxes.
+            - **buffer (mmap)**: read only memory map of the index file.
             - **offset (int)**: byte offset to the node.
             - **results (list)**:   recursive result array to store the parsed leaf nodes.     
             - **debug (bool)**: When true, the results also include the bounding box of each entry. 
+            - **exclude (ndarray)**: file ids whose items are skipped.
+            - **fileids (tuple)**: file ids whose items are kept and their summary, subtrees without them are skipped.
             Returns:
             - **results (list)**:   recursive result array to store the parsed leaf nodes.    
        
@@ -310,68 +590,74 @@ class _QuadTree(object):
             results = []
         if offset == -1:
             return results
-        # if offset is None:
-        #     raise Exception("memory search not implemented")
-        with open(f_path, 'rb') as f:
-            f.seek(offset)
-            a = f.read(48 + 1)
-            if offset < 80:
-                raise Exception()
-            (x, y, width, height, depth, num_items, isLeaf) = unpack("ddddll?", a)
-
-            contains = parent_contains or box_contains(rect, (x - width/2, y - height/2, x + width/2, y + height/2))
-
-            # search children
-            if not isLeaf:
-                children = unpack("llll", f.read(32))
-                if contains or box_intersect(rect, (x - width/2, y, x, y + height/2)):
-                    # print(1)
-                    self._intersect_file(rect, f_path,children[1], results, parent_contains = contains, debug = debug)
-                if contains or box_intersect(rect, (x - width/2, y - height/2, x, y)):
-                    # print(2)
-                    self._intersect_file(rect, f_path, children[2], results, parent_contains = contains, debug = debug)
-                if contains or box_intersect(rect, (x, y - height/2, x + width/2, y)):
-                    # print(3)
-                    self._intersect_file(rect, f_path, children[3], results, parent_contains = contains, debug = debug)
-                if contains or box_intersect(rect, (x, y, x + width/2, y + height/2)):
-                    # print(4)
-                    self._intersect_file(rect, f_path, children[0], results, parent_contains = contains, debug = debug)
-            # if not isLeaf:
-            #     children = unpack("llll", f.read(32))
-            #     if box_intersect(rect, (x - width/2, y, x, y + height/2)):
-            #         # print(1)
-            #         self._intersect_file(rect, f_path,children[1], results)
-            #     if box_intersect(rect, (x - width/2, y - height/2, x, y)):
-            #         # print(2)
-            #         self._intersect_file(rect, f_path, children[2], results)
-            #     if box_intersect(rect, (x, y - height/2, x + width/2, y)):
-            #         # print(3)
-            #         self._intersect_file(rect, f_path, children[3], results)
-            #     if box_intersect(rect, (x, y, x + width/2, y + height/2)):
-            #         # print(4)
-            #         self._intersect_file(rect, f_path, children[0], results)
-            nodes = []
-            counter = 0
-
-            while counter < num_items:
-                counter += 1
-                node_item = unpack(self.field_str, f.read(self.item_size - 4*8))
-                node_rect = unpack("dddd", f.read(4*8))
-                if node_item[2] == 0:
-                    break
-                else:
-                    nodes.append((node_item, node_rect))
-            for node in nodes:
-                if box_intersect(rect, node[1]):
-                    if debug:
-                        results.append(node[0] + node[1])
-                    else:
-                        results.append(node[0])
+        if offset < 80:
+            raise Exception()
+        (x, y, width, height, children, items, files) = self._read_node(buffer, offset)
+        if fileids is not None and not _may_contain(files, fileids[1]):
+            return results
+
+        contains = parent_contains or _query_contains(rect, (x - width/2, y - height/2, x + width/2, y + height/2))
+
+        # search children
+        if children is not None:
+            quadrants = ((1, (x - width/2, y, x, y + height/2)), (2, (x - width/2, y - height/2, x, y)),
+                         (3, (x, y - height/2, x + width/2, y)), (0, (x, y, x + width/2, y + height/2)))
+            for i, quadrant in quadrants:
+                sub = rect if contains else _query_clip(rect, quadrant)
+                if sub is not None:
+                    self._intersect_file(sub, buffer, children[i], results, parent_contains = contains, debug = debug,
+                                         exclude = exclude, fileids = fileids)
+
+        _append_results(items[_query_intersect_many(rect, items['rect'])], results, debug, exclude, fileids)
         return results
 
-    def _split(self):
+    def _read_node(self, buffer, offset):
         '''
-        convert the current node into a parent node, spawn 4 child nodes and insert the current node's data into children.
+        Decode the node stored at an offset of the index file.
+        Decoded nodes are kept in the node cache of the index, if it has one.
+
+            Parameters:
+            - **buffer (mmap)**: read only memory map of the index file.
+            - **offset (int)**: byte offset to the node.
+
+            Returns:
+            - **node (tuple)**: center x, center y, width, height, child offsets (None for a leaf), the item array
+                                and the file summary (None if the node has none).
+        '''
+        cache = getattr(self, "cache", None)
+        key = (self.disk, offset)
+        if cache is not None:
+            node = cache.get(key)
+            if node is not None:
+                return node
+
+        (x, y, width, height, depth, num_items, flags) = unpack_from("ddddllB", buffer, offset)
+        offset += 48 + 1
+        children = None
+        if not flags & LEAF_FLAG:
+            children = unpack_from("llll", buffer, offset)
+            offset += 32
+        files = None
+        if flags & FILES_FLAG:
+            files = np.frombuffer(buffer, dtype=np.uint64, count=FILES_BYTES // 8, offset=offset).copy()
+            offset += FILES_BYTES
+        # zero-copy view of the item block
+        items = np.frombuffer(buffer, dtype=self.dtype, count=num_items, offset=offset)
+        # an item with a zero offset marks the end of the stored items
+        empty = np.flatnonzero(items['offset'] == 0)
+        if len(empty) != 0:
+            items = items[:empty[0]]
+
+        node = (x, y, width, height, children, items, files)
+        if cache is not None:
+            # the cached copy does not hold on to the memory map
+            node = (x, y, width, height, children, items.copy(), files)
+            cache.put(key, node, NODE_BYTES + items.nbytes)
+        return node
+
+    def _spawn_children(self):
+        '''
+        Create the 4 (empty) child nodes of the current node.
 
             Parameters:
 
@@ -387,107 +673,157 @@ class _QuadTree(object):
         y1 = self.center[1] - quartheight
         y2 = self.center[1] + quartheight
         new_depth = self._depth + 1
-        self.children = [_QuadTree(x2, y2, halfwidth, halfheight,
-                                   self.max_items, self.max_depth, new_depth),
-                         _QuadTree(x1, y2, halfwidth, halfheight,
-                                   self.max_items, self.max_depth, new_depth),
-                         _QuadTree(x1, y1, halfwidth, halfheight,
-                                   self.max_items, self.max_depth, new_depth),
-                         _QuadTree(x2, y1, halfwidth, halfheight,
-                                   self.max_items, self.max_depth, new_depth)]
-        nodes = self.nodes
-        self.nodes = []
-        for node in nodes:
-            # self._insert_into_children(node.item, node.rect)
-            # call insert again, which would invoke insert into 
-            # children if appropriate
-            self._insert(node.item, node.rect)
-
-    def _to_disk(self, position):
-        '''
-        pack the current node into binary, and prepare the children node if there is any.
+        self.children = [self._new_child(x2, y2, halfwidth, halfheight, new_depth),
+                         self._new_child(x1, y2, halfwidth, halfheight, new_depth),
+                         self._new_child(x1, y1, halfwidth, halfheight, new_depth),
+                         self._new_child(x2, y1, halfwidth, halfheight, new_depth)]
+
+    def _split(self):
+        '''
+        convert the current node into a parent node, spawn 4 child nodes and insert the current node's data into children.
 
             Parameters:
-            - **position (int)**: position to the offest in the file, this is to compute the file offest for the children nodes.
+
+            Returns:
+       
+        '''
+        self._spawn_children()
+        items = self.items[:self.count]
+        self.items = np.empty(0, dtype=self.dtype)
+        self.count = 0
+        # insert again, which routes the items into children where appropriate
+        self._insert_many(items)
+
+    def _disk_size(self):
+        '''
+        Number of bytes the node takes in the index file, 0 for an empty leaf which is not written.
+        '''
+        files = FILES_BYTES if self.files is not None else 0
+        if len(self.children) != 0:
+            return 48 + 1 + 32 + files + (self.count * self.item_size)
+        elif self.count != 0:
+            return 48 + 1 + files + (self.count * self.item_size)
+        return 0
+
+    def _summarize(self):
+        '''
+        Compute the missing file summaries of the subtree, e.g. of nodes read from an index written before the summaries.
+
+            Returns:
+            - **files (ndarray)**: file summary of the node, None if the items have no file id.
+        '''
+        if 'fileid' not in self.dtype.names:
+            return None
+        if self.files is None:
+            files = _file_summary(self.items['fileid'][:self.count])
+            for child in self.children:
+                if child is not None:
+                    files = _merge_summary(files, child._summarize())
+            self.files = files
+        return self.files
+
+    def _to_disk(self, children_position):
+        '''
+        pack the current node into binary.
+
+            Parameters:
+            - **children_position (list)**: file offsets of the 4 children, -1 for a missing child. Ignored for a leaf node.
 
             Returns:
             - **barray (bytes)**: bytes of the current node.
-            - **children (_QuadTree)**: children node objects if any.
-            - **position (int)**: byte position to the current end of file after adding the current node.
        
         '''
         barray = pack('ddddl', self.center[0], self.center[1], self.width, self.height, self._depth)
-        barray += pack('l', len(self.nodes))
+        barray += pack('l', self.count)
+        flags = FILES_FLAG if self.files is not None else 0
         if len(self.children) != 0:
             # parent node
-            barray += pack('?', 0)
-            children = self.children
-            children_position = []
-            for c in self.children:
-                children_position.append(position)
-                if len(c.children) != 0:
-                    position += 48 + 1 + 32 + (len(c.nodes) * self.item_size)
-                elif len(c.nodes) != 0:
-                    position += 48 + 1 + ((len(c.nodes)) * self.item_size)
-                else: 
-                    children_position[-1] = -1
+            barray += pack('B', flags)
             barray += pack('llll', children_position[0], children_position[1], children_position[2], children_position[3])
         else:
             # leaf node
-            barray += pack('?', 1)
-            if len(self.nodes) == 0:
-                return bytearray(), [], position
-            children = []
+            barray += pack('B', flags | LEAF_FLAG)
+            if self.count == 0:
+                return bytes()
+        if self.files is not None:
+            barray += self.files.tobytes()
 
-        for node in self.nodes:
-            (item, rect) = (node.item, node.rect)
-            # barray += pack("lllll", item[0], item[1], item[2], item[3], item[4])
-            barray += node.pack_items(self.extra)
-            barray += pack("dddd", rect[0], rect[1], rect[2], rect[3])
-        return barray, children, position
+        # the item array has the same packed layout as the file
+        return barray + self.items[:self.count].tobytes()
 
-    def _from_disk(self, f_path, offset):
+    def _from_buffer(self, buffer, offset):
         '''
-        load a node from file.
+        load a node from a memory mapped index file. The children are left as their file offsets
+        (None for a missing child) until they are loaded.
 
             Parameters:
-            - **f_path (str)**: path to the pre-computed index.
+            - **buffer (mmap)**: memory map of the pre-computed index.
             - **offset (int)**: position to the offest in the file. This offset contains the location of the node
 
             Returns:
        
         '''
+        (x, y, self.width, self.height, self._depth, num_node, flags) = unpack_from("ddddllB", buffer, offset)
+        self.center = (x, y)
+        self.isLeaf = bool(flags & LEAF_FLAG)
+        offset += 48 + 1
         children = []
-        self.center = (0,0)
-        with open(f_path, 'rb') as f:
-            f.seek(offset)
-            a = f.read(49)
-            # print(offset, a)
-            (x, y, self.width, self.height, self._depth, num_node, self.isLeaf) = unpack("ddddll?", a)
-            self.center= (x, y)
-            if not self.isLeaf:
-                children = unpack("llll", f.read(32))
-
-            for x in range(0, num_node):
-                node = unpack(self.field_str, f.read(self.item_size - 4*8))
-                rect = unpack("dddd", f.read(4*8))
-                node = _QuadNode(node, rect)
-                self.nodes.append(node)
-
-        # parse the children outside so that no multiple file pointers opened 
-        self.children = []
-        for child in children:
-            if child != -1:
-                self.children.append(_QuadTree(path = f_path, offset = child, field_str = self.field_str))
-            else:
-                self.children.append(None)
+        if not self.isLeaf:
+            children = unpack_from("llll", buffer, offset)
+            offset += 32
+        self.files = None
+        if flags & FILES_FLAG:
+            self.files = np.frombuffer(buffer, dtype=np.uint64, count=FILES_BYTES // 8, offset=offset).copy()
+            offset += FILES_BYTES
+        self.items = np.frombuffer(buffer, dtype=self.dtype, count=num_node, offset=offset).copy()
+        self.count = num_node
+        self.children = [None if child == -1 else child for child in children]
+
+    def _load_child(self, i, buffer):
+        '''
+        Decode the i-th child of the node, which is still a file offset.
+
+            Parameters:
+            - **i (int)**: index of the child.
+            - **buffer (mmap)**: memory map of the pre-computed index.
+
+            Returns:
+            - **child (_QuadTree)**: the loaded child node.
+        '''
+        child = _QuadTree(max_items = self.max_items, max_depth = self.max_depth, buffer = buffer, offset = self.children[i],
+                          extra = self.extra, field_str = self.field_str)
+        self.children[i] = child
+        return child
+
+    def _load_all(self, buffer):
+        '''
+        Load every node of the subtree that is not in memory yet.
+
+            Parameters:
+            - **buffer (mmap)**: memory map of the pre-computed index.
+
+            Returns:
+            - **loaded (int)**: number of nodes loaded.
+        '''
+        loaded = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for i, child in enumerate(node.children):
+                if isinstance(child, int):
+                    child = node._load_child(i, buffer)
+                    loaded += 1
+                if child is not None:
+                    stack.append(child)
+        return loaded
 
 class Index(_QuadTree):
     """
     The wrapper of the root quad tree node, which represents a spatial index. 
     """
 
-    def __init__(self, bbox=None, x=None, y=None, width=None, height=None, max_items=MAX_ITEMS, max_depth=MAX_DEPTH, disk = None, first_run=False):
+    def __init__(self, bbox=None, x=None, y=None, width=None, height=None, max_items=MAX_ITEMS, max_depth=MAX_DEPTH, disk = None, first_run=False, cache = None,
+                 lazy = False, max_resident_depth = None, max_resident_nodes = None, fields = None):
         """
         Initiate by specifying either 1) a bbox to keep track of, or 2) with an xy centerpoint and a width and height,
         3, a disk path to pre-computed index.
@@ -508,10 +844,26 @@ class Index(_QuadTree):
             occurs and the bottommost quad nodes may grow indefinately. Default is 20.
         - **disk** (optional): The path to which this index is prestored.
         - **first_run** (optional): Setting it to true invokes a reconstruction from a precomputed file to memory when the object is created. 
+        - **cache** (optional): LRUCache of decoded nodes used by file based searches, keyed by (index file, node offset).
+            It can be shared by several indexes.
+        - **lazy** (optional): With first_run, only the root is loaded, the other nodes are loaded the first time a search visits them.
+        - **max_resident_depth** (optional): With lazy, the deepest level of nodes that is loaded to memory.
+        - **max_resident_nodes** (optional): With lazy, the maximum number of nodes loaded to memory.
+            Parts of the tree that are not allowed in memory are searched in the file.
+        - **fields** (optional): Names of the integer item fields of a new index, ITEM_FIELDS by default.
         """
-        # print(disk, first_run)
+        extra = None if fields is None else {name: int for name in fields}
+        # memory map of the index file, shared by all file based searches
+        self._buffer = None
+        self._lock = threading.Lock()
+        # (container path, offset, length) of an index stored in a container file
+        self._segment = None
+        self._shared = False
+        self.cache = cache
+        self._lazy = False
+        self._load_lock = threading.Lock()
         if disk and first_run:
-            self.from_disk(disk)
+            self.from_disk(disk, lazy = lazy, max_resident_depth = max_resident_depth, max_resident_nodes = max_resident_nodes)
         elif disk:
             self.disk = disk
         elif bbox != None:
@@ -521,10 +873,10 @@ class Index(_QuadTree):
             width, height = abs(x2-x1), abs(y2-y1)
             midx, midy = x1+width/2.0, y1+height/2.0
             
-            super(Index, self).__init__(midx, midy, width, height, max_items, max_depth)
+            super(Index, self).__init__(midx, midy, width, height, max_items, max_depth, extra = extra)
 
         elif None not in (x, y, width, height):
-            super(Index, self).__init__(x, y, width, height, max_items, max_depth)
+            super(Index, self).__init__(x, y, width, height, max_items, max_depth, extra = extra)
 
         else:
             raise Exception("Either the bbox argument must be set, or the x, y, width, and height arguments must be set")
@@ -536,81 +888,331 @@ class Index(_QuadTree):
         - **item**: The item to insert into the index, which will be returned by the intersection method
         - **bbox**: The spatial bounding box tuple of the item, with four members (xmin,ymin,xmax,ymax)
         """
+        self._load_remaining()
         self._insert(item, bbox)
 
-    def intersect(self, bbox, in_memory = False, debug = False):
+    def insert_many(self, items, bboxes):
+        """
+        Inserts many items at once, e.g. all the leaf blocks of a chromosome from one or many files.
+        The items are presorted by their first field (the start, i.e. the hilbert distance of the block)
+        and the tree is built top down by partitioning them by quadrant, one level at a time, so no
+        item is re-inserted one by one when a node splits.
+        Parameters:
+        - **items**: A structured array with the item fields, or a (n, number of fields) array with the fields in order
+        - **bboxes**: A (n, 4) array of the spatial bounding boxes of the items (xmin,ymin,xmax,ymax)
+        """
+        bboxes = np.asarray(bboxes, dtype='d').reshape(-1, 4)
+        rows = np.empty(len(bboxes), dtype=self.dtype)
+        fields = self.dtype.names[:-1]
+        if isinstance(items, np.ndarray) and items.dtype.names is not None:
+            for name in fields:
+                rows[name] = items[name]
+        else:
+            items = np.asarray(items).reshape(len(bboxes), -1)
+            for i, name in enumerate(fields):
+                rows[name] = items[:, i]
+        rows['rect'][:, 0] = np.minimum(bboxes[:, 0], bboxes[:, 2])
+        rows['rect'][:, 1] = np.minimum(bboxes[:, 1], bboxes[:, 3])
+        rows['rect'][:, 2] = np.maximum(bboxes[:, 0], bboxes[:, 2])
+        rows['rect'][:, 3] = np.maximum(bboxes[:, 1], bboxes[:, 3])
+        self._load_remaining()
+        if len(rows) != 0:
+            self._insert_many(rows[np.argsort(rows[fields[0]], kind='stable')])
+
+    def intersect(self, bbox, in_memory = False, debug = False, exclude = None, fileids = None):
         """
         Intersects an input boundingbox rectangle with all of the items
         contained in the quadtree.
         Parameters:
-        - **bbox**: A spatial bounding box tuple with four members (xmin,ymin,xmax,ymax)
+        - **bbox**: A spatial bounding box tuple with four members (xmin,ymin,xmax,ymax),
+                    or a list (or (n, 4) array) of boxes to search their union.
         - **in_memory** (optional): A flag for using in_memory search with respect to file based search.
         - **debug** (optional): A flag that allows extra output when debugging.
+        - **exclude** (optional): File ids whose items are skipped, e.g. removed files.
+        - **fileids** (optional): File ids whose items are returned, all files by default.
+                    Subtrees whose file summary holds none of them are not searched.
         Returns:
         - A list of inserted items whose bounding boxes intersect with the input bbox.
         """
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64)
+        if fileids is not None:
+            fileids = np.unique(np.asarray(list(fileids), dtype=np.int64))
+            fileids = (fileids, _file_summary(fileids))
+        if isinstance(bbox, np.ndarray) and bbox.ndim == 2:
+            bbox = [tuple(box) for box in bbox.tolist()]
+        elif isinstance(bbox, list):
+            # a list of boxes given as lists, or one box given as a list, the searches tell them apart by type
+            bbox = [tuple(box) for box in bbox] if len(bbox) != 0 and np.ndim(bbox[0]) == 1 else tuple(bbox)
+        if isinstance(bbox, list) and len(bbox) == 1:
+            bbox = bbox[0]
+        if len(bbox) == 0:
+            return []
         if in_memory:
-            t = self._intersect_memory(bbox, debug = debug)
+            t = self._intersect_memory(bbox, debug = debug, index = self, exclude = exclude, fileids = fileids)
             return t
         else:
-            self.read_header()
-            t = self._intersect_file(bbox, self.disk, 80+len(self.field_str), debug = debug)
+            buffer = self._open()
+            t = self._intersect_file(bbox, buffer, 80+len(self.field_str), debug = debug, exclude = exclude, fileids = fileids)
             return t
 
-    def read_header(self):
-        header = None
-        with open(self.disk, 'rb') as f:
-            header = unpack('qiiiqqqqqll', f.read(80))
-            (magic, max_item, _, _, x1, y1, x2, y2, _, item_size, field_str_len) = header
-            
-            if magic != 0x45504951:
-                raise Exception("File magic mismatch")
-            self.item_size = item_size
-            self.bbox = (x1, y1, x2, y2)
-            self.max_item = max_item
-            self.field_str = f.read(field_str_len).decode("utf-8")
+    def _open(self):
+        '''
+        Memory map the index file and read its header. This happens once per Index,
+        concurrent file based searches share the same read only mapping.
+
+            Returns:
+            - **buffer (mmap)**: the memory mapped index file.
+        '''
+        if self._buffer is None:
+            with self._lock:
+                if self._buffer is None:
+                    buffer = _map(self.disk, self._segment)
+                    try:
+                        self.read_header(buffer)
+                    except Exception:
+                        _release(buffer)
+                        raise
+                    self._buffer = buffer
+        return self._buffer
+
+    def attach(self, buffer, disk, segment = None, load = False, **options):
+        '''
+        Use an index that is already mapped, e.g. a chromosome tree of a container file.
+        The buffer belongs to the caller and is not closed by the index.
+
+            Parameters:
+            - **buffer (memoryview)**: the index data.
+            - **disk (str)**: name of the index, used as the node cache key.
+            - **segment (tuple)** (optional): (container path, offset, length) of the index, to map it again after close.
+            - **load (bool)** (optional): load the index to memory.
+            - **options**: lazy loading options, see from_disk.
+        '''
+        self.close()
+        self.disk = disk
+        self._segment = segment
+        self.read_header(buffer)
+        with self._lock:
+            self._buffer = buffer
+            self._shared = True
+        if load:
+            self._load(buffer, **options)
+
+    def close(self):
+        '''
+        Release the memory map of the index file, if any.
+        '''
+        with self._lock:
+            buffer, self._buffer = self._buffer, None
+            shared, self._shared = self._shared, False
+        if buffer is not None and not shared:
+            _release(buffer)
 
-    def from_disk(self, f_path):
+    def read_header(self, buffer = None):
+        '''
+        Read the header of the index file.
+
+            Parameters:
+            - **buffer (mmap)** (optional): the memory mapped index file. The file is mapped if not given.
+        '''
+        if buffer is None:
+            buffer = self._open()
+        header = unpack_from('qiiiqqqqqll', buffer, 0)
+        (magic, max_item, version, _, x1, y1, x2, y2, _, item_size, field_str_len) = header
+
+        if magic != 0x45504951:
+            raise Exception("File magic mismatch")
+        if version not in (NODE_VERSION, FILES_VERSION):
+            raise Exception("Unsupported index version " + str(version))
+        self.item_size = item_size
+        self.bbox = (x1, y1, x2, y2)
+        self.max_item = max_item
+        self.field_str = bytes(buffer[80:80 + field_str_len]).decode("utf-8")
+        self.dtype = _item_dtype(self.field_str)
+        self.extra = {name: (int if t == 'l' else float) for name, t in zip(self.dtype.names, self.field_str)}
+
+    def from_disk(self, f_path, lazy = False, max_resident_depth = None, max_resident_nodes = None):
         '''
         Constructs a quadtree index from a precomputed file and store it in the current node.
         Parameters:
         - **f_path**: a string containing the path to the precomputed index.
+        - **lazy** (optional): Only load the root, the other nodes are loaded the first time a search visits them.
+        - **max_resident_depth** (optional): With lazy, the deepest level of nodes that is loaded to memory.
+        - **max_resident_nodes** (optional): With lazy, the maximum number of nodes loaded to memory.
 
         '''
+        self.close()
         self.disk = f_path
-        self.read_header()
-        self.nodes = []
-        self._from_disk(f_path, 80+len(self.field_str))
+        self._segment = None
+        self._load(self._open(), lazy = lazy, max_resident_depth = max_resident_depth, max_resident_nodes = max_resident_nodes)
 
-    def to_disk(self, path):
+    def _load(self, buffer, lazy = False, max_resident_depth = None, max_resident_nodes = None):
+        '''
+        Load the index from its mapped data, see from_disk.
+        '''
+        self.max_items = self.max_item
+        self.max_depth = MAX_DEPTH
+        self.max_resident_depth = max_resident_depth
+        self.max_resident_nodes = max_resident_nodes
+        self._from_buffer(buffer, 80+len(self.field_str))
+        self.resident_nodes = 1
+        self._lazy = lazy
+        if not lazy:
+            self.resident_nodes += self._load_all(buffer)
+
+    def _resident_child(self, node, i):
+        '''
+        Load the i-th child of a node of a lazily loaded index, unless the resident limits are reached.
+
+            Parameters:
+            - **node (_QuadTree)**: the parent node.
+            - **i (int)**: index of the child.
+
+            Returns:
+            - **child (_QuadTree)**: the loaded child, None if it has to be searched in the file.
+        '''
+        buffer = self._open()
+        with self._load_lock:
+            child = node.children[i]
+            if isinstance(child, _QuadTree):
+                return child
+            if self.max_resident_depth is not None and node._depth + 1 > self.max_resident_depth:
+                return None
+            if self.max_resident_nodes is not None and self.resident_nodes >= self.max_resident_nodes:
+                return None
+            self.resident_nodes += 1
+            return node._load_child(i, buffer)
+
+    def _load_remaining(self):
+        '''
+        Load the nodes of a lazily loaded index that are not in memory yet, before the tree is modified or written.
+        '''
+        if self._lazy:
+            with self._load_lock:
+                self.resident_nodes += self._load_all(self._open())
+                self._lazy = False
+
+    def _layout(self, position, page_size):
+        '''
+        Assign a file offset to every node that is written.
+
+        Nodes are laid out depth first, in the order searches visit the children, so every subtree
+        is stored contiguously. A node that fits in a page never straddles a page boundary, it is
+        moved to the start of the next page instead.
+
+            Parameters:
+            - **position (int)**: file offset of the root node.
+            - **page_size (int)**: page size in bytes, 0 to disable the page alignment.
+
+            Returns:
+            - **order (list)**: the nodes in file order, with their offset and the padding before them.
+            - **offsets (dict)**: file offset by node id.
+        '''
+        order = []
+        offsets = {}
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            size = node._disk_size()
+            padding = 0
+            # the root stays right after the header, where readers expect it
+            if page_size and node is not self and size <= page_size and position % page_size + size > page_size:
+                padding = page_size - position % page_size
+            position += padding
+            offsets[id(node)] = position
+            order.append((node, padding))
+            position += size
+            # searches visit the children in order 1, 2, 3, 0
+            for i in (0, 3, 2, 1):
+                if i < len(node.children) and node.children[i] is not None and node.children[i]._disk_size() != 0:
+                    stack.append(node.children[i])
+        return order, offsets
+
+    def to_disk(self, path, page_size = PAGE_SIZE):
         '''
         Converts a quadtree index to file format and output it to disk.
         Parameter:
         - **path**: a string that contains the path to which the tree will be stored at.
+        - **page_size** (optional): nodes are packed into blocks of this size, 0 writes them back to back.
     
         '''
-        # defualt filepointer.tell() probably will not work as python reads bytes into 
-        # buffer (maybe it works). To keep things undercontrol, we use a manual byte counter.
-        q = [self]
-        position = 0
-        fp = 0
-        farray = bytearray()
+        self._load_remaining()
+        self.close()
         self.disk = path
-        with open(path, 'wb') as f:
-            x1, y1, x2, y2 = self.bbox
-            field_str = self.get_field_str()
-            f.write(pack('qiiiqqqqqll', 0x45504951, MAX_ITEMS, 64, 64,x1,y1,x2,y2,0, self.item_size, len(field_str)))
-            f.write(field_str)
-            position = 80 + len(field_str)
-            f.seek(position)
-            if not super(Index, self).IsParent():
-                position += 48 + 1 + 32 + (len(self.nodes) * self.item_size)
-            else:
-                position += 48 + 1 + (len(self.nodes) * self.item_size)
+        self._segment = None
+        # the file is written next to the target and then replaced, so open maps of the old file stay valid
+        with open(path + ".tmp", 'wb', buffering = WRITE_BUFFER) as f:
+            self.write(f, page_size)
+        os.replace(path + ".tmp", path)
+        if self.cache is not None:
+            self.cache.discard(lambda key: key[0] == path)
+        return self.disk
+
+    def write(self, f, page_size = PAGE_SIZE):
+        '''
+        Write the index to a binary stream, starting at its current position.
+        Offsets in the index are relative to that position, pages are aligned if it is page aligned.
+
+            Parameters:
+            - **f (file)**: binary stream to write to.
+            - **page_size (int)** (optional): nodes are packed into blocks of this size, 0 writes them back to back.
+
+            Returns:
+            - **length (int)**: number of bytes written.
+        '''
+        self._load_remaining()
+        self._summarize()
+        x1, y1, x2, y2 = self.bbox
+        field_str = self.get_field_str()
+        order, offsets = self._layout(80 + len(field_str), page_size)
+        # only files with file summaries get the new version, older readers do not know the FILES_FLAG nodes
+        version = FILES_VERSION if any(node.files is not None for node, _ in order) else NODE_VERSION
+        # the page size goes in the reserved header field, readers do not depend on it
+        f.write(pack('qiiiqqqqqll', 0x45504951, self.max_items, version, 64, x1, y1, x2, y2, page_size, self.item_size, len(field_str)))
+        f.write(field_str)
+        length = 80 + len(field_str)
+        for node, padding in order:
+            if padding:
+                f.write(bytes(padding))
+            barray = node._to_disk([offsets.get(id(c), -1) for c in node.children])
+            f.write(barray)
+            length += padding + len(barray)
+        return length
+
+    def all_items(self):
+        '''
+        Return every item of the index, loading the index to memory if needed.
+
+            Returns:
+            - **items (ndarray)**: structured array of the items, the item fields followed by the bounding box.
+        '''
+        if getattr(self, 'children', None) is None:
+            self._load(self._open())
+        self._load_remaining()
+        parts = [np.empty(0, dtype=self.dtype)]
+        q = [self]
+        while q:
+            node = q.pop()
+            parts.append(node.items[:node.count])
+            q += [c for c in node.children if c is not None]
+        return np.concatenate(parts)
+
+    def memory_usage(self):
+        '''
+        Report the memory held by the in-memory tree.
 
+            Returns:
+            - **usage (dict)**: number of nodes, number of items, bytes held by the item arrays and total bytes (node objects included).
+        '''
+        nodes, items, item_bytes, total = 0, 0, 0, 0
+        if getattr(self, 'children', None) is not None:
+            q = [self]
             while q:
-                t = q.pop(0)
-                barray, children, position = t._to_disk(position)
-                f.write(barray)
-                q += children
-        return self.disk
+                node = q.pop()
+                nodes += 1
+                items += node.count
+                item_bytes += node.items.nbytes
+                total += sys.getsizeof(node) + sys.getsizeof(node.children) + node.items.nbytes
+                # children of a lazily loaded index that are not loaded yet are file offsets
+                q += [c for c in node.children if isinstance(c, _QuadTree)]
+        return {"nodes": nodes, "items": items, "item_bytes": item_bytes, "bytes": total}
@@ -0,0 +1,179 @@
+## binned aggregation of the entries of many files over a range
+
+import numpy as np
+
+# statistics computed by bin_entries, one (files, bins) matrix each
+BIN_STATS = ["count", "coverage", "sum", "squares", "mean", "min", "max"]
+# statistics of a tile of the summary layer, see summarize_entries
+SUMMARY_FIELDS = ["count", "coverage", "sum", "squares", "min", "max"]
+SUMMARY_DTYPE = np.dtype([(name, np.float64) for name in SUMMARY_FIELDS])
+
+
+def bin_edges(start, end, num_bins):
+    '''
+    Return the edges of num_bins equal bins dividing a range.
+
+        Parameters:
+        - **start (int)**: start location of the range.
+        - **end (int)**: end location of the range.
+        - **num_bins (int)**: number of bins.
+
+        Returns:
+        - **edges (ndarray)**: the num_bins + 1 bin edges, from start to end.
+    '''
+    return start + (end - start) * np.arange(num_bins + 1, dtype=np.float64) / num_bins
+
+
+def bin_pairs(starts, ends, start, end, num_bins):
+    '''
+    Expand intervals to the equal bins of a range they overlap.
+
+        Parameters:
+        - **starts (ndarray)**: start of each interval.
+        - **ends (ndarray)**: end of each interval, exclusive.
+        - **start (int)**: start location of the range.
+        - **end (int)**: end location of the range.
+        - **num_bins (int)**: number of bins.
+
+        Returns:
+        - **entry (ndarray)**: interval of each (interval, bin) pair with a positive overlap.
+        - **bins (ndarray)**: bin of each pair.
+        - **overlap (ndarray)**: length of the overlap of each pair.
+    '''
+    bin_size = (end - start) / num_bins
+    lo = np.maximum(np.asarray(starts, dtype=np.float64), start)
+    hi = np.minimum(np.asarray(ends, dtype=np.float64), end)
+    # first and last bin of each interval, widened by one against rounding, and one row per (interval, bin) pair
+    first = np.clip(((lo - start) // bin_size).astype(np.int64) - 1, 0, num_bins - 1)
+    last = np.clip(np.ceil((hi - start) / bin_size).astype(np.int64), first, num_bins - 1)
+    counts = np.where(hi > lo, last - first + 1, 0)
+    entry = np.repeat(np.arange(len(lo)), counts)
+    bins = first[entry] + np.arange(len(entry)) - np.repeat(np.cumsum(counts) - counts, counts)
+    edges = bin_edges(start, end, num_bins)
+    overlap = np.minimum(hi[entry], edges[bins + 1]) - np.maximum(lo[entry], edges[bins])
+    pairs = overlap > 0
+    return entry[pairs], bins[pairs], overlap[pairs]
+
+
+def bin_entries(files, starts, ends, values, start, end, num_bins, num_files):
+    '''
+    Aggregate the entries of many files over equal bins of a range, in one pass over all (entry, bin) overlaps.
+    Each entry is expanded to the bins it spans (see bin_pairs), and the statistics are reduced per (file, bin)
+    with bincount and ufunc.at.
+
+        Parameters:
+        - **files (ndarray)**: file index of each entry, from 0 to num_files - 1.
+        - **starts (ndarray)**: start of each entry.
+        - **ends (ndarray)**: end of each entry, exclusive.
+        - **values (ndarray)**: value of each entry.
+        - **start (int)**: start location of the range.
+        - **end (int)**: end location of the range.
+        - **num_bins (int)**: number of bins.
+        - **num_files (int)**: number of files, i.e. rows of the result.
+
+        Returns:
+        - **stats (dict)**: (num_files, num_bins) matrices of each statistic of BIN_STATS:
+                            count is the number of entries overlapping the bin, coverage the number of bases of the bin
+                            covered by entries, sum and squares are the sums of the values and squared values weighted by
+                            their overlap with the bin, mean is sum / coverage, min and max are the extreme values of the
+                            entries overlapping the bin. Bins without entries have a coverage of 0 and NaN mean, min and max.
+    '''
+    files = np.asarray(files, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    entry, bins, overlap = bin_pairs(starts, ends, start, end, num_bins)
+    values = values[entry]
+    cell = files[entry] * num_bins + bins
+    size = num_files * num_bins
+    stats = {"count": np.bincount(cell, minlength=size).astype(np.float64),
+             "coverage": np.bincount(cell, weights=overlap, minlength=size),
+             "sum": np.bincount(cell, weights=overlap * values, minlength=size),
+             "squares": np.bincount(cell, weights=overlap * values * values, minlength=size),
+             "min": np.full(size, np.inf), "max": np.full(size, -np.inf)}
+    np.minimum.at(stats["min"], cell, values)
+    np.maximum.at(stats["max"], cell, values)
+    return _finish(stats, (num_files, num_bins))
+
+
+def _finish(stats, shape):
+    '''
+    Set the min and max of empty cells to NaN, add the mean and reshape the statistics.
+    '''
+    empty = stats["coverage"] == 0
+    stats["min"][empty] = np.nan
+    stats["max"][empty] = np.nan
+    stats["mean"] = np.divide(stats["sum"], stats["coverage"], out=np.full(len(empty), np.nan), where=~empty)
+    return {name: stats[name].reshape(shape) for name in BIN_STATS}
+
+
+def empty_tiles(shape):
+    '''
+    Return summary tiles without entries, with NaN min and max.
+
+        Parameters:
+        - **shape (tuple)**: shape of the array.
+
+        Returns:
+        - **tiles (ndarray)**: array of SUMMARY_DTYPE.
+    '''
+    tiles = np.zeros(shape, dtype=SUMMARY_DTYPE)
+    tiles["min"] = np.nan
+    tiles["max"] = np.nan
+    return tiles
+
+
+def summarize_entries(starts, ends, values, length, resolution):
+    '''
+    Compute the tiles of the summary layer of a file on one chromosome.
+
+        Parameters:
+        - **starts (ndarray)**: start of each entry.
+        - **ends (ndarray)**: end of each entry, exclusive.
+        - **values (ndarray)**: value of each entry.
+        - **length (int)**: length of the chromosome.
+        - **resolution (int)**: size of the tiles in bases.
+
+        Returns:
+        - **tiles (ndarray)**: array of SUMMARY_DTYPE with the statistics of each tile, see bin_entries.
+    '''
+    num_tiles = max(-(-length // resolution), 1)
+    stats = bin_entries(np.zeros(len(starts), dtype=np.int64), starts, ends, values, 0, num_tiles * resolution, num_tiles, 1)
+    tiles = np.empty(num_tiles, dtype=SUMMARY_DTYPE)
+    for name in SUMMARY_FIELDS:
+        tiles[name] = stats[name][0]
+    return tiles
+
+
+def bin_summaries(tiles, resolution, start, end, num_bins, length = None):
+    '''
+    Aggregate the summary tiles of many files over equal bins of a range. The sums of a tile are split between
+    the bins it overlaps in proportion to the overlap, its count, min and max are counted in each of them.
+
+        Parameters:
+        - **tiles (ndarray)**: (files, tiles) array of SUMMARY_DTYPE, the tiles of a chromosome.
+        - **resolution (int)**: size of the tiles in bases.
+        - **start (int)**: start location of the range.
+        - **end (int)**: end location of the range.
+        - **num_bins (int)**: number of bins.
+        - **length (int)**: length of the chromosome, the last tile ends there.
+
+        Returns:
+        - **stats (dict)**: (files, num_bins) matrices of each statistic of BIN_STATS, see bin_entries.
+    '''
+    num_files = tiles.shape[0]
+    first = max(int(start // resolution), 0)
+    last = min(int(-(-end // resolution)), tiles.shape[1])
+    positions = np.arange(first, max(last, first), dtype=np.int64) * resolution
+    ends = positions + resolution if length is None else np.minimum(positions + resolution, length)
+    entry, bins, overlap = bin_pairs(positions, ends, start, end, num_bins)
+    tiles = tiles[:, first + entry]
+    fraction = overlap / (ends - positions)[entry]
+    rows = np.repeat(np.arange(num_files), len(bins))
+    cell = (rows * num_bins + np.tile(bins, num_files))
+    size = num_files * num_bins
+    stats = {"min": np.full(size, np.inf), "max": np.full(size, -np.inf)}
+    for name in ["coverage", "sum", "squares"]:
+        stats[name] = np.bincount(cell, weights=(tiles[name] * fraction).ravel(), minlength=size)
+    stats["count"] = np.bincount(cell, weights=tiles["count"].ravel(), minlength=size)
+    np.fmin.at(stats["min"], cell, tiles["min"].ravel())
+    np.fmax.at(stats["max"], cell, tiles["max"].ravel())
+    return _finish(stats, (num_files, num_bins))
@@ -0,0 +1,274 @@
+## bounded caches shared by the index readers
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LRUCache(object):
+    """
+    Thread safe least recently used cache with a byte budget.
+
+    Every entry is stored with its size in bytes, the least recently used entries are
+    evicted once the total size exceeds the budget. Hits and misses are counted.
+    """
+
+    def __init__(self, max_bytes):
+        '''
+        Initialize an empty cache.
+
+            Parameters:
+            - **max_bytes (int)**: byte budget of the cache.
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default = None):
+        '''
+        Return the cached value of a key and mark it as recently used.
+
+            Parameters:
+            - **key**: key of the entry.
+            - **default**: value returned when the key is not cached.
+
+            Returns:
+            - **value**: the cached value, or default.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        '''
+        Cache a value, evicting the least recently used entries if the budget is exceeded.
+        A value larger than the whole budget is not cached.
+
+            Parameters:
+            - **key**: key of the entry.
+            - **value**: value to cache.
+            - **nbytes (int)**: size of the value in bytes.
+        '''
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._entries.popitem(last = False)
+                self.nbytes -= size
+                self.evictions += 1
+
+    def discard(self, match):
+        '''
+        Remove the entries whose key matches a predicate.
+
+            Parameters:
+            - **match (function)**: called with each key, entries are removed when it returns true.
+        '''
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self.nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        '''
+        Remove all entries, the counters are kept.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        Report the cache usage.
+
+            Returns:
+            - **stats (dict)**: number of entries, bytes used, byte budget, hits, misses and evictions.
+        '''
+        return {"entries": len(self._entries), "bytes": self.nbytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class _Handle(object):
+    __slots__ = ('handle', 'users', 'lock', 'discarded')
+
+    def __init__(self, handle = None):
+        self.handle = handle
+        self.users = 0
+        self.lock = threading.Lock()
+        self.discarded = False
+
+
+class HandlePool(object):
+    """
+    Thread safe pool of open file handles with a maximum size.
+
+    Handles are opened on demand and used by one thread at a time. Once the pool is full, the least
+    recently used handles that are not in use are closed; when every handle is in use the pool grows
+    until some are released. Handles are closed after the pool lock is released, a slow closer does
+    not block the other threads.
+    """
+
+    def __init__(self, max_handles, opener, closer = None):
+        '''
+        Initialize an empty pool.
+
+            Parameters:
+            - **max_handles (int)**: maximum number of open handles.
+            - **opener (function)**: called with a key, returns a new handle.
+            - **closer (function)** (optional): called with a key and its handle when the handle is closed.
+        '''
+        self.max_handles = max_handles
+        self.opener = opener
+        self.closer = closer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @contextmanager
+    def handle(self, key):
+        '''
+        Use the handle of a key, opening it if it is not in the pool. The handle is locked while it is used.
+
+            Parameters:
+            - **key**: key of the handle, e.g. a file path.
+
+            Returns:
+            - **handle**: the open handle, as a context manager.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Handle()
+            self._entries.move_to_end(key)
+            entry.users += 1
+        try:
+            with entry.lock:
+                opened = entry.handle is None
+                if opened:
+                    entry.handle = self.opener(key)
+                with self._lock:
+                    if opened:
+                        self.misses += 1
+                    else:
+                        self.hits += 1
+                yield entry.handle
+        finally:
+            with self._lock:
+                entry.users -= 1
+                closing = [(key, self._detach(entry))] if entry.discarded and entry.users == 0 else []
+                closing += self._evict()
+            self._close(closing)
+
+    def add(self, key, handle):
+        '''
+        Add a handle that is already open, e.g. the file object used to index a file.
+
+            Parameters:
+            - **key**: key of the handle.
+            - **handle**: the open handle.
+        '''
+        closing = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = _Handle(handle)
+                closing = self._evict()
+        self._close(closing)
+
+    def discard(self, key):
+        '''
+        Close the handle of a key and remove it from the pool, once it is not in use anymore.
+
+            Parameters:
+            - **key**: key of the handle.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return
+            entry.discarded = True
+            if entry.users != 0:
+                return
+            closing = [(key, self._detach(entry))]
+        self._close(closing)
+
+    def clear(self):
+        '''
+        Close all the handles that are not in use.
+        '''
+        with self._lock:
+            closing = [(key, self._detach(self._entries.pop(key)))
+                       for key in [key for key, entry in self._entries.items() if entry.users == 0]]
+        self._close(closing)
+
+    @staticmethod
+    def _detach(entry):
+        handle, entry.handle = entry.handle, None
+        return handle
+
+    def _close(self, closing):
+        '''
+        Close handles removed from the pool, the pool lock must not be held.
+
+            Parameters:
+            - **closing (list)**: (key, handle) pairs, the handle is None if it was never opened.
+        '''
+        if self.closer is None:
+            return
+        for key, handle in closing:
+            if handle is not None:
+                self.closer(key, handle)
+
+    def _evict(self):
+        '''
+        Remove the least recently used idle handles while the pool is too large, the pool lock is held by the caller.
+
+            Returns:
+            - **closing (list)**: (key, handle) pairs of the removed handles, to close once the lock is released.
+        '''
+        closing = []
+        if len(self._entries) <= self.max_handles:
+            return closing
+        for key in [key for key, entry in self._entries.items() if entry.users == 0]:
+            if len(self._entries) <= self.max_handles:
+                break
+            closing.append((key, self._detach(self._entries.pop(key))))
+            self.evictions += 1
+        return closing
+
+    def stats(self):
+        '''
+        Report the pool usage.
+
+            Returns:
+            - **stats (dict)**: number of handles, maximum number of handles, hits, misses and evictions.
+        '''
+        return {"handles": len(self._entries), "max_handles": self.max_handles,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -1,8 +1,12 @@
 from hilbertcurve.hilbertcurve import HilbertCurve
+from functools import lru_cache
+import numpy as np
 import requests
 import math
 
 avaliable_typles = ['mm10', 'mm9', 'hg19', 'hg38', 'human']
+# number of distances decoded at once by the vectorized hilbert decoder
+DECODE_CHUNK = 1 << 14
 
 human_genome = {
     "chr1": 249250621, 
@@ -32,6 +36,87 @@ human_genome = {
     "chrY": 59373566
 }
 
+@lru_cache(maxsize=None)
+def _hilbert_curve(hlevel, dims):
+    '''
+    Return the hilbert curve of a level, curves are created once per level and dimension.
+    '''
+    return HilbertCurve(hlevel, dims)
+
+def _compact_bits(h):
+    '''
+    Gather the even bits of each integer into its low half (bit 2j goes to bit j).
+    '''
+    x = h & 0x5555555555555555
+    x = (x | (x >> 1)) & 0x3333333333333333
+    x = (x | (x >> 2)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x >> 4)) & 0x00FF00FF00FF00FF
+    x = (x | (x >> 8)) & 0x0000FFFF0000FFFF
+    x = (x | (x >> 16)) & 0x00000000FFFFFFFF
+    return x
+
+@lru_cache(maxsize=None)
+def _hilbert_decoder(hlevel):
+    '''
+    Return a vectorized decoder of distances along the 2d hilbert curve of a level.
+    It follows the transpose decoding of HilbertCurve.point_from_distance (Skilling's algorithm),
+    applied with bit operations to whole numpy arrays.
+
+            Parameters:
+            - **hlevel (int)**:       level of the hilbert space.
+
+            Returns:
+            - **decode (function)**:  takes an int64 array of distances, returns the x and y coordinate arrays.
+    '''
+    if 2 * hlevel > 62:
+        raise ValueError("hilbert level {} is too large for 64 bit distances".format(hlevel))
+    max_h = 4 ** hlevel - 1
+    # the "undo excess work" bits, q = 2, 4, ... 2**(hlevel-1)
+    steps = [(k, 1 << k) for k in range(1, hlevel)]
+
+    def decode(distances):
+        h = np.asarray(distances, dtype=np.int64)
+        if h.size and (h.max() > max_h or h.min() < 0):
+            raise ValueError("all values in distances must be between 0 and 2**(p*n)-1={}".format(max_h))
+        if h.size > DECODE_CHUNK:
+            # decode in chunks that stay in cache
+            parts = [decode(h[i:i + DECODE_CHUNK]) for i in range(0, h.size, DECODE_CHUNK)]
+            return np.concatenate([x for x, _ in parts]), np.concatenate([y for _, y in parts])
+        # transpose: bit j of x (resp. y) is bit 2j+1 (resp. 2j) of the distance
+        x = _compact_bits(h >> 1)
+        y = _compact_bits(h)
+        # gray decode
+        t = y >> 1
+        y ^= x
+        x ^= t
+        # undo excess work, the branches are applied with masks: m is all ones where the bit q is set
+        for k, q in steps:
+            p = q - 1
+            m = -((y >> k) & 1)
+            x ^= p & m
+            t = x ^ y
+            t &= p & ~m
+            x ^= t
+            y ^= t
+            x ^= p & -((x >> k) & 1)
+        return x, y
+
+    return decode
+
+def hilbert_points(hlevel, distances):
+    '''
+    Returns hilbert space coordinates of many distances along the 2d hilbert curve at once.
+
+            Parameters:
+            - **hlevel (int)**:       level of the hilbert space.
+            - **distances (array)**:  integer distances along the hilbert curve.
+
+            Returns:
+            - **x (ndarray)**:        x coordinates in hilbert space.
+            - **y (ndarray)**:        y coordinates in hilbert space.
+    '''
+    return _hilbert_decoder(hlevel)(distances)
+
 def hcoords(x, chromLength, dims = 2):
     '''
     Returns hilbert space coordinate of the input query.
@@ -48,10 +133,31 @@ def hcoords(x, chromLength, dims = 2):
     '''
     hlevel = math.ceil(math.log2(chromLength)/dims)
     # print("hlevel, ", hlevel)
-    hilbert_curve = HilbertCurve(hlevel, dims)
+    hilbert_curve = _hilbert_curve(hlevel, dims)
     [x,y] = hilbert_curve.points_from_distances([x])[0]
     return x, y, hlevel
 
+def hcoords_many(xs, chromLength, dims = 2):
+    '''
+    Returns hilbert space coordinates of many locations at once, see hcoords.
+
+            Parameters:
+            - **xs (array)**:         integers representing the query locations in a chromosome.
+            - **chromLength (int)**:  The total length of the chromosome.
+            - **dims (int)**:         dimension of the hilbert space, only 2d hilbert space is vectorized.
+
+            Returns:
+            - **x (ndarray)**:        x coordinates in hilbert space.
+            - **y (ndarray)**:        y coordinates in hilbert space.
+            - **hlevel (int)**:   level of the hilbert space.
+    '''
+    hlevel = math.ceil(math.log2(chromLength)/dims)
+    if dims != 2:
+        points = np.array(_hilbert_curve(hlevel, dims).points_from_distances([int(x) for x in xs]), dtype=np.int64)
+        return points[:, 0], points[:, 1], hlevel
+    x, y = hilbert_points(hlevel, xs)
+    return x, y, hlevel
+
 # query : dictionary with 2 items, start and end
 def range2bbox(hlevel, query, dims = 2, margin = 0):
     '''
@@ -71,7 +177,7 @@ def range2bbox(hlevel, query, dims = 2, margin = 0):
     #     "start": 0,
     #     "end":  127074
     #     }
-    hilbert_curve = HilbertCurve(hlevel, dims)
+    hilbert_curve = _hilbert_curve(hlevel, dims)
     inc = 0
     # ite = 0
     start = query["start"]+1
@@ -128,6 +234,127 @@ def range2bbox(hlevel, query, dims = 2, margin = 0):
     # print(time.time() - now)
     return bbox
 
+def range2bbox_many(hlevel, starts, ends, dims = 2, margin = 0):
+    '''
+    Convert many chromosome ranges to bounding boxes in hilbert space at once, see range2bbox.
+    The ranges are decomposed into hilbert curve points together, one power of 4 step at a time,
+    and all the points are decoded with one vectorized call.
+
+            Parameters:
+            - **hlevel (int)**:       level of the hilbert space, calculated by the size of the chromosome.
+            - **starts (array)**:     start of each range.
+            - **ends (array)**:       end of each range.
+            - **dims (int)**:         dimension of the hilbert space, only 2d hilbert space is vectorized.
+            - **margin (int)**:       margin of the query box in hilbert space.
+
+            Returns:
+            - **bboxes (ndarray)**: (n, 4) integers, lower left x, y, then top right x, y of each range.
+    '''
+    starts = np.asarray(starts, dtype=np.int64).reshape(-1)
+    ends = np.asarray(ends, dtype=np.int64).reshape(-1)
+    if dims != 2:
+        return np.array([range2bbox(hlevel, {"start": int(s), "end": int(e)}, dims, margin)
+                         for s, e in zip(starts.tolist(), ends.tolist())], dtype=np.int64).reshape(-1, 4)
+    n = len(starts)
+    rows = []
+    points = []
+    # the points up to the first multiple of 4
+    start = starts + 1
+    aligned = (start + 3) // 4 * 4
+    for k in range(4):
+        sel = np.flatnonzero(start + k <= aligned)
+        rows.append(sel)
+        points.append(start[sel] + k)
+    start = aligned
+    limit = ends + 1
+    inc = np.zeros(n, dtype=np.int64)
+    active = np.flatnonzero(start < limit)
+    while len(active) != 0:
+        s, i, l = start[active], inc[active], limit[active]
+        # locate the proper power incrementer
+        grow = s % (4 ** (i + 1)) == 0
+        while grow.any():
+            i[grow] += 1
+            grow = s % (4 ** (i + 1)) == 0
+        fits = s + 4 ** i <= l
+        while not fits.all():
+            i[~fits] -= 1
+            fits = s + 4 ** i <= l
+        # the 3rd point of the third sub-quadrant is diagonal to the starting point
+        displacement = 2 * (4 ** i - 1) // 3
+        rows += [active, active]
+        points += [s + 1, s + displacement + 1]
+        start[active] = s + 4 ** i
+        inc[active] = i
+        active = active[start[active] < l]
+
+    rows = np.concatenate(rows)
+    x, y = hilbert_points(hlevel, np.concatenate(points))
+    order = np.argsort(rows, kind='stable')
+    bounds = np.searchsorted(rows[order], np.arange(n))
+    x, y = x[order], y[order]
+    bboxes = np.empty((n, 4), dtype=np.int64)
+    if n != 0:
+        bboxes[:, 0] = np.minimum.reduceat(x, bounds) - margin
+        bboxes[:, 1] = np.minimum.reduceat(y, bounds) - margin
+        bboxes[:, 2] = np.maximum.reduceat(x, bounds) + margin
+        bboxes[:, 3] = np.maximum.reduceat(y, bounds) + margin
+    return bboxes
+
+def range2boxes(hlevel, start, end, max_boxes = 16, margin = 0):
+    '''
+    Convert the input query chromosome range to a small set of query boxes in hilbert space, whose union
+    is much tighter than the single box of range2bbox.
+    The hilbert distances of the range are split into aligned blocks of 4**k cells, each block is an aligned
+    square of side 2**k. Neighbouring squares (in curve order) are merged, the merge adding the fewest cells
+    first, while there are more than max_boxes squares or a merge adds no cells.
+    The box of an indexed block (range2bbox) may miss some of the cells of the block, but it always holds
+    a cell at most one step away along the curve from each of them, so the range is grown by one distance
+    on both ends: a block overlapping the range always intersects a query box.
+
+            Parameters:
+            - **hlevel (int)**:       level of the hilbert space, calculated by the size of the chromosome.
+            - **start (int)**:        start location of the query range.
+            - **end (int)**:          end location of the query range.
+            - **max_boxes (int)**:    maximum number of query boxes.
+            - **margin (int)**:       extra margin of the query boxes in hilbert space.
+
+            Returns:
+            - **boxes (ndarray)**: (n, 4) integers, lower left x, y, then top right x, y of each box.
+    '''
+    # positions are stored at distance position + 1, see range2bbox
+    lo = max(int(start), 0)
+    hi = min(int(end) + 2, 4 ** hlevel - 1)
+    blocks = []
+    while lo <= hi:
+        k = 0
+        while k < hlevel and lo % (4 ** (k + 1)) == 0 and lo + 4 ** (k + 1) - 1 <= hi:
+            k += 1
+        blocks.append((lo, k))
+        lo += 4 ** k
+    if len(blocks) == 0:
+        return np.empty((0, 4), dtype=np.int64)
+    x, y = hilbert_points(hlevel, [lo for lo, _ in blocks])
+    boxes = []
+    for x0, y0, (_, k) in zip(x.tolist(), y.tolist(), blocks):
+        side = 1 << k
+        x0, y0 = x0 - x0 % side, y0 - y0 % side
+        boxes.append((x0, y0, x0 + side - 1, y0 + side - 1))
+
+    def cells(box):
+        return (box[2] - box[0] + 1) * (box[3] - box[1] + 1)
+
+    sizes = [cells(box) for box in boxes]
+    while len(boxes) > 1:
+        merged = [(min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])) for a, b in zip(boxes, boxes[1:])]
+        waste = [cells(box) - sizes[i] - sizes[i + 1] for i, box in enumerate(merged)]
+        i = int(np.argmin(waste))
+        if waste[i] > 0 and len(boxes) <= max_boxes:
+            break
+        boxes[i:i + 2] = [merged[i]]
+        sizes[i:i + 2] = [cells(merged[i])]
+    return np.array(boxes, dtype=np.int64) + np.array([-margin, -margin, margin, margin], dtype=np.int64)
+
 def get_genome(t):
     '''
     Get the range of chromosomes of the given type. Currently these are read from hgdownload.cse.ucsc.edu.
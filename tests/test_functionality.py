@@ -1,9 +1,19 @@
 import pytest
 import os
+import threading
+import zlib
+from struct import pack, unpack_from
+from types import SimpleNamespace
+from functools import partialmethod
+import numpy as np
+import pandas
 
 from epivizquindex import QuadTree
+from epivizquindex import IntervalIndex
+from epivizquindex.cache import LRUCache, HandlePool
+from epivizquindex.binning import bin_entries
 from epivizquindex import EpivizQuindex
-from epivizquindex.utils import get_genome
+from epivizquindex.utils import get_genome, range2bbox, range2bbox_many, range2boxes, hcoords, hcoords_many
 
 __author__ = "Yifan_Yang"
 __copyright__ = "Yifan_Yang"
@@ -16,6 +26,943 @@ def test_get_genome():
     assert type(genome.get('chr1')) == int
 
 
+def test_box_intersect():
+    '''
+    Test bounding box intersection, boxes sharing an edge or a corner intersect.
+    '''
+    assert QuadTree.box_intersect((0, 0, 10, 10), (10, 10, 20, 20))
+    assert QuadTree.box_intersect((0, 0, 10, 10), (5, 5, 5, 5))
+    assert not QuadTree.box_intersect((0, 0, 10, 10), (11, 0, 12, 3))
+
+    rects = np.array([(10, 10, 20, 20), (5, 5, 5, 5), (11, 0, 12, 3), (-5, -5, 0, 0)], dtype='d')
+    assert QuadTree.box_intersect_many((0, 0, 10, 10), rects).tolist() == [True, True, False, True]
+
+
+def _random_items(n, width, seed = 0):
+    rng = np.random.default_rng(seed)
+    x = rng.integers(0, width, n)
+    y = rng.integers(0, width, n)
+    w = rng.choice([0, 1, 10, 100], n)
+    items = [(i * 10, i * 10 + 5, i + 1, 7, i % 5) for i in range(n)]
+    bboxes = [(a, b, min(width, a + c), min(width, b + c)) for a, b, c in zip(x.tolist(), y.tolist(), w.tolist())]
+    return items, bboxes
+
+
+def test_index_insert_intersect(tmp_path):
+    '''
+    Test that in memory, file based and loaded quadtree searches match a brute force search.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width)
+    tree = QuadTree.Index(bbox=(0, 0, width, width))
+    for item, bbox in zip(items, bboxes):
+        tree.insert(item, bbox)
+
+    usage = tree.memory_usage()
+    assert usage["items"] == 3000
+    assert usage["nodes"] > 1
+
+    path = str(tmp_path / "quadtree.test.index")
+    tree.to_disk(path)
+    on_disk = QuadTree.Index(disk=path)
+    loaded = QuadTree.Index(disk=path, first_run=True)
+
+    for query in [(0, 0, 10, 10), (100, 200, 400, 260), (512, 512, 512, 512), (0, 0, width, width)]:
+        expected = sorted(item for item, bbox in zip(items, bboxes) if QuadTree.box_intersect(query, bbox))
+        assert sorted(tree.intersect(query, in_memory=True)) == expected
+        assert sorted(on_disk.intersect(query)) == expected
+        assert sorted(loaded.intersect(query, in_memory=True)) == expected
+        # boxes given as lists, e.g. from ndarray.tolist()
+        assert sorted(tree.intersect([list(query)], in_memory=True)) == expected
+        assert sorted(tree.intersect([list(query), [0, 0, 1, 1]], in_memory=True)) == \
+               sorted(set(expected) | set(tree.intersect((0, 0, 1, 1), in_memory=True)))
+        assert sorted(on_disk.intersect(list(query))) == expected
+
+
+def test_index_insert_many():
+    '''
+    Test that a bulk loaded quadtree returns the same items as one built item by item.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width, seed = 2)
+    tree = QuadTree.Index(bbox=(0, 0, width, width))
+    for item, bbox in zip(items, bboxes):
+        tree.insert(item, bbox)
+    bulk = QuadTree.Index(bbox=(0, 0, width, width))
+    bulk.insert_many(np.array(items), np.array(bboxes))
+
+    assert bulk.memory_usage()["items"] == 3000
+    for query in [(0, 0, 10, 10), (100, 200, 400, 260), (0, 0, width, width)]:
+        assert sorted(bulk.intersect(query, in_memory=True)) == sorted(tree.intersect(query, in_memory=True))
+
+
+def test_index_page_layout(tmp_path):
+    '''
+    Test that index files are written depth first with page aligned nodes, and searched the same way.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width, seed = 4)
+    tree = QuadTree.Index(bbox=(0, 0, width, width), max_items = 20)
+    tree.insert_many(np.array(items), np.array(bboxes))
+
+    page_size = 1024
+    path = str(tmp_path / "quadtree.paged.index")
+    tree.to_disk(path, page_size = page_size)
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    assert unpack_from('q', buffer, 48)[0] == page_size
+
+    # walk the file depth first, each node must start after the previous one
+    root = 80 + len(tree.get_field_str())
+    previous = 0
+    stack = [root]
+    while stack:
+        offset = stack.pop()
+        assert offset > previous
+        previous = offset
+        (_, _, _, _, _, count, flags) = unpack_from("ddddllB", buffer, offset)
+        isLeaf = flags & QuadTree.LEAF_FLAG
+        assert flags & QuadTree.FILES_FLAG
+        size = 49 + count * tree.item_size + (0 if isLeaf else 32) + QuadTree.FILES_BYTES
+        if offset != root and size <= page_size:
+            assert offset // page_size == (offset + size - 1) // page_size
+        if not isLeaf:
+            children = unpack_from("llll", buffer, offset + 49)
+            stack += [children[i] for i in (0, 3, 2, 1) if children[i] != -1]
+
+    packed = str(tmp_path / "quadtree.packed.index")
+    tree.to_disk(packed, page_size = 0)
+    for query in [(0, 0, 10, 10), (100, 200, 400, 260), (0, 0, width, width)]:
+        expected = sorted(tree.intersect(query, in_memory=True))
+        assert sorted(QuadTree.Index(disk=path).intersect(query)) == expected
+        assert sorted(QuadTree.Index(disk=packed).intersect(query)) == expected
+
+
+def test_intersect_fileids(tmp_path, monkeypatch):
+    '''
+    Test that searches for some file ids match a filtered search, in memory, in the file and in an index written without file summaries.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width, seed = 6)
+    # the items of a file are close to each other, so that the summaries of most subtrees exclude it
+    items = [item[:4] + (bbox[0] // 4,) for item, bbox in zip(items, bboxes)]
+    tree = QuadTree.Index(bbox=(0, 0, width, width), max_items = 20)
+    tree.insert_many(np.array(items[:2000]), np.array(bboxes[:2000]))
+    for item, bbox in zip(items[2000:], bboxes[2000:]):
+        tree.insert(item, bbox)
+    path = str(tmp_path / "quadtree.files.index")
+    tree.to_disk(path)
+
+    # an index file of the previous format, without file summaries
+    legacy = str(tmp_path / "quadtree.legacy.index")
+    monkeypatch.setattr(QuadTree._QuadTree, "_summarize", lambda self: None)
+    plain = QuadTree.Index(bbox=(0, 0, width, width), max_items = 20)
+    plain.insert_many(np.array(items), np.array(bboxes))
+    for node in [plain] + list(plain):
+        node.files = None
+    plain.to_disk(legacy)
+    monkeypatch.undo()
+
+    # only the files with summaries get the new version, readers reject the versions they do not know
+    with open(path, 'rb') as f:
+        buffer = bytearray(f.read())
+    with open(legacy, 'rb') as f:
+        assert unpack_from('i', f.read(), 12)[0] == QuadTree.NODE_VERSION
+    assert unpack_from('i', buffer, 12)[0] == QuadTree.FILES_VERSION
+    unknown = str(tmp_path / "quadtree.unknown.index")
+    with open(unknown, 'wb') as f:
+        f.write(pack('i', QuadTree.FILES_VERSION + 1).join([buffer[:12], buffer[16:]]))
+    with pytest.raises(Exception, match = "version"):
+        QuadTree.Index(disk=unknown).intersect((0, 0, width, width))
+    with pytest.raises(Exception, match = "version"):
+        QuadTree.Index(disk=unknown, first_run=True)
+
+    indexes = [(tree, True), (QuadTree.Index(disk=path), False), (QuadTree.Index(disk=path, first_run=True, lazy=True), True),
+               (QuadTree.Index(disk=legacy), False), (QuadTree.Index(disk=legacy, first_run=True), True)]
+    for query in [(0, 0, 10, 10), (100, 200, 400, 260), (0, 0, width, width)]:
+        for fileids in [[3], [0, 17, 200, 255], list(range(0, 256, 7)), [1000]]:
+            expected = sorted(item for item in tree.intersect(query, in_memory=True) if item[4] in fileids)
+            for index, in_memory in indexes:
+                assert sorted(index.intersect(query, in_memory=in_memory, fileids=fileids)) == expected
+                assert sorted(index.intersect([query], in_memory=in_memory, fileids=fileids, exclude=fileids[:1])) == \
+                       [item for item in expected if item[4] != fileids[0]]
+
+
+def test_node_cache(tmp_path):
+    '''
+    Test that file based searches reuse cached nodes within the byte budget, and that rewriting a file drops them.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width, seed = 5)
+    tree = QuadTree.Index(bbox=(0, 0, width, width))
+    tree.insert_many(np.array(items), np.array(bboxes))
+    path = str(tmp_path / "quadtree.test.index")
+    tree.to_disk(path)
+
+    cache = LRUCache(64 * 1024)
+    on_disk = QuadTree.Index(disk=path, cache=cache)
+    query = (100, 200, 400, 260)
+    expected = sorted(tree.intersect(query, in_memory=True))
+    assert sorted(on_disk.intersect(query)) == expected
+    misses = cache.misses
+    assert cache.hits == 0 and misses > 0
+    assert sorted(on_disk.intersect(query)) == expected
+    assert cache.hits == misses and cache.misses == misses
+
+    on_disk.intersect((0, 0, width, width))
+    assert cache.evictions > 0
+    assert cache.nbytes <= cache.max_bytes
+
+    QuadTree.Index(disk=path, first_run=True, cache=cache).to_disk(path)
+    assert len(cache) == 0
+
+
+def test_handle_pool():
+    '''
+    Test that the handle pool closes the least recently used idle handles, and never a handle in use or under the pool lock.
+    '''
+    opened, closed = [], []
+
+    def opener(key):
+        opened.append(key)
+        return [key]
+
+    def closer(key, handle):
+        # handles are closed once the pool lock is released
+        assert not pool._lock.locked()
+        closed.append(key)
+
+    pool = HandlePool(2, opener, closer)
+    with pool.handle("a") as a:
+        assert a == ["a"]
+        with pool.handle("b"):
+            pass
+        with pool.handle("c"):
+            assert len(pool) == 3
+        # b is the least recently used idle handle, a is in use
+        assert closed == ["b"] and "a" in pool
+    with pool.handle("a"), pool.handle("c"):
+        pass
+    assert opened == ["a", "b", "c"]
+    assert pool.stats()["hits"] == 2 and pool.stats()["evictions"] == 1
+    pool.add("d", ["d"])
+    assert closed == ["b", "a"] and len(pool) == 2
+    pool.discard("c")
+    pool.clear()
+    assert sorted(closed) == ["a", "b", "c", "d"] and len(pool) == 0
+
+
+def test_lazy_load(tmp_path):
+    '''
+    Test that lazily loaded indexes only load the visited nodes, within the resident limits, and return the same items.
+    '''
+    width = 1024
+    items, bboxes = _random_items(3000, width, seed = 6)
+    tree = QuadTree.Index(bbox=(0, 0, width, width), max_items = 20)
+    tree.insert_many(np.array(items), np.array(bboxes))
+    path = str(tmp_path / "quadtree.test.index")
+    tree.to_disk(path)
+    nodes = tree.memory_usage()["nodes"]
+
+    lazy = QuadTree.Index(disk=path, first_run=True, lazy=True)
+    assert lazy.memory_usage()["nodes"] == 1
+    capped = QuadTree.Index(disk=path, first_run=True, lazy=True, max_resident_nodes=10)
+    shallow = QuadTree.Index(disk=path, first_run=True, lazy=True, max_resident_depth=2)
+
+    query = (100, 200, 140, 260)
+    expected = sorted(tree.intersect(query, in_memory=True))
+    assert sorted(lazy.intersect(query, in_memory=True)) == expected
+    assert 1 < lazy.memory_usage()["nodes"] < nodes
+    for query in [(0, 0, 10, 10), (100, 200, 400, 260), (0, 0, width, width)]:
+        expected = sorted(tree.intersect(query, in_memory=True))
+        assert sorted(capped.intersect(query, in_memory=True)) == expected
+        assert sorted(shallow.intersect(query, in_memory=True)) == expected
+    assert capped.memory_usage()["nodes"] == 10
+    assert shallow.memory_usage()["nodes"] < nodes
+
+    # rewriting the file leaves the nodes not loaded yet readable
+    shallow = QuadTree.Index(disk=path, first_run=True, lazy=True, max_resident_depth=1)
+    small = QuadTree.Index(bbox=(0, 0, width, width), max_items = 20)
+    small.insert_many(np.array(items[:10]), np.array(bboxes[:10]))
+    small.to_disk(path)
+    assert sorted(shallow.intersect((0, 0, width, width), in_memory=True)) == sorted(tree.intersect((0, 0, width, width), in_memory=True))
+    assert sorted(QuadTree.Index(disk=path).intersect((0, 0, width, width))) == sorted(items[:10])
+    assert not os.path.exists(path + ".tmp")
+
+    lazy.insert(items[0], bboxes[0])
+    assert lazy.memory_usage()["items"] == 3001
+
+
+def test_single_file_index(tmp_path):
+    '''
+    Test that an index saved to a single container file loads with the same trees, file mapping and genome.
+    '''
+    genome = {"chr1": 1 << 20, "chr2": 1 << 18}
+    base_path = str(tmp_path) + "/"
+    index = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    index.file_mapping = ["a.bw", "b.bw"]
+    for seed, chrm in enumerate(genome):
+        items, bboxes = _random_items(2000, 1024, seed = seed)
+        index.get_tree(chrm).insert_many(np.array(items), np.array(bboxes))
+    index.to_disk(single_file = True)
+    assert os.listdir(base_path) == [EpivizQuindex.CONTAINER_NAME]
+
+    query = (100, 200, 400, 260)
+    for options in [{"load": False}, {"load": True}, {"load": True, "lazy": True}]:
+        loaded = EpivizQuindex.EpivizQuindex({}, base_path = base_path)
+        loaded.from_disk(**options)
+        assert loaded.genome == genome
+        assert loaded.file_mapping == index.file_mapping
+        for chrm in genome:
+            expected = sorted(index.trees[chrm].intersect(query, in_memory = True))
+            assert sorted(loaded.trees[chrm].intersect(query, in_memory = options["load"])) == expected
+            assert sorted(index.trees[chrm].intersect(query)) == expected
+
+
+def _fake_file(self, file, fileid, zoomlvl = -2, blocks = 200, width = 1000, entries = None, zooms = ()):
+    # the leaf blocks of a fake file on chr1, without reading a bigwig, at random places seeded by the length of its name:
+    # - without entries, blocks blocks of width bases, and no file object,
+    # - with a number of entries, blocks compressed bedgraph blocks of that many entries and a file object reading them,
+    #   entries can also be a dict of the (start, end, value) entries of each file, stored in one block,
+    # - with zooms, 64 record zoom blocks of each reduction level, for the files with a name of at most 4 characters.
+    rng = np.random.default_rng(len(file))
+    length = self.genome["chr1"]
+    bw = None
+    if entries is None:
+        starts = np.sort(rng.integers(0, length - width, blocks))
+        items = np.stack([starts, starts + width, starts + 1, np.full(blocks, 10), np.full(blocks, fileid)], axis = 1)
+    else:
+        if isinstance(entries, dict):
+            sections = [entries[file]]
+        else:
+            span = length // blocks
+            sections = []
+            for block in range(blocks):
+                starts = block * span + np.sort(rng.choice(span // 10, entries, replace = False)) * 10
+                sections.append(list(zip(starts.tolist(), (starts + rng.integers(1, 10, entries)).tolist(), rng.normal(size = entries).tolist())))
+        data, items = bytearray(64), []
+        for section in sections:
+            payload = pack("=IIIIIBBH", 0, section[0][0], section[-1][1], 0, 0, 1, 0, len(section))
+            payload = zlib.compress(payload + b"".join(pack("=IIf", *entry) for entry in section))
+            items.append((section[0][0], section[-1][1], len(data), len(payload), fileid))
+            data += payload
+        data = bytes(data)
+        bw = SimpleNamespace(endian = "=", compressed = True, columns = ["chr", "start", "end", "score"], cacheData = {},
+                             getId = lambda chrm: 0, get_bytes = lambda offset, size: data[offset:offset + size])
+        items = np.array(items, dtype = np.int64)
+    keys = {"chr1": items}
+    if len(zooms) != 0 and len(file) <= 4:
+        levels = []
+        for reduction in zooms:
+            starts = np.arange(0, length, 64 * reduction)
+            ends = np.minimum(starts + 64 * reduction, length - 1)
+            levels.append(np.stack([starts, ends, starts + reduction, np.full(len(starts), 20), np.full(len(starts), fileid),
+                                    np.full(len(starts), reduction)], axis = 1))
+        keys["chr1" + EpivizQuindex.ZOOM_SUFFIX] = np.concatenate(levels)
+    hlevel = int(np.ceil(np.log2(length) / 2))
+    return bw, {key: (items, range2bbox_many(hlevel, items[:, 0], items[:, 1]).astype('d') if self.engine == "quadtree" else None)
+                for key, items in keys.items()}
+
+
+def _use_fake_files(monkeypatch, **options):
+    # index fake files, see _fake_file
+    monkeypatch.setattr(EpivizQuindex.EpivizQuindex, "get_file_blocks", partialmethod(_fake_file, **options))
+
+
+@pytest.mark.parametrize("engine", ["quadtree", "interval"])
+def test_append_files(tmp_path, monkeypatch, engine):
+    '''
+    Test that files appended to a saved index are found through the delta segments, and after compaction.
+    '''
+    _use_fake_files(monkeypatch)
+    genome = {"chr1": 1 << 20}
+    base_path = str(tmp_path / "appended") + "/"
+    full = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "full") + "/", engine = engine)
+    full.add_files(["a.bw", "bb.bw", "ccc.bw"])
+
+    index = EpivizQuindex.EpivizQuindex(genome, base_path = base_path, engine = engine)
+    index.add_files(["a.bw"])
+    index.to_disk()
+    index.append_files(["bb.bw"])
+    loaded = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    loaded.from_disk()
+    loaded.append_files(["ccc.bw"])
+    assert loaded.file_mapping == full.file_mapping
+    assert len(loaded.segments) == 2
+
+    def records(index, in_memory = True):
+        return sorted(map(tuple, index.get_records("chr1", 1000, 300000, in_memory = in_memory).values.tolist()))
+
+    expected = records(full)
+    assert records(loaded) == expected
+    assert records(loaded, in_memory = False) == expected
+    old = [loaded.trees["chr1"]] + [segment["chr1"] for segment in loaded.segments]
+    loaded.compact()
+    assert len(loaded.segments) == 0
+    assert all(tree._buffer is None for tree in old)
+    assert sorted(os.listdir(base_path)) == ["quadtree.chr1.index", "quadtreeFileMaps.index", "quadtreeKeys.index",
+                                           EpivizQuindex.LAYERS_NAME]
+    compacted = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    compacted.from_disk()
+    assert records(compacted) == expected
+
+
+@pytest.mark.parametrize("engine", ["quadtree", "interval"])
+def test_remove_file(tmp_path, monkeypatch, engine):
+    '''
+    Test that removed files are skipped by queries, and dropped with renumbered ids after compaction.
+    '''
+    _use_fake_files(monkeypatch)
+    genome = {"chr1": 1 << 20}
+    base_path = str(tmp_path / "removed") + "/"
+    kept = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "kept") + "/", engine = engine)
+    kept.add_files(["a.bw", "ccc.bw"])
+
+    def records(index, in_memory = True):
+        return sorted(map(tuple, index.get_records("chr1", 1000, 300000, in_memory = in_memory).values.tolist()))
+
+    expected = records(kept)
+    index = EpivizQuindex.EpivizQuindex(genome, base_path = base_path, engine = engine)
+    index.add_files(["a.bw", "bb.bw", "ccc.bw"])
+    index.to_disk()
+    index.remove_file("bb.bw")
+    assert records(index) == expected
+    assert index.active_files() == ["a.bw", "ccc.bw"]
+    assert list(index.hit("chr1", 1000, 300000).file_name) == ["a.bw", "ccc.bw"]
+
+    loaded = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    loaded.from_disk()
+    assert loaded.removed == {1}
+    assert records(loaded, in_memory = False) == expected
+    loaded.compact()
+    assert loaded.file_mapping == ["a.bw", "ccc.bw"]
+    assert loaded.removed == set()
+    assert records(loaded) == expected
+    compacted = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    compacted.from_disk()
+    assert records(compacted) == expected
+    assert sorted(compacted.trees["chr1"].all_items()["fileid"].tolist()) == sorted(kept.trees["chr1"].all_items()["fileid"].tolist())
+
+
+def test_add_files_workers(tmp_path, monkeypatch):
+    '''
+    Test that files read by a process pool get the same ids and items as files read one by one.
+    '''
+    _use_fake_files(monkeypatch)
+    genome = {"chr1": 1 << 20}
+    files = ["a.bw", "bb.bw", "ccc.bw", "dddd.bw"]
+    serial = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "serial") + "/")
+    serial.add_files(files)
+    parallel = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "parallel") + "/")
+    parallel.add_files(files, workers = 2)
+
+    assert parallel.file_mapping == files
+    assert parallel.file_counter == len(files)
+    expected = np.sort(serial.trees["chr1"].all_items())
+    assert np.array_equal(np.sort(parallel.trees["chr1"].all_items()), expected)
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_leaf_blocks(tmp_path, endian):
+    '''
+    Test that the vectorized btree leaf extraction matches the recursive traversal.
+    '''
+    # a two level btree: the root points to 3 leaves of 4 entries, offsets are file offsets
+    fullIndexOffset = 1000
+    leaf_size = 4 + 4 * 32
+    root = pack(endian + "BBH", 0, 0, 3)
+    leaves = b""
+    for i in range(3):
+        root += pack(endian + "IIIIQ", i, 0, i, 100, fullIndexOffset + 48 + 4 + 3 * 24 + i * leaf_size)
+        leaves += pack(endian + "BBH", 1, 0, 4)
+        for j in range(4):
+            leaves += pack(endian + "IIIIQQ", i % 2, j * 10, i % 2, j * 10 + 5, 5000 + i * 100 + j, 7 + j)
+    tree = bytes(48) + root + leaves
+    bw = SimpleNamespace(endian = endian, header = {"fullIndexOffset": fullIndexOffset})
+
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1000}, base_path = str(tmp_path) + "/")
+    expected = index.traverse_nodes(index.read_node(tree, 48, endian), tree = tree, fullIndexOffset = fullIndexOffset, endian = endian)
+    assert len(expected) == 12
+    assert list(map(tuple, index.get_leaf_nodes(tree, bw, -2).values.tolist())) == expected
+
+
+def test_file_search_shared_mapping(tmp_path):
+    '''
+    Test that concurrent file based searches share one memory map of the index.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    width = 1024
+    items, bboxes = _random_items(2000, width, seed = 1)
+    tree = QuadTree.Index(bbox=(0, 0, width, width))
+    for item, bbox in zip(items, bboxes):
+        tree.insert(item, bbox)
+    path = str(tmp_path / "quadtree.test.index")
+    tree.to_disk(path)
+
+    on_disk = QuadTree.Index(disk=path)
+    queries = [(x, x, x + 64, x + 64) for x in range(0, width, 32)]
+    with ThreadPoolExecutor(max_workers = 8) as pool:
+        results = list(pool.map(lambda q: sorted(on_disk.intersect(q)), queries))
+    buffer = on_disk._buffer
+    assert buffer is not None
+    assert results == [sorted(tree.intersect(q, in_memory=True)) for q in queries]
+    assert on_disk._open() is buffer
+    on_disk.close()
+
+
+def test_interval_index(tmp_path):
+    '''
+    Test that in memory, file based and loaded interval index searches match a brute force search.
+    '''
+    rng = np.random.default_rng(3)
+    starts = rng.integers(0, 100000, 5000)
+    ends = starts + rng.choice([0, 10, 1000, 50000], 5000)
+    items = [(s, e, i + 1, 7, i % 5) for i, (s, e) in enumerate(zip(starts.tolist(), ends.tolist()))]
+    index = IntervalIndex.IntervalIndex(chunk_size = 16)
+    index.insert_many(np.array(items[:3000]))
+    for item in items[3000:]:
+        index.insert(item)
+
+    path = str(tmp_path / "quadtree.test.index")
+    index.to_disk(path)
+    on_disk = IntervalIndex.IntervalIndex(disk=path)
+    loaded = IntervalIndex.IntervalIndex(disk=path, first_run=True)
+
+    for start, end in [(0, 0), (500, 700), (99999, 200000), (0, 200000), (-10, -1)]:
+        expected = sorted(item for item in items if item[1] >= start and item[0] <= end)
+        assert sorted(index.intersect((start, end), in_memory=True)) == expected
+        assert sorted(on_disk.intersect((start, end))) == expected
+        assert sorted(loaded.intersect((start, end), in_memory=True)) == expected
+
+    # version 1 files, without the running max of the chunk max ends, are still read, other versions are rejected
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    assert unpack_from('i', buffer, 12)[0] == IntervalIndex.INTERVAL_VERSION
+    num_chunks = unpack_from('q', buffer, 32)[0]
+    for version, data in [(1, buffer[:len(buffer) - 8 * num_chunks]), (IntervalIndex.INTERVAL_VERSION + 1, buffer)]:
+        with open(str(tmp_path / "interval.old.index"), 'wb') as f:
+            f.write(buffer[:12] + pack('i', version) + data[16:])
+        old = IntervalIndex.IntervalIndex(disk=str(tmp_path / "interval.old.index"))
+        if version == 1:
+            for start, end in [(500, 700), (99999, 200000)]:
+                assert sorted(old.intersect((start, end))) == sorted(index.intersect((start, end), in_memory=True))
+        else:
+            with pytest.raises(Exception, match = "version"):
+                old.intersect((500, 700))
+        old.close()
+    # rewriting the file leaves the open map of the old one readable
+    small = IntervalIndex.IntervalIndex(chunk_size = 16)
+    small.insert_many(np.array(items[:10]))
+    small.to_disk(path)
+    assert sorted(on_disk.intersect((0, 200000))) == sorted(items)
+    on_disk.close()
+    assert sorted(IntervalIndex.IntervalIndex(disk=path).intersect((0, 200000))) == sorted(items[:10])
+
+    # searches running while items are inserted see whole merges
+    concurrent = IntervalIndex.IntervalIndex(chunk_size = 16)
+    def insert():
+        for item in items:
+            concurrent.insert(item)
+    thread = threading.Thread(target = insert)
+    thread.start()
+    while thread.is_alive():
+        found = concurrent.intersect((500, 700), in_memory=True)
+        assert all(item[1] >= 500 and item[0] <= 700 for item in found)
+    thread.join()
+    assert sorted(concurrent.intersect((500, 700), in_memory=True)) == sorted(item for item in items if item[1] >= 500 and item[0] <= 700)
+
+
+def test_hilbert_many():
+    '''
+    Test that the batched hilbert encodings match the scalar ones.
+    '''
+    for hlevel in range(2, 5):
+        # ranges close to the end of the curve step past its last point
+        starts, ends = np.triu_indices(4 ** hlevel // 2)
+        expected = [list(range2bbox(hlevel, {"start": s, "end": e})) for s, e in zip(starts.tolist(), ends.tolist())]
+        assert range2bbox_many(hlevel, starts, ends).tolist() == expected
+
+    rng = np.random.default_rng(4)
+    hlevel = 14
+    starts = rng.integers(0, 4 ** hlevel - 100000, 500)
+    ends = starts + rng.choice([0, 3, 4000, 100000], 500)
+    expected = [list(range2bbox(hlevel, {"start": s, "end": e})) for s, e in zip(starts.tolist(), ends.tolist())]
+    assert range2bbox_many(hlevel, starts, ends).tolist() == expected
+
+    xs = rng.integers(0, 195471971, 500)
+    x, y, hlevel = hcoords_many(xs, 195471971)
+    assert list(zip(x.tolist(), y.tolist(), [hlevel] * len(xs))) == [hcoords(x, 195471971) for x in xs.tolist()]
+
+
+def test_query_boxes(tmp_path, monkeypatch):
+    '''
+    Test that a range searched as several hilbert boxes finds every overlapping block, with fewer candidates.
+    '''
+    hlevel = 6
+    rng = np.random.default_rng(5)
+    starts = rng.integers(0, 4 ** hlevel - 600, 3000)
+    ends = starts + rng.choice([0, 5, 40, 300], 3000)
+    items = np.stack([starts, ends, np.arange(3000) + 1, np.full(3000, 7), np.zeros(3000, dtype=int)], axis = 1)
+    tree = QuadTree.Index(bbox=(0, 0, 2 ** hlevel, 2 ** hlevel), max_items = 16)
+    tree.insert_many(items, range2bbox_many(hlevel, starts, ends).astype('d'))
+    for start in range(0, 4 ** hlevel - 700, 37):
+        end = start + int(rng.choice([0, 10, 100, 600]))
+        expected = set(map(tuple, items[(items[:, 0] <= end) & (items[:, 1] >= start)].tolist()))
+        boxes = range2boxes(hlevel, start, end, max_boxes = 8)
+        assert 1 <= len(boxes) <= 8
+        found = set(item for item in tree.intersect(boxes, in_memory = True) if item[0] <= end and item[1] >= start)
+        assert found == expected
+
+    _use_fake_files(monkeypatch)
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1 << 20}, base_path = str(tmp_path) + "/")
+    index.add_files(["a.bw", "bb.bw", "ccc.bw"])
+    single = index.get_records("chr1", 1000, 300000, max_boxes = 1)
+    single_stats = index.last_query_stats
+    records = index.get_records("chr1", 1000, 300000)
+    assert sorted(map(tuple, records.values.tolist())) == sorted(map(tuple, single.values.tolist()))
+    assert index.last_query_stats["results"] == len(records)
+    assert single_stats["boxes"] == 1 and index.last_query_stats["boxes"] > 1
+    assert index.last_query_stats["candidates"] <= single_stats["candidates"]
+
+
+@pytest.mark.parametrize("engine", ["quadtree", "interval"])
+def test_get_records_many(tmp_path, monkeypatch, engine):
+    '''
+    Test that a batch search matches one search per region.
+    '''
+    _use_fake_files(monkeypatch)
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1 << 20}, base_path = str(tmp_path) + "/", engine = engine)
+    index.add_files(["a.bw", "bb.bw", "ccc.bw"])
+    regions = [("chr1", start, start + width) for start, width in zip(range(0, 1000000, 25000), [0, 100, 5000, 80000] * 10)]
+    records = index.get_records_many(regions)
+    for region, (chrm, start, end) in enumerate(regions):
+        expected = sorted(map(tuple, index.get_records(chrm, start, end).values.tolist()))
+        found = records.loc[records["region"] == region].drop(columns = ["region", "chr"])
+        assert sorted(map(tuple, found.values.tolist())) == expected
+        # the searches for some files skip the blocks of the others
+        some = sorted(map(tuple, index.get_records(chrm, start, end, file_names = ["a.bw", "ccc.bw"]).values.tolist()))
+        assert some == [record for record in expected if record[4] != "bb.bw"]
+
+    frame = pandas.DataFrame(regions, columns = ["chr", "start", "end"], index = ["r%d" % i for i in range(len(regions))])
+    has_data = index.has_data_many(frame, file_names = ["a.bw"])
+    assert list(has_data.columns) == ["region", "chr", "start", "end", "file_name"]
+    assert set(has_data["file_name"]) == {"a.bw"}
+    assert set(has_data["region"]) <= set(frame.index)
+    with pytest.raises(Exception):
+        index.query_many(frame.set_index(frame.index.str[:2]))
+
+
+@pytest.mark.parametrize("engine", ["quadtree", "interval"])
+def test_select_zoom(tmp_path, monkeypatch, engine):
+    '''
+    Test that each file is read at its coarsest zoom level meeting the resolution, or at the base level.
+    '''
+    _use_fake_files(monkeypatch, zooms = [100, 400, 1600])
+    base_path = str(tmp_path) + "/"
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1 << 20}, base_path = base_path, engine = engine)
+    index.add_files(["a.bw", "ccccc.bw"])
+    zoom = index.get_records("chr1", 100000, 400000, zoomlvl = -1)
+    assert set(zoom["reduction"]) == {100, 400, 1600}
+    assert set(zoom["file_name"]) == {"a.bw"}
+
+    for resolution, level in [(50, -2), (399, 100), (400, 400), (10 ** 6, 1600)]:
+        records = index.select_zoom("chr1", 100000, 400000, resolution)
+        assert set(records.loc[records["file_name"] == "a.bw", "zoomlvl"]) == {level}
+        assert set(records.loc[records["file_name"] == "ccccc.bw", "zoomlvl"]) == {-2}
+        expected = zoom.loc[zoom["reduction"] == level] if level != -2 else index.get_records("chr1", 100000, 400000)
+        found = records.loc[records["file_name"] == "a.bw"].drop(columns = ["zoomlvl"])
+        assert len(found) == len(expected.loc[expected["file_name"] == "a.bw"])
+    assert set(index.select_zoom("chr1", 100000, 400000, 1000, file_names = ["a.bw"])["zoomlvl"]) == {400}
+    # zoom levels are selected with zoomlvl -1 and a resolution or number of bins
+    for zoomlvl, options in [(-1, {}), (-2, {"num_bins": 100}), (-2, {"resolution": 1000}), (400, {"resolution": 1000})]:
+        with pytest.raises(Exception):
+            index.query("chr1", 100000, 400000, zoomlvl = zoomlvl, **options)
+
+    # the batch query selects the level of each region and file like select_zoom, the files are not read
+    def fetch_many(requests, workers = None):
+        return [([[start], [zoomlvl], [(records["file_name"] == name).sum()]], ["start", "zoomlvl", "blocks"])
+                for name, records, chrm, start, end, zoomlvl in requests]
+    monkeypatch.setattr(index, "fetch_many", fetch_many)
+    regions = [("chr1", 100000, 400000), ("chr1", 0, 30000), ("chr1", 500000, 500100)]
+    found = index.query_many(regions, zoomlvl = -1, num_bins = 100)
+    for region, (chrm, start, end) in enumerate(regions):
+        expected = index.select_zoom(chrm, start, end, (end - start) / 100)
+        for name, records in expected.groupby("file_name"):
+            row = found.loc[(found["region"] == region) & (found["file_name"] == name)]
+            assert row["zoomlvl"].tolist() == [records["zoomlvl"].iloc[0]] and row["blocks"].tolist() == [len(records)]
+    assert set(index.query_many(regions, zoomlvl = -1, resolution = 10 ** 6)["zoomlvl"]) == {1600, -2}
+    with pytest.raises(Exception):
+        index.query_many(regions, zoomlvl = -1)
+
+    index.to_disk()
+    loaded = EpivizQuindex.EpivizQuindex({"chr1": 1 << 20}, base_path = base_path)
+    loaded.from_disk()
+    records = loaded.select_zoom("chr1", 100000, 400000, 1000)
+    assert records.equals(index.select_zoom("chr1", 100000, 400000, 1000))
+
+
+def test_query_fetch_workers(tmp_path, monkeypatch):
+    '''
+    Test that files fetched by a thread pool give the same result as fetching them one after the other.
+    '''
+    import time
+
+    threads = set()
+
+    def fetch_arrays(self, file_name, df, chrm, start, end, zoomlvl):
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+        rows = df[df["file_name"] == file_name]
+        return [np.zeros(len(rows)), rows["start"].values, rows["end"].values, np.full(len(rows), len(file_name))], ["chr", "start", "end", "score"]
+
+    _use_fake_files(monkeypatch)
+    monkeypatch.setattr(EpivizQuindex.EpivizQuindex, "fetch_arrays", fetch_arrays)
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1 << 20}, base_path = str(tmp_path) + "/")
+    index.add_files(["a.bw", "bb.bw", "ccc.bw", "dddd.bw"])
+    serial = index.query("chr1", 1000, 300000, workers = 1)
+    assert len(threads) == 1
+    concurrent = index.query("chr1", 1000, 300000, workers = 4)
+    assert len(threads) > 1
+    assert serial.equals(concurrent)
+    assert index.query("chr1", 1000, 300000, file_names = ["bb.bw"]).equals(serial.loc[serial["file_name"] == "bb.bw"])
+
+
+def test_fetch_entries_coalesced(tmp_path):
+    '''
+    Test that blocks fetched with coalesced reads are decoded like BigWig.parseLeafDataNode, and cached.
+    '''
+    from epivizFileParser import BigWig
+
+    blocks = [pack("=IIIIIBBH", 0, 100, 200, 0, 0, 1, 0, 3) + b"".join(pack("=IIf", 100 + 30 * i, 120 + 30 * i, i + 0.5) for i in range(3)),
+              pack("=IIIIIBBH", 0, 150, 250, 25, 10, 3, 0, 4) + b"".join(pack("=f", -i * 1.25) for i in range(4)),
+              pack("=IIIIIBBH", 1, 0, 50, 0, 0, 1, 0, 2) + b"".join(pack("=IIf", 10 * i, 10 * i + 5, 2.0) for i in range(2))]
+    data = bytearray(300)
+    offsets = []
+    for block, gap in zip(blocks, [0, 10, 100000]):
+        offsets.append(len(data) + gap)
+        data += bytes(gap) + zlib.compress(block)
+    data = bytes(data)
+    reads = []
+
+    def get_bytes(offset, size):
+        reads.append((offset, size))
+        return data[offset:offset + size]
+
+    bw = SimpleNamespace(endian = "=", compressed = True, columns = ["chr", "start", "end", "score"], cacheData = {},
+                         getId = lambda chrm: 0, get_bytes = get_bytes)
+    records = pandas.DataFrame({"start": [100, 150, 0], "end": [200, 250, 50], "offset": offsets,
+                                "size": [len(zlib.compress(block)) for block in blocks], "file_name": "a.bw"})
+    index = EpivizQuindex.EpivizQuindex({"chr1": 1000}, base_path = str(tmp_path) + "/")
+    index.file_objects.add("a.bw", bw)
+    entries, columns = index.fetch_entries("a.bw", records, "chr1", 110, 190, -2)
+    # the decoded blocks are cached
+    assert index.fetch_entries("a.bw", records, "chr1", 110, 190, -2)[0] == entries
+    assert len(reads) == 2
+    assert index.block_cache_stats()["hits"] == 3 and index.block_cache_stats()["entries"] == 3
+    expected = []
+    for i, row in records.iterrows():
+        bw.cacheData = {}
+        expected += BigWig.parseLeafDataNode(bw, 0, 110, 190, -2, 0, row["start"], 0, row["end"], row["offset"], row["size"])
+    # the fixed step values of parseLeafDataNode are 1-tuples
+    assert entries == [entry[:3] + (entry[3][0] if isinstance(entry[3], tuple) else entry[3],) for entry in expected]
+    assert columns == bw.columns
+
+    zoom = b"".join(pack("=4I4f", 0, 40 * i, 40 * i + 40, i, 0.0, 1.0, 3.0 * i, 1.0) for i in range(5))
+    data = zlib.compress(zoom)
+    bw.cacheData = {}
+    records = pandas.DataFrame({"start": [0], "end": [200], "offset": [0], "size": [len(data)], "file_name": "a.bw"})
+    entries, _ = index.fetch_entries("a.bw", records, "chr1", 50, 130, 2)
+    bw.cacheData = {}
+    assert entries == BigWig.parseLeafDataNode(bw, 0, 50, 130, 2, 0, 0, 0, 200, 0, len(data))
+
+
+def test_index_zoomlvl(tmp_path):
+    '''
+    Test that files added with a zoom level still index their base level blocks in the chromosome trees,
+    and their zoom level blocks in the zoom trees.
+    '''
+    pyBigWig = pytest.importorskip("pyBigWig")
+    path = str(tmp_path / "zoom.bw")
+    bw = pyBigWig.open(path, "w")
+    bw.addHeader([("chr1", 1000000)], maxZooms = 2)
+    starts = np.arange(0, 1000000, 50)
+    bw.addEntries(["chr1"] * len(starts), starts.tolist(), ends = (starts + 25).tolist(), values = np.sin(starts / 1000).tolist())
+    bw.close()
+
+    base = EpivizQuindex.EpivizQuindex({"chr1": 1000000}, base_path = str(tmp_path / "base") + "/")
+    base.add_to_index(path)
+    zoom = EpivizQuindex.EpivizQuindex({"chr1": 1000000}, base_path = str(tmp_path / "zoom") + "/")
+    zoom.add_to_index(path, zoomlvl = 0)
+    assert sorted(zoom.trees) == ["chr1", "chr1" + EpivizQuindex.ZOOM_SUFFIX]
+    for key, tree in base.trees.items():
+        assert np.array_equal(zoom.trees[key].all_items(), tree.all_items())
+    records = zoom.query("chr1", 1000, 2000)
+    assert records["start"].tolist() == list(range(1000, 2001, 50))
+    assert np.allclose(records["score"], np.sin(records["start"] / 1000))
+    assert zoom.query("chr1", 0, 1000000, zoomlvl = -1, num_bins = 10).equals(base.query("chr1", 0, 1000000, zoomlvl = -1, num_bins = 10))
+
+
+def test_bin_entries():
+    '''
+    Test the binned statistics of entries of several files against a bin by bin computation.
+    '''
+    stats = bin_entries([0, 0, 0, 1], [0, 15, 30, 5], [10, 35, 31, 100], [1.0, 2.0, -4.0, 3.0], 0, 40, 4, 3)
+    assert stats["coverage"].tolist() == [[10, 5, 10, 6], [5, 10, 10, 10], [0, 0, 0, 0]]
+    assert stats["sum"].tolist() == [[10, 10, 20, 6], [15, 30, 30, 30], [0, 0, 0, 0]]
+    assert stats["min"][0].tolist() == [1, 2, 2, -4] and stats["max"][0].tolist() == [1, 2, 2, 2]
+    assert np.isnan(stats["mean"][2]).all() and stats["mean"][1].tolist() == [3, 3, 3, 3]
+
+    rng = np.random.default_rng(3)
+    starts = np.sort(rng.integers(0, 10000, 300))
+    ends = starts + rng.integers(1, 500, 300)
+    files = rng.integers(0, 4, 300)
+    values = rng.normal(size = 300)
+    stats = bin_entries(files, starts, ends, values, 1000, 9000, 37, 4)
+    edges = 1000 + 8000 * np.arange(38) / 37
+    for f in range(4):
+        for b in range(37):
+            overlap = np.minimum(ends, edges[b + 1]) - np.maximum(starts, edges[b])
+            hit = (overlap > 0) & (files == f)
+            assert np.isclose(stats["sum"][f, b], (overlap[hit] * values[hit]).sum())
+            assert np.isclose(stats["coverage"][f, b], overlap[hit].sum())
+            if hit.any():
+                assert stats["max"][f, b] == values[hit].max()
+
+
+
+def test_summary_layer(tmp_path, monkeypatch):
+    '''
+    Test that the summary layer gives the statistics of the entries without reading the files, and is saved with the index.
+    '''
+    _use_fake_files(monkeypatch, blocks = 40, entries = 10)
+    base_path = str(tmp_path) + "/"
+    genome = {"chr1": 800000, "chr2": 1000}
+    index = EpivizQuindex.EpivizQuindex(genome, base_path = base_path, summary_resolutions = [10000, 1000])
+    index.add_files(["a.bw", "bb.bw", "ccc.bw"])
+    assert index.summary_resolutions == [1000, 10000]
+
+    # bins aligned with the tiles are exact
+    summary = index.bin_stats("chr1", 100000, 600000, num_bins = 50, summary = True)
+    entries = index.bin_stats("chr1", 100000, 600000, num_bins = 50)
+    for name in ["count", "coverage", "sum", "squares", "mean", "min", "max"]:
+        assert np.allclose(summary[name].values, entries[name].values, equal_nan = True)
+    whole = index.summary("chr1", 0, 800000)
+    expected = index.bin_stats("chr1", 0, 800000, num_bins = 1)
+    assert np.allclose(whole["sum"].values, expected["sum"].values[:, 0])
+    assert np.allclose(whole["coverage"].values, expected["coverage"].values[:, 0])
+    assert (index.summary("chr2", 0, 1000)["coverage"] == 0).all()
+
+    index.to_disk()
+    index.remove_file("bb.bw")
+    assert list(index.summary("chr1", 0, 800000).index) == ["a.bw", "ccc.bw"]
+    loaded = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    loaded.from_disk()
+    assert loaded.summary("chr1", 0, 800000).equals(whole.loc[["a.bw", "ccc.bw"]])
+    loaded.remove_file("a.bw")
+    loaded.compact()
+    assert loaded.file_mapping == ["ccc.bw"]
+    assert loaded.summary("chr1", 0, 800000).equals(whole.loc[["ccc.bw"]])
+
+    # appended files keep their tiles in their delta segment, the saved layers are not rewritten
+    saved = os.stat(base_path + EpivizQuindex.LAYERS_NAME).st_mtime_ns
+    loaded.append_files(["dddd.bw"])
+    assert os.stat(base_path + EpivizQuindex.LAYERS_NAME).st_mtime_ns == saved
+    full = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "full") + "/", summary_resolutions = [10000, 1000])
+    full.add_files(["ccc.bw", "dddd.bw"])
+    expected = full.bin_stats("chr1", 100000, 600000, num_bins = 50, summary = True)["sum"]
+    assert loaded.bin_stats("chr1", 100000, 600000, num_bins = 50, summary = True)["sum"].equals(expected)
+    reloaded = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    reloaded.from_disk()
+    assert reloaded.summary_resolutions == [1000, 10000]
+    assert reloaded.bin_stats("chr1", 100000, 600000, num_bins = 50, summary = True)["sum"].equals(expected)
+    reloaded.compact()
+    assert len(reloaded.summaries["chr1"][1000]) == 2
+    assert reloaded.bin_stats("chr1", 100000, 600000, num_bins = 50, summary = True)["sum"].equals(expected)
+    with pytest.raises(Exception):
+        EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "none") + "/").summary("chr1", 0, 1000)
+
+
+def test_plot_helpper(tmp_path, monkeypatch):
+    '''
+    Test the heatmap values of region_plot on entries with gaps inside the bins, from the entries and from the summary layer.
+    '''
+    entries = {"a.bw": [(100, 300, 2.0), (500, 600, -1.0), (1500, 2000, 4.0)], "bb.bw": [(2500, 3500, 1.0)]}
+    _use_fake_files(monkeypatch, entries = entries)
+    index = EpivizQuindex.EpivizQuindex({"chr1": 10000}, base_path = str(tmp_path) + "/", summary_resolutions = [1000])
+    index.add_files(["a.bw", "bb.bw"])
+
+    # the bins are 1000 bases, a.bw covers 300 bases of the first with a sum of 400 - 100 and 500 of the second
+    values = index.plot_helpper("chr1", 0, 4000, num_bins = 4, show_missing = False)
+    assert list(values.index) == ["a.bw", "bb.bw"]
+    assert list(values.columns) == ["1 k", "2 k", "3 k", "4 k"]
+    assert np.allclose(values.values, [[0.3, 2.0, 0, 0], [0, 0, 0.5, 0.5]])
+    # the uncovered bases count as -1
+    missing = index.plot_helpper("chr1", 0, 4000, num_bins = 4)
+    assert np.allclose(missing.values, [[-0.4, 1.5, -1, -1], [-1, -1, 0, 0]])
+    for show_missing, expected in [(False, values), (True, missing)]:
+        summary = index.plot_helpper("chr1", 0, 4000, num_bins = 4, show_missing = show_missing, summary = True)
+        assert list(summary.columns) == list(expected.columns)
+        assert np.allclose(summary.values, expected.values)
+
+
+def test_presence_hit(tmp_path, monkeypatch):
+    '''
+    Test that hit with the presence bitmaps finds the same files as a search of the index, after saving, removing and compacting.
+    '''
+    _use_fake_files(monkeypatch, blocks = 8, width = 3000)
+    genome = {"chr1": 1 << 20, "chr2": 1000}
+    base_path = str(tmp_path) + "/"
+    files = ["f" * n + ".bw" for n in range(1, 11)]
+    index = EpivizQuindex.EpivizQuindex(genome, base_path = base_path, presence_tile = 4096)
+    index.add_files(files[:6])
+    index.to_disk()
+    saved = os.stat(base_path + EpivizQuindex.LAYERS_NAME).st_mtime_ns
+    index.append_files(files[6:8])
+    index.append_files(files[8:])
+    assert os.stat(base_path + EpivizQuindex.LAYERS_NAME).st_mtime_ns == saved
+    assert [layers["presence"]["chr1"][4096]["bits"].shape[1] for layers in index.segment_layers] == [1, 1]
+    # the bitmaps keep one row per run of tiles with the same files
+    assert len(index.presence["chr1"][4096]) < genome["chr1"] // 4096
+    plain = EpivizQuindex.EpivizQuindex(genome, base_path = str(tmp_path / "plain") + "/", presence_tile = None)
+    plain.add_files(files)
+    assert plain.presence == {}
+
+    rng = np.random.default_rng(0)
+    ranges = [(0, genome["chr1"] - 1), (4096, 8191), (100, 200)]
+    ranges += [tuple(sorted(r)) for r in rng.integers(0, genome["chr1"], (40, 2)).tolist()]
+
+    def check(index, removed = ()):
+        for start, end in ranges:
+            hits = index.hit("chr1", start, end)
+            expected = plain.hit("chr1", start, end, file_names = [f for f in files if f not in removed])
+            assert hits.equals(expected)
+        assert not index.hit("chr2", 0, 999)["hit"].any()
+
+    check(index)
+    loaded = EpivizQuindex.EpivizQuindex(genome, base_path = base_path)
+    loaded.from_disk()
+    assert loaded.presence_tile == 4096
+    check(loaded)
+    loaded.remove_file(files[2])
+    check(loaded, [files[2]])
+    loaded.compact()
+    assert loaded.presence["chr1"][4096]["bits"].shape[1] == 2
+    check(loaded, [files[2]])
+    assert not loaded.hit("chr1", 0, 1000, file_names = ["none.bw"])["hit"].any()
+
+    # the layers are saved in the container of a single file index
+    single_path = str(tmp_path / "single") + "/"
+    single = EpivizQuindex.EpivizQuindex(genome, base_path = single_path, presence_tile = 4096)
+    single.add_files(files)
+    single.to_disk(single_file = True)
+    assert os.listdir(single_path) == [EpivizQuindex.CONTAINER_NAME]
+    single = EpivizQuindex.EpivizQuindex(genome, base_path = single_path)
+    single.from_disk()
+    assert single.presence_tile == 4096
+    check(single)
+
+
 def test_in_memory_query():
     '''
     Test index creation, and in_memory query. 